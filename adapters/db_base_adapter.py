@@ -1,7 +1,26 @@
+from enum import Enum
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
 from typing import Union, List
 
 
+class DbOperationType(Enum):
+    # replaces the whole document matching the query or inserts it
+    REPLACE = 'replace'
+    # sets fields of the document matching the query
+    UPDATE = 'update'
+    # sets fields of the document matching the query or inserts it
+    UPSERT = 'upsert'
+    REMOVE = 'remove'
+
+
+@dataclass
+class DbWriteOperation:
+    operation_type: DbOperationType
+    query: dict
+    data: dict = None
+
+
 class BaseDbAdapter(ABC):
 
     @abstractmethod
@@ -9,7 +28,7 @@ class BaseDbAdapter(ABC):
         raise NotImplementedError("Database adapter must implement save method")
 
     @abstractmethod
-    def select(self, query: object, multiple: bool = False) -> Union[dict, List[dict]]:
+    def select(self, query: object, multiple: bool = False, projection: dict = None) -> Union[dict, List[dict]]:
         raise NotImplementedError("Database adapter must implement load method")
 
     @abstractmethod
@@ -19,3 +38,56 @@ class BaseDbAdapter(ABC):
     @abstractmethod
     def remove(self, old_data: dict):
         raise NotImplementedError("Database adapter must implement remove method")
+
+    @abstractmethod
+    def upsert(self, query: dict, new_data: dict) -> bool:
+        raise NotImplementedError("Database adapter must implement upsert method")
+
+    @abstractmethod
+    def replace(self, query: dict, data: dict, upsert: bool = True):
+        raise NotImplementedError("Database adapter must implement replace method")
+
+    @abstractmethod
+    def bulk_write(self, operations: List[DbWriteOperation]) -> List[bool]:
+        raise NotImplementedError("Database adapter must implement bulk_write method")
+
+    @abstractmethod
+    def ensure_index(self, fields: List[str], unique: bool = False, expire_after_seconds: int = None,
+                     partial_filter: dict = None):
+        raise NotImplementedError("Database adapter must implement ensure_index method")
+
+
+class BaseAsyncDbAdapter(ABC):
+
+    @abstractmethod
+    async def save(self, data: dict) -> str:
+        raise NotImplementedError("Database adapter must implement save method")
+
+    @abstractmethod
+    async def select(self, query: object, multiple: bool = False, projection: dict = None) -> Union[dict, List[dict]]:
+        raise NotImplementedError("Database adapter must implement load method")
+
+    @abstractmethod
+    async def update(self, old_data: dict, new_data: dict):
+        raise NotImplementedError("Database adapter must implement update method")
+
+    @abstractmethod
+    async def remove(self, old_data: dict):
+        raise NotImplementedError("Database adapter must implement remove method")
+
+    @abstractmethod
+    async def upsert(self, query: dict, new_data: dict) -> bool:
+        raise NotImplementedError("Database adapter must implement upsert method")
+
+    @abstractmethod
+    async def replace(self, query: dict, data: dict, upsert: bool = True):
+        raise NotImplementedError("Database adapter must implement replace method")
+
+    @abstractmethod
+    async def bulk_write(self, operations: List[DbWriteOperation]) -> List[bool]:
+        raise NotImplementedError("Database adapter must implement bulk_write method")
+
+    @abstractmethod
+    async def ensure_index(self, fields: List[str], unique: bool = False, expire_after_seconds: int = None,
+                           partial_filter: dict = None):
+        raise NotImplementedError("Database adapter must implement ensure_index method")
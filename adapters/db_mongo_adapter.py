@@ -1,14 +1,25 @@
-from pymongo import MongoClient
+from typing import List, Tuple
 
-from adapters.db_base_adapter import BaseDbAdapter
+from pymongo import MongoClient, ASCENDING, ReplaceOne, UpdateOne, DeleteMany
+from pymongo.errors import DuplicateKeyError, OperationFailure, BulkWriteError
+
+from adapters.db_base_adapter import BaseDbAdapter, DbWriteOperation, DbOperationType
+
+# MongoDB error codes of an index which exists with different options and of a duplicate key
+INDEX_OPTIONS_CONFLICT = 85
+DUPLICATE_KEY_ERROR = 11000
 
 
 class MongoDbAdapter(BaseDbAdapter):
 
-    def __init__(self, db_name: str, series_name: str, username: str, password: str,
-                 host: str = '127.0.0.1', port: int = 27017):
+    def __init__(self, db_name: str, series_name: str, username: str = None, password: str = None,
+                 host: str = '127.0.0.1', port: int = 27017, db_client: MongoClient = None):
+        # a client passed by DbAdapterRegistry is shared with other adapters and is closed by the registry
+        self.owns_client = db_client is None
         try:
-            self.db_client = MongoClient(host=host, port=port, username=username, password=password)
+            if db_client is None:
+                db_client = MongoClient(host=host, port=port, username=username, password=password)
+            self.db_client = db_client
             self.db = self.db_client[db_name]
             self.collection = self.db[series_name]
         except Exception as e:
@@ -20,13 +31,13 @@ class MongoDbAdapter(BaseDbAdapter):
         except Exception as e:
             raise ConnectionError('Could not insert to MongoDB. Reason:', str(e))
 
-    def select(self, query: dict, multiple: bool = False):
+    def select(self, query: dict, multiple: bool = False, projection: dict = None):
         try:
             if multiple:
-                results = self.collection.find(query)
+                results = self.collection.find(query, projection)
                 return [rs for rs in results]
             else:
-                return self.collection.find_one(query)
+                return self.collection.find_one(query, projection)
         except Exception as e:
             raise ConnectionError('Could not select from MongoDB. Reason:', str(e))
 
@@ -38,6 +49,106 @@ class MongoDbAdapter(BaseDbAdapter):
 
     def remove(self, old_data: dict):
         try:
-            self.collection.remove(old_data)
+            self.collection.delete_many(old_data)
         except Exception as e:
             raise ConnectionError('Could not remove in MongoDB. Reason:', str(e))
+
+    def upsert(self, query: dict, new_data: dict) -> bool:
+        """
+        Updates document matching the query or inserts it, returns False when the insert conflicts with existing one
+        """
+        try:
+            self.collection.update_one(query, {"$set": new_data}, upsert=True)
+            return True
+        except DuplicateKeyError:
+            return False
+        except Exception as e:
+            raise ConnectionError('Could not upsert in MongoDB. Reason:', str(e))
+
+    def replace(self, query: dict, data: dict, upsert: bool = True):
+        try:
+            self.collection.replace_one(query, data, upsert=upsert)
+        except Exception as e:
+            raise ConnectionError('Could not replace in MongoDB. Reason:', str(e))
+
+    def bulk_write(self, operations: List[DbWriteOperation]) -> List[bool]:
+        """
+        Sends the operations in one unordered batch, returns for every operation whether it succeeded,
+        upserts conflicting with existing documents fail without failing the others
+        """
+        if not operations:
+            return []
+        try:
+            self.collection.bulk_write([create_write_request(operation) for operation in operations],
+                                        ordered=False)
+        except BulkWriteError as e:
+            return bulk_write_succeeded(len(operations), e)
+        except Exception as e:
+            raise ConnectionError('Could not bulk write to MongoDB. Reason:', str(e))
+
+        return [True] * len(operations)
+
+    def ensure_index(self, fields: List[str], unique: bool = False, expire_after_seconds: int = None,
+                     partial_filter: dict = None):
+        """
+        Creates ascending index on the fields, expire_after_seconds makes it a TTL index removing documents
+        that many seconds after the date in the field, changed TTL of existing index is updated in place
+        """
+        keys, options = index_options(fields, unique, expire_after_seconds, partial_filter)
+        try:
+            self.collection.create_index(keys, **options)
+        except OperationFailure as e:
+            if not is_ttl_conflict(e, expire_after_seconds):
+                raise ConnectionError('Could not create index in MongoDB. Reason:', str(e))
+            self.db.command('collMod', self.collection.name, index=ttl_index_change(keys, expire_after_seconds))
+        except Exception as e:
+            raise ConnectionError('Could not create index in MongoDB. Reason:', str(e))
+
+    def close(self):
+        if self.owns_client:
+            self.db_client.close()
+
+
+def create_write_request(operation: DbWriteOperation):
+    if operation.operation_type == DbOperationType.REPLACE:
+        return ReplaceOne(operation.query, operation.data, upsert=True)
+    if operation.operation_type == DbOperationType.REMOVE:
+        return DeleteMany(operation.query)
+    return UpdateOne(operation.query, {"$set": operation.data},
+                     upsert=operation.operation_type == DbOperationType.UPSERT)
+
+
+def bulk_write_succeeded(operations_count: int, error: BulkWriteError) -> List[bool]:
+    """
+    Returns for every operation of the failed batch whether it succeeded, only duplicate key errors are expected
+    """
+    succeeded = [True] * operations_count
+    for write_error in error.details.get('writeErrors', []):
+        if write_error.get('code') != DUPLICATE_KEY_ERROR:
+            raise ConnectionError('Could not bulk write to MongoDB. Reason:', str(error))
+        succeeded[write_error['index']] = False
+
+    return succeeded
+
+
+def index_options(fields: List[str], unique: bool = False, expire_after_seconds: int = None,
+                  partial_filter: dict = None) -> Tuple[List[Tuple[str, int]], dict]:
+    keys = [(field, ASCENDING) for field in fields]
+    options = {"unique": unique}
+    if expire_after_seconds is not None:
+        options["expireAfterSeconds"] = expire_after_seconds
+    if partial_filter:
+        options["partialFilterExpression"] = partial_filter
+
+    return keys, options
+
+
+def is_ttl_conflict(error: OperationFailure, expire_after_seconds: int = None) -> bool:
+    """
+    Returns whether the index exists with another TTL, which is changed in place instead of failing
+    """
+    return error.code == INDEX_OPTIONS_CONFLICT and expire_after_seconds is not None
+
+
+def ttl_index_change(keys: List[Tuple[str, int]], expire_after_seconds: int) -> dict:
+    return {"keyPattern": dict(keys), "expireAfterSeconds": expire_after_seconds}
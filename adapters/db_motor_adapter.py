@@ -0,0 +1,110 @@
+from typing import List
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError, OperationFailure, BulkWriteError
+
+from adapters.db_base_adapter import BaseAsyncDbAdapter, DbWriteOperation
+from adapters.db_mongo_adapter import create_write_request, bulk_write_succeeded, index_options, is_ttl_conflict, \
+    ttl_index_change
+
+
+class MotorDbAdapter(BaseAsyncDbAdapter):
+    """
+    MongoDB adapter for asyncio applications, the client is bound to the event loop it is first used in
+    """
+
+    def __init__(self, db_name: str, series_name: str, username: str = None, password: str = None,
+                 host: str = '127.0.0.1', port: int = 27017, db_client: AsyncIOMotorClient = None):
+        # a client passed by DbAdapterRegistry is shared with other adapters and is closed by the registry
+        self.owns_client = db_client is None
+        try:
+            if db_client is None:
+                db_client = AsyncIOMotorClient(host=host, port=port, username=username, password=password)
+            self.db_client = db_client
+            self.db = self.db_client[db_name]
+            self.collection = self.db[series_name]
+        except Exception as e:
+            raise ConnectionError('Could not connect to MongoDB. Reason:', str(e))
+
+    async def save(self, data: dict):
+        try:
+            return str((await self.collection.insert_one(data)).inserted_id)
+        except Exception as e:
+            raise ConnectionError('Could not insert to MongoDB. Reason:', str(e))
+
+    async def select(self, query: dict, multiple: bool = False, projection: dict = None):
+        try:
+            if multiple:
+                return await self.collection.find(query, projection).to_list(length=None)
+            else:
+                return await self.collection.find_one(query, projection)
+        except Exception as e:
+            raise ConnectionError('Could not select from MongoDB. Reason:', str(e))
+
+    async def update(self, old_data: dict, new_data: dict):
+        try:
+            await self.collection.update_one(old_data, {"$set": new_data})
+        except Exception as e:
+            raise ConnectionError('Could not update in MongoDB. Reason:', str(e))
+
+    async def remove(self, old_data: dict):
+        try:
+            await self.collection.delete_many(old_data)
+        except Exception as e:
+            raise ConnectionError('Could not remove in MongoDB. Reason:', str(e))
+
+    async def upsert(self, query: dict, new_data: dict) -> bool:
+        """
+        Updates document matching the query or inserts it, returns False when the insert conflicts with existing one
+        """
+        try:
+            await self.collection.update_one(query, {"$set": new_data}, upsert=True)
+            return True
+        except DuplicateKeyError:
+            return False
+        except Exception as e:
+            raise ConnectionError('Could not upsert in MongoDB. Reason:', str(e))
+
+    async def replace(self, query: dict, data: dict, upsert: bool = True):
+        try:
+            await self.collection.replace_one(query, data, upsert=upsert)
+        except Exception as e:
+            raise ConnectionError('Could not replace in MongoDB. Reason:', str(e))
+
+    async def bulk_write(self, operations: List[DbWriteOperation]) -> List[bool]:
+        """
+        Sends the operations in one unordered batch, returns for every operation whether it succeeded,
+        upserts conflicting with existing documents fail without failing the others
+        """
+        if not operations:
+            return []
+        try:
+            await self.collection.bulk_write([create_write_request(operation) for operation in operations],
+                                              ordered=False)
+        except BulkWriteError as e:
+            return bulk_write_succeeded(len(operations), e)
+        except Exception as e:
+            raise ConnectionError('Could not bulk write to MongoDB. Reason:', str(e))
+
+        return [True] * len(operations)
+
+    async def ensure_index(self, fields: List[str], unique: bool = False, expire_after_seconds: int = None,
+                           partial_filter: dict = None):
+        """
+        Creates ascending index on the fields, expire_after_seconds makes it a TTL index removing documents
+        that many seconds after the date in the field, changed TTL of existing index is updated in place
+        """
+        keys, options = index_options(fields, unique, expire_after_seconds, partial_filter)
+        try:
+            await self.collection.create_index(keys, **options)
+        except OperationFailure as e:
+            if not is_ttl_conflict(e, expire_after_seconds):
+                raise ConnectionError('Could not create index in MongoDB. Reason:', str(e))
+            await self.db.command('collMod', self.collection.name,
+                                  index=ttl_index_change(keys, expire_after_seconds))
+        except Exception as e:
+            raise ConnectionError('Could not create index in MongoDB. Reason:', str(e))
+
+    def close(self):
+        if self.owns_client:
+            self.db_client.close()
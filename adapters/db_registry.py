@@ -0,0 +1,143 @@
+import os
+import threading
+
+from dataclasses import dataclass
+from typing import Dict, Union
+
+from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from adapters.db_base_adapter import BaseDbAdapter, BaseAsyncDbAdapter
+from adapters.db_mongo_adapter import MongoDbAdapter
+from adapters.db_motor_adapter import MotorDbAdapter
+from adapters.db_sqlite_adapter import SqliteDbAdapter, SqliteAsyncDbAdapter
+
+
+@dataclass
+class MongoClientSettings:
+    host: str = '127.0.0.1'
+    port: int = 27017
+    username: str = None
+    password: str = None
+    max_pool_size: int = 100
+    min_pool_size: int = 0
+    max_idle_time_ms: int = None
+    wait_queue_timeout_ms: int = None
+    connect_timeout_ms: int = 5000
+    server_selection_timeout_ms: int = 10000
+    socket_timeout_ms: int = None
+    # primary, primaryPreferred, secondary, secondaryPreferred or nearest
+    read_preference: str = 'primary'
+
+    @staticmethod
+    def from_env() -> 'MongoClientSettings':
+        def optional_int(name: str, default: int = None) -> int:
+            value = os.environ.get(name)
+            return int(value) if value else default
+
+        return MongoClientSettings(host=os.environ.get('MONGODB_HOST', '127.0.0.1'),
+                                   port=optional_int('MONGODB_PORT', 27017),
+                                   username=os.environ.get('MONGODB_USER', 'mongodbuser'),
+                                   password=os.environ.get('MONGODB_PASSWORD', 'your_mongodb_root_password'),
+                                   max_pool_size=optional_int('MONGODB_POOL_SIZE', 100),
+                                   min_pool_size=optional_int('MONGODB_MIN_POOL_SIZE', 0),
+                                   max_idle_time_ms=optional_int('MONGODB_MAX_IDLE_TIME_MS'),
+                                   wait_queue_timeout_ms=optional_int('MONGODB_WAIT_QUEUE_TIMEOUT_MS'),
+                                   connect_timeout_ms=optional_int('MONGODB_CONNECT_TIMEOUT_MS', 5000),
+                                   server_selection_timeout_ms=optional_int('MONGODB_SERVER_SELECTION_TIMEOUT_MS',
+                                                                            10000),
+                                   socket_timeout_ms=optional_int('MONGODB_SOCKET_TIMEOUT_MS'),
+                                   read_preference=os.environ.get('MONGODB_READ_PREFERENCE', 'primary'))
+
+    def client_options(self) -> dict:
+        options = {"host": self.host, "port": self.port, "username": self.username, "password": self.password,
+                   "maxPoolSize": self.max_pool_size, "minPoolSize": self.min_pool_size,
+                   "maxIdleTimeMS": self.max_idle_time_ms, "waitQueueTimeoutMS": self.wait_queue_timeout_ms,
+                   "connectTimeoutMS": self.connect_timeout_ms,
+                   "serverSelectionTimeoutMS": self.server_selection_timeout_ms,
+                   "socketTimeoutMS": self.socket_timeout_ms, "readPreference": self.read_preference}
+        return {name: value for name, value in options.items() if value is not None}
+
+
+class DbAdapterRegistry:
+    """
+    Application scoped database adapters: adapters of all the collections share one pooled client,
+    which is opened on application startup and closed on shutdown.
+    With sqlite_path the collections are tables of an embedded SQLite database instead of MongoDB
+    """
+
+    def __init__(self, settings: MongoClientSettings = None, db_name: str = 'road_trip', asynchronous: bool = False,
+                 sqlite_path: str = None):
+        self.settings = settings or MongoClientSettings()
+        self.db_name = db_name
+        # asynchronous registries create motor clients, they have to be opened in the event loop using them
+        self.asynchronous = asynchronous
+        self.sqlite_path = sqlite_path
+        self.db_client = None
+        self.__adapters: Dict[tuple, Union[BaseDbAdapter, BaseAsyncDbAdapter]] = {}
+        self.__lock = threading.Lock()
+
+    def open(self):
+        with self.__lock:
+            self.__open()
+
+    def get(self, series_name: str, db_name: str = None) -> Union[BaseDbAdapter, BaseAsyncDbAdapter]:
+        with self.__lock:
+            return self.__get((db_name or self.db_name, series_name))
+
+    def get_blocking(self, series_name: str, db_name: str = None) -> BaseDbAdapter:
+        """
+        Returns blocking adapter of the collection sharing the client of the registry, for the worker threads
+        of asynchronous applications
+        """
+        key = (db_name or self.db_name, series_name)
+        with self.__lock:
+            if not self.asynchronous:
+                return self.__get(key)
+            adapter = self.__adapters.get(('blocking',) + key)
+            if adapter is None:
+                if self.sqlite_path:
+                    # the blocking adapter wrapped by the async one, so they see the same indexes
+                    adapter = self.__get(key).db_adapter
+                else:
+                    self.__open()
+                    # motor clients run their operations on a pymongo client
+                    adapter = MongoDbAdapter(key[0], series_name, db_client=self.db_client.delegate)
+                self.__adapters[('blocking',) + key] = adapter
+            return adapter
+
+    def close(self):
+        with self.__lock:
+            db_client, self.db_client = self.db_client, None
+            adapters = list(self.__adapters.values())
+            self.__adapters.clear()
+        if db_client is not None:
+            db_client.close()
+        if self.sqlite_path:
+            for adapter in adapters:
+                adapter.close()
+
+    def __get(self, key: tuple) -> Union[BaseDbAdapter, BaseAsyncDbAdapter]:
+        adapter = self.__adapters.get(key)
+        if adapter is None:
+            self.__open()
+            if self.sqlite_path:
+                adapter_class = SqliteAsyncDbAdapter if self.asynchronous else SqliteDbAdapter
+                adapter = adapter_class(self.sqlite_path, '{}.{}'.format(*key))
+            elif self.asynchronous:
+                adapter = MotorDbAdapter(key[0], key[1], db_client=self.db_client)
+            else:
+                adapter = MongoDbAdapter(key[0], key[1], db_client=self.db_client)
+            self.__adapters[key] = adapter
+        return adapter
+
+    def __open(self):
+        if self.db_client is not None or self.sqlite_path:
+            return
+        try:
+            if self.asynchronous:
+                self.db_client = AsyncIOMotorClient(**self.settings.client_options())
+            else:
+                self.db_client = MongoClient(**self.settings.client_options())
+        except Exception as e:
+            raise ConnectionError('Could not connect to MongoDB. Reason:', str(e))
@@ -0,0 +1,398 @@
+import time
+import sqlite3
+import asyncio
+import threading
+import bson
+
+from bson import ObjectId
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import partial
+from typing import List, Dict, Tuple, Optional, Iterator, Any
+
+from adapters.db_base_adapter import BaseDbAdapter, BaseAsyncDbAdapter, DbWriteOperation, DbOperationType
+from adapters.documents import MISSING, get_field, set_fields, is_operators, match_document, query_equalities, \
+    project_document
+
+# expired documents are purged by writes at most that often, like the TTL monitor of MongoDB does
+EXPIRED_PURGE_INTERVAL_SECONDS = 60
+# values of one IN (...) lookup, SQLite limits the number of query parameters
+LOOKUP_BATCH_SIZE = 500
+
+
+class SqliteDbAdapter(BaseDbAdapter):
+    """
+    Embedded adapter keeping BSON documents in a SQLite database file, so a single node runs without MongoDB.
+    WAL journal lets readers work while a write is in progress, large cached blobs are read through
+    the memory mapped database file. Documents are looked up by _id and indexed fields, other queries
+    scan the collection
+    """
+
+    def __init__(self, path: str, series_name: str, mmap_size: int = 256 * 1024 * 1024,
+                 busy_timeout_ms: int = 5000):
+        self.path = path
+        self.series_name = series_name
+        self.mmap_size = mmap_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.__table = quote_identifier(series_name)
+        self.__fields_table = quote_identifier(series_name + '_fields')
+        self.__indexes_table = quote_identifier(series_name + '_indexes')
+        self.__local = threading.local()
+        self.__connections = []
+        self.__lock = threading.Lock()
+        self.__purged_at = 0.0
+        try:
+            connection = self.__connection()
+            with connection:
+                connection.execute(f'CREATE TABLE IF NOT EXISTS {self.__table} '
+                                   f'(id BLOB PRIMARY KEY, document BLOB NOT NULL, expires_at REAL)')
+                connection.execute(f'CREATE INDEX IF NOT EXISTS {quote_identifier(series_name + "_expires_at")} '
+                                   f'ON {self.__table} (expires_at)')
+                # values of the indexed fields, documents are found by them without decoding the whole collection
+                connection.execute(f'CREATE TABLE IF NOT EXISTS {self.__fields_table} '
+                                   f'(id BLOB NOT NULL, name TEXT NOT NULL, value BLOB NOT NULL)')
+                connection.execute(f'CREATE INDEX IF NOT EXISTS {quote_identifier(series_name + "_fields_value")} '
+                                   f'ON {self.__fields_table} (name, value)')
+                connection.execute(f'CREATE INDEX IF NOT EXISTS {quote_identifier(series_name + "_fields_id")} '
+                                   f'ON {self.__fields_table} (id)')
+                connection.execute(f'CREATE TABLE IF NOT EXISTS {self.__indexes_table} '
+                                   f'(name TEXT PRIMARY KEY, is_unique INTEGER NOT NULL, expire_after_seconds REAL)')
+                self.__indexes: Dict[str, Tuple[bool, Optional[float]]] = {
+                    name: (bool(is_unique), expire_after_seconds) for name, is_unique, expire_after_seconds
+                    in connection.execute(f'SELECT name, is_unique, expire_after_seconds FROM {self.__indexes_table}')
+                }
+        except sqlite3.Error as e:
+            raise ConnectionError('Could not open SQLite database. Reason:', str(e))
+
+    def save(self, data: dict):
+        document = dict(data)
+        document.setdefault("_id", ObjectId())
+        try:
+            with self.__transaction() as connection:
+                self.__insert(connection, document)
+            return str(document["_id"])
+        except sqlite3.Error as e:
+            raise ConnectionError('Could not insert to SQLite. Reason:', str(e))
+
+    def select(self, query: dict, multiple: bool = False, projection: dict = None):
+        try:
+            documents = [project_document(document, projection) for _, document
+                         in self.__find(self.__connection(), query, limit=None if multiple else 1)]
+        except sqlite3.Error as e:
+            raise ConnectionError('Could not select from SQLite. Reason:', str(e))
+        if multiple:
+            return documents
+        return documents[0] if documents else None
+
+    def update(self, old_data: dict, new_data: dict):
+        try:
+            with self.__transaction() as connection:
+                self.__update(connection, old_data, new_data, upsert=False)
+        except sqlite3.Error as e:
+            raise ConnectionError('Could not update in SQLite. Reason:', str(e))
+
+    def remove(self, old_data: dict):
+        try:
+            with self.__transaction() as connection:
+                self.__remove(connection, old_data)
+        except sqlite3.Error as e:
+            raise ConnectionError('Could not remove in SQLite. Reason:', str(e))
+
+    def upsert(self, query: dict, new_data: dict) -> bool:
+        """
+        Updates document matching the query or inserts it, returns False when the insert conflicts with existing one
+        """
+        try:
+            with self.__transaction() as connection:
+                self.__update(connection, query, new_data, upsert=True)
+            return True
+        except sqlite3.IntegrityError:
+            return False
+        except sqlite3.Error as e:
+            raise ConnectionError('Could not upsert in SQLite. Reason:', str(e))
+
+    def replace(self, query: dict, data: dict, upsert: bool = True):
+        try:
+            with self.__transaction() as connection:
+                self.__replace(connection, query, data, upsert)
+        except sqlite3.Error as e:
+            raise ConnectionError('Could not replace in SQLite. Reason:', str(e))
+
+    def bulk_write(self, operations: List[DbWriteOperation]) -> List[bool]:
+        """
+        Writes the operations in one transaction, returns for every operation whether it succeeded,
+        upserts conflicting with existing documents fail without failing the others
+        """
+        succeeded = []
+        try:
+            with self.__transaction() as connection:
+                for operation in operations:
+                    connection.execute('SAVEPOINT operation')
+                    try:
+                        self.__write_operation(connection, operation)
+                        succeeded.append(True)
+                    except sqlite3.IntegrityError:
+                        connection.execute('ROLLBACK TO operation')
+                        succeeded.append(False)
+                    connection.execute('RELEASE operation')
+        except sqlite3.Error as e:
+            raise ConnectionError('Could not bulk write to SQLite. Reason:', str(e))
+
+        return succeeded
+
+    def ensure_index(self, fields: List[str], unique: bool = False, expire_after_seconds: int = None,
+                     partial_filter: dict = None):
+        """
+        Indexes every field separately, unique is enforced for single field indexes only. Documents without
+        the field are never indexed, so partial filters are not needed for lookups
+        """
+        options = (unique and len(fields) == 1, expire_after_seconds)
+        try:
+            with self.__transaction() as connection:
+                changed_fields = [field for field in fields if self.__indexes.get(field) != options]
+                if not changed_fields:
+                    return
+                for field in changed_fields:
+                    connection.execute(f'INSERT OR REPLACE INTO {self.__indexes_table} '
+                                       f'(name, is_unique, expire_after_seconds) VALUES (?, ?, ?)',
+                                       (field, int(options[0]), expire_after_seconds))
+                    self.__indexes[field] = options
+                # existing documents are indexed and their expiry is updated
+                for id_key, data in connection.execute(f'SELECT id, document FROM {self.__table}').fetchall():
+                    self.__write(connection, id_key, bson.decode(data))
+        except sqlite3.Error as e:
+            raise ConnectionError('Could not create index in SQLite. Reason:', str(e))
+
+    def close(self):
+        with self.__lock:
+            connections, self.__connections = self.__connections, []
+            self.__local = threading.local()
+        for connection in connections:
+            connection.close()
+
+    def __connection(self) -> sqlite3.Connection:
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            # transactions are started explicitly, every thread uses its own connection
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+            connection.execute(f'PRAGMA busy_timeout={int(self.busy_timeout_ms)}')
+            self.__local.connection = connection
+            with self.__lock:
+                self.__connections.append(connection)
+
+        return connection
+
+    @contextmanager
+    def __transaction(self) -> Iterator[sqlite3.Connection]:
+        connection = self.__connection()
+        # the write lock is taken at the start, so read-modify-write of concurrent processes does not interleave
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.__purge_expired(connection)
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def __find(self, connection: sqlite3.Connection, query: dict, limit: int = None) -> List[Tuple[bytes, dict]]:
+        documents = []
+        for sql, parameters in self.__candidates_queries(query):
+            for id_key, data in connection.execute(sql, parameters):
+                document = bson.decode(data)
+                if match_document(document, query):
+                    documents.append((id_key, document))
+                    if limit and len(documents) >= limit:
+                        return documents
+
+        return documents
+
+    def __candidates_queries(self, query: dict) -> Iterator[Tuple[str, list]]:
+        not_expired = '(expires_at IS NULL OR expires_at > ?)'
+        now = time.time()
+        if '_id' in query:
+            values = lookup_values(query['_id'])
+            if values is not None:
+                for batch_start in range(0, len(values), LOOKUP_BATCH_SIZE):
+                    keys = [encode_key(value) for value in values[batch_start:batch_start + LOOKUP_BATCH_SIZE]]
+                    yield (f'SELECT id, document FROM {self.__table} '
+                           f'WHERE {not_expired} AND id IN ({", ".join("?" * len(keys))})', [now, *keys])
+                return
+
+        for name, condition in query.items():
+            values = lookup_values(condition) if name in self.__indexes else None
+            if values is not None:
+                for batch_start in range(0, len(values), LOOKUP_BATCH_SIZE):
+                    keys = [encode_key(value) for value in values[batch_start:batch_start + LOOKUP_BATCH_SIZE]]
+                    yield (f'SELECT id, document FROM {self.__table} WHERE {not_expired} AND id IN '
+                           f'(SELECT id FROM {self.__fields_table} WHERE name = ? '
+                           f'AND value IN ({", ".join("?" * len(keys))}))', [now, name, *keys])
+                return
+
+        yield f'SELECT id, document FROM {self.__table} WHERE {not_expired}', [now]
+
+    def __write_operation(self, connection: sqlite3.Connection, operation: DbWriteOperation):
+        if operation.operation_type == DbOperationType.REPLACE:
+            self.__replace(connection, operation.query, operation.data, upsert=True)
+        elif operation.operation_type == DbOperationType.REMOVE:
+            self.__remove(connection, operation.query)
+        else:
+            self.__update(connection, operation.query, operation.data,
+                          upsert=operation.operation_type == DbOperationType.UPSERT)
+
+    def __update(self, connection: sqlite3.Connection, query: dict, fields: dict, upsert: bool):
+        found = self.__find(connection, query, limit=1)
+        if found:
+            id_key, document = found[0]
+            set_fields(document, fields)
+            self.__write(connection, id_key, document)
+        elif upsert:
+            document = {}
+            set_fields(document, query_equalities(query))
+            set_fields(document, fields)
+            document.setdefault("_id", ObjectId())
+            self.__insert(connection, document)
+
+    def __replace(self, connection: sqlite3.Connection, query: dict, data: dict, upsert: bool):
+        found = self.__find(connection, query, limit=1)
+        document = dict(data)
+        if found:
+            id_key, found_document = found[0]
+            if document.setdefault("_id", found_document["_id"]) != found_document["_id"]:
+                raise sqlite3.IntegrityError('The _id of the replaced document can not be changed')
+            self.__write(connection, id_key, document)
+        elif upsert:
+            if "_id" not in document:
+                document["_id"] = query_equalities(query).get("_id", ObjectId())
+            self.__insert(connection, document)
+
+    def __remove(self, connection: sqlite3.Connection, query: dict):
+        for id_key, _ in self.__find(connection, query):
+            self.__delete(connection, id_key)
+
+    def __insert(self, connection: sqlite3.Connection, document: dict):
+        id_key = encode_key(document["_id"])
+        # an expired document which is not purged yet must not conflict with the new one
+        connection.execute(f'DELETE FROM {self.__fields_table} WHERE id IN '
+                           f'(SELECT id FROM {self.__table} WHERE id = ? AND expires_at <= ?)', (id_key, time.time()))
+        connection.execute(f'DELETE FROM {self.__table} WHERE id = ? AND expires_at <= ?', (id_key, time.time()))
+        self.__check_unique_fields(connection, id_key, document)
+        connection.execute(f'INSERT INTO {self.__table} (id, document, expires_at) VALUES (?, ?, ?)',
+                           (id_key, bson.encode(document), self.__expires_at(document)))
+        self.__index_fields(connection, id_key, document)
+
+    def __write(self, connection: sqlite3.Connection, id_key: bytes, document: dict):
+        self.__check_unique_fields(connection, id_key, document)
+        connection.execute(f'UPDATE {self.__table} SET document = ?, expires_at = ? WHERE id = ?',
+                           (bson.encode(document), self.__expires_at(document), id_key))
+        self.__index_fields(connection, id_key, document)
+
+    def __delete(self, connection: sqlite3.Connection, id_key: bytes):
+        connection.execute(f'DELETE FROM {self.__fields_table} WHERE id = ?', (id_key,))
+        connection.execute(f'DELETE FROM {self.__table} WHERE id = ?', (id_key,))
+
+    def __check_unique_fields(self, connection: sqlite3.Connection, id_key: bytes, document: dict):
+        for name, (unique, _) in self.__indexes.items():
+            value = get_field(document, name)
+            if not unique or value is MISSING:
+                continue
+            if connection.execute(f'SELECT 1 FROM {self.__fields_table} WHERE name = ? AND value = ? AND id != ? '
+                                  f'LIMIT 1', (name, encode_key(value), id_key)).fetchone():
+                raise sqlite3.IntegrityError('Duplicate key {} for unique field {}'.format(value, name))
+
+    def __index_fields(self, connection: sqlite3.Connection, id_key: bytes, document: dict):
+        connection.execute(f'DELETE FROM {self.__fields_table} WHERE id = ?', (id_key,))
+        values = [(name, get_field(document, name)) for name in self.__indexes]
+        connection.executemany(f'INSERT INTO {self.__fields_table} (id, name, value) VALUES (?, ?, ?)',
+                               [(id_key, name, encode_key(value)) for name, value in values if value is not MISSING])
+
+    def __expires_at(self, document: dict) -> Optional[float]:
+        expires_at = None
+        for name, (_, expire_after_seconds) in self.__indexes.items():
+            value = get_field(document, name)
+            if expire_after_seconds is None or not isinstance(value, datetime):
+                continue
+            if value.tzinfo is None:
+                # naive dates are UTC, like in BSON
+                value = value.replace(tzinfo=timezone.utc)
+            field_expires_at = value.timestamp() + expire_after_seconds
+            expires_at = field_expires_at if expires_at is None else min(expires_at, field_expires_at)
+
+        return expires_at
+
+    def __purge_expired(self, connection: sqlite3.Connection):
+        now = time.time()
+        if now - self.__purged_at < EXPIRED_PURGE_INTERVAL_SECONDS:
+            return
+        self.__purged_at = now
+        connection.execute(f'DELETE FROM {self.__fields_table} WHERE id IN '
+                           f'(SELECT id FROM {self.__table} WHERE expires_at <= ?)', (now,))
+        connection.execute(f'DELETE FROM {self.__table} WHERE expires_at <= ?', (now,))
+
+
+class SqliteAsyncDbAdapter(BaseAsyncDbAdapter):
+    """
+    SqliteDbAdapter for asyncio applications, the calls run in the default executor of the event loop
+    """
+
+    def __init__(self, path: str, series_name: str, **kwargs):
+        self.db_adapter = SqliteDbAdapter(path, series_name, **kwargs)
+
+    async def save(self, data: dict) -> str:
+        return await self.__run(self.db_adapter.save, data)
+
+    async def select(self, query: dict, multiple: bool = False, projection: dict = None):
+        return await self.__run(self.db_adapter.select, query, multiple, projection)
+
+    async def update(self, old_data: dict, new_data: dict):
+        await self.__run(self.db_adapter.update, old_data, new_data)
+
+    async def remove(self, old_data: dict):
+        await self.__run(self.db_adapter.remove, old_data)
+
+    async def upsert(self, query: dict, new_data: dict) -> bool:
+        return await self.__run(self.db_adapter.upsert, query, new_data)
+
+    async def replace(self, query: dict, data: dict, upsert: bool = True):
+        await self.__run(self.db_adapter.replace, query, data, upsert)
+
+    async def bulk_write(self, operations: List[DbWriteOperation]) -> List[bool]:
+        return await self.__run(self.db_adapter.bulk_write, operations)
+
+    async def ensure_index(self, fields: List[str], unique: bool = False, expire_after_seconds: int = None,
+                           partial_filter: dict = None):
+        await self.__run(self.db_adapter.ensure_index, fields, unique, expire_after_seconds, partial_filter)
+
+    def close(self):
+        self.db_adapter.close()
+
+    @staticmethod
+    async def __run(function, *args) -> Any:
+        return await asyncio.get_event_loop().run_in_executor(None, partial(function, *args))
+
+
+def quote_identifier(name: str) -> str:
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def encode_key(value: Any) -> bytes:
+    # BSON of the value, so equal values of the same type have equal keys
+    return bson.encode({"v": value})
+
+
+def lookup_values(condition: Any) -> Optional[list]:
+    """
+    Returns values the field is looked up by, or None when the condition can not be answered by a lookup
+    """
+    if is_operators(condition):
+        values = list(condition["$in"]) if list(condition) == ["$in"] else None
+    else:
+        values = [condition]
+    # missing fields match None, they are not indexed
+    if values is None or any(value is None for value in values):
+        return None
+    return values
@@ -0,0 +1,96 @@
+from typing import Any
+
+# value of a field which is not in the document
+MISSING = object()
+
+
+def get_field(document: dict, path: str) -> Any:
+    value = document
+    for name in path.split('.'):
+        if not isinstance(value, dict) or name not in value:
+            return MISSING
+        value = value[name]
+
+    return value
+
+
+def set_fields(document: dict, fields: dict):
+    """
+    Sets fields like MongoDB $set does, dotted paths create missing embedded documents
+    """
+    for path, value in fields.items():
+        names = path.split('.')
+        embedded = document
+        for name in names[:-1]:
+            embedded = embedded.setdefault(name, {})
+        embedded[names[-1]] = value
+
+
+def is_operators(condition: Any) -> bool:
+    return isinstance(condition, dict) and len(condition) > 0 and all(name.startswith('$') for name in condition)
+
+
+def match_document(document: dict, query: dict) -> bool:
+    """
+    Matches the document with a MongoDB query of field equalities and comparison operators
+    """
+    for path, condition in query.items():
+        value = get_field(document, path)
+        if not is_operators(condition):
+            if value is MISSING:
+                if condition is not None:
+                    return False
+            elif value != condition:
+                return False
+            continue
+        for operator, operand in condition.items():
+            if not match_operator(value, operator, operand):
+                return False
+
+    return True
+
+
+def match_operator(value: Any, operator: str, operand: Any) -> bool:
+    if operator == '$exists':
+        return (value is not MISSING) == bool(operand)
+    if operator == '$in':
+        return value is not MISSING and value in operand
+    if operator == '$nin':
+        return value is MISSING or value not in operand
+    if operator == '$ne':
+        return value is MISSING or value != operand
+    if operator not in ('$lt', '$lte', '$gt', '$gte'):
+        raise ValueError('Unsupported query operator {}'.format(operator))
+    if value is MISSING:
+        return False
+    try:
+        if operator == '$lt':
+            return value < operand
+        if operator == '$lte':
+            return value <= operand
+        if operator == '$gt':
+            return value > operand
+        return value >= operand
+    except TypeError:
+        # values of different types are not compared, like in MongoDB
+        return False
+
+
+def query_equalities(query: dict) -> dict:
+    """
+    Returns fields of the query compared by equality, an upsert inserts them into the new document
+    """
+    return {path: condition for path, condition in query.items() if not is_operators(condition)}
+
+
+def project_document(document: dict, projection: dict = None) -> dict:
+    """
+    Applies projection of top level fields to a document, like the database does
+    """
+    if not projection:
+        return dict(document)
+    included = [name for name, value in projection.items() if value and name != "_id"]
+    if included:
+        return {name: value for name, value in document.items()
+                if name in included or (name == "_id" and projection.get("_id", 1))}
+    return {name: value for name, value in document.items() if name not in projection}
@@ -1,14 +1,23 @@
 import os
+import asyncio
 import logging
 import uvicorn
 from uuid import uuid4
 
-from fastapi import FastAPI, Depends, BackgroundTasks
+from functools import partial
+from dataclasses import asdict
+from fastapi import FastAPI, Depends, BackgroundTasks, Request, Header, HTTPException
+from fastapi.responses import StreamingResponse
+from telegram import Bot
+from telegram.error import TelegramError
 
-from adapters.db_mongo_adapter import MongoDbAdapter
-from providers import CacheProvider, OverpassProvider
-from dto import SearchConfigModel
+from adapters.db_registry import DbAdapterRegistry, MongoClientSettings
+from providers import AsyncCacheProvider, CacheProvider, OverpassProvider, LocalExtractProvider, MemoryCache, \
+    SpatialIndexCache
+from dto import SearchConfigModel, BatchSearchConfigModel
 from base_algo import BasicAlgorithm
+from api.telegram_webhook import TelegramWebhook
+from api.search_jobs import SearchJobs
 
 app = FastAPI()
 
@@ -17,39 +26,190 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def get_cache_provider() -> CacheProvider:
-    return CacheProvider(MongoDbAdapter(host=os.environ.get('MONGODB_HOST', '127.0.0.1'),
-                                        db_name=os.environ.get('MONGODB_DATABASE', 'road_trip'),
-                                        series_name=os.environ.get('MONGODB_SERIES', 'user_search'),
-                                        username=os.environ.get('MONGODB_USER', 'mongodbuser'),
-                                        password=os.environ.get('MONGODB_PASSWORD',
-                                                                'your_mongodb_root_password')))
+maps_provider = OverpassProvider(os.environ.get('OSM_URL', 'https://overpass-api.de/api/interpreter'),
+                                 pool_size=int(os.environ.get('OSM_POOL_SIZE', 10)))
+# areas of a preprocessed regional extract are answered locally, other areas are still requested from Overpass
+if os.environ.get('OSM_EXTRACT_PATH'):
+    maps_provider = LocalExtractProvider(os.environ['OSM_EXTRACT_PATH'], fallback=maps_provider)
+# SQLITE_PATH makes a single node deployment use an embedded database instead of MongoDB
+db_registry = DbAdapterRegistry(MongoClientSettings.from_env(), db_name=os.environ.get('MONGODB_DATABASE', 'road_trip'),
+                                asynchronous=True, sqlite_path=os.environ.get('SQLITE_PATH'))
+# only tiles and datasets are kept in memory, searches are polled from any worker while the search is running
+memory_cache = MemoryCache(max_bytes=int(os.environ.get('MEMORY_CACHE_MB', 256)) * 1024 ** 2)
+# merged datasets of recent searches share the memory budget of the cached tiles
+BasicAlgorithm.spatial_index_cache = SpatialIndexCache(memory_cache)
+# user searches are read from memory for this long, 0 keeps them in the database only, which every worker sees
+user_search_cache_seconds = float(os.environ.get('USER_SEARCH_CACHE_SECONDS', 0))
+# route pools of the most searched tiles are precomputed in the background at this interval, 0 disables them
+route_pools_interval_seconds = float(os.environ.get('ROUTE_POOLS_INTERVAL_SECONDS', 300))
+# tiles requested by a search are leased in the database, so other workers wait for them, 0 disables leases
+tiles_lease_seconds = float(os.environ.get('TILES_LEASE_SECONDS', 60))
+# searches running in this process, GET requests wait for them instead of polling the database
+search_jobs = SearchJobs()
+# longest wait of a long polling GET request, events streams are closed after SEARCH_EVENTS_TIMEOUT_SECONDS
+long_poll_max_seconds = float(os.environ.get('LONG_POLL_MAX_SECONDS', 60))
+search_events_timeout_seconds = float(os.environ.get('SEARCH_EVENTS_TIMEOUT_SECONDS', 300))
+# routes of a batch request are generated in the request, over nodes and ways fetched once
+batch_routes_max_count = int(os.environ.get('BATCH_ROUTES_MAX_COUNT', 50))
+# the bot receives updates through this app instead of polling when the webhook url is set
+telegram_webhook_url = os.environ.get('TELEGRAM_WEBHOOK_URL')
+telegram_webhook_secret = os.environ.get('TELEGRAM_WEBHOOK_SECRET')
+telegram_webhook = None
+
+
+@app.on_event("startup")
+async def open_db_registry():
+    db_registry.open()
+    try:
+        await get_cache_provider().ensure_indexes()
+    except ConnectionError as e:
+        logger.error(str(e))
+    # searches of the bot are counted for the route pools precomputed by this task
+    if route_pools_interval_seconds:
+        app.state.route_pools_task = asyncio.create_task(precompute_route_pools())
+    if telegram_webhook_url:
+        start_telegram_webhook()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, partial(
+                telegram_webhook.dispatcher.bot.set_webhook, url=telegram_webhook_url,
+                secret_token=telegram_webhook_secret))
+        except TelegramError as e:
+            logger.error(str(e))
+
+
+@app.on_event("shutdown")
+async def close_maps_provider():
+    if getattr(app.state, 'route_pools_task', None):
+        app.state.route_pools_task.cancel()
+    if telegram_webhook:
+        await telegram_webhook.stop()
+        # running route jobs are waited for, they edit the messages of their users
+        await asyncio.get_running_loop().run_in_executor(
+            None, telegram_webhook.dispatcher.bot_data['bot_context'].close)
+    await maps_provider.close_async()
+    maps_provider.close()
+    db_registry.close()
+
+
+async def precompute_route_pools():
+    while True:
+        await asyncio.sleep(route_pools_interval_seconds)
+        try:
+            built_count = await BasicAlgorithm(maps_provider, async_cache_provider=get_cache_provider(),
+                                               tiles_lease_seconds=tiles_lease_seconds).precompute_route_pools_async()
+            if built_count:
+                logger.info('%s route pools precomputed', built_count)
+        except Exception as e:
+            logger.error(str(e))
+
+
+def start_telegram_webhook():
+    """
+    Starts the bot on the providers of the app, its handlers run in worker threads, so they use the blocking
+    adapter of the database client opened by the app
+    """
+    import telegram_bot
+
+    global telegram_webhook
+    cache_provider = CacheProvider(db_registry.get_blocking(os.environ.get('MONGODB_SERIES', 'user_search')),
+                                   memory_cache=memory_cache, user_search_ttl_seconds=user_search_cache_seconds)
+    telegram_dispatcher = telegram_bot.create_webhook_dispatcher(Bot(os.environ.get('TELEGRAM_API_TOKEN')),
+                                                                 cache_provider, maps_provider,
+                                                                 use_route_pools=bool(route_pools_interval_seconds),
+                                                                 tiles_lease_seconds=tiles_lease_seconds)
+    telegram_webhook = TelegramWebhook(telegram_dispatcher, workers_count=int(os.environ.get('TELEGRAM_WORKERS', 4)),
+                                       batch_size=int(os.environ.get('TELEGRAM_BATCH_SIZE', 16)))
+    telegram_webhook.start()
+
+
+def get_cache_provider() -> AsyncCacheProvider:
+    return AsyncCacheProvider(db_registry.get(os.environ.get('MONGODB_SERIES', 'user_search')),
+                              memory_cache=memory_cache, user_search_ttl_seconds=user_search_cache_seconds)
+
+
+@app.get("/stats")
+async def read_stats():
+    """
+    Returns hits, misses, evictions and size of the memory cache of this worker
+    """
+    memory_cache_stats = memory_cache.stats
+    return {"memory_cache": {**asdict(memory_cache_stats), "hit_ratio": memory_cache_stats.hit_ratio,
+                             "max_bytes": memory_cache.max_bytes}}
+
+
+@app.post("/telegram/webhook")
+async def telegram_update(request: Request, x_telegram_bot_api_secret_token: str = Header(None)):
+    if telegram_webhook is None or x_telegram_bot_api_secret_token != telegram_webhook_secret:
+        raise HTTPException(status_code=404)
+    if not telegram_webhook.put(await request.json()):
+        # Telegram sends the update again later
+        raise HTTPException(status_code=503)
+    return {"ok": True}
 
 
 @app.post("/search")
-def read_root(search_config: SearchConfigModel,
-              background_tasks: BackgroundTasks,
-              cache_provider: CacheProvider = Depends(get_cache_provider)):
+async def read_root(search_config: SearchConfigModel,
+                    background_tasks: BackgroundTasks,
+                    cache_provider: AsyncCacheProvider = Depends(get_cache_provider)):
     search_id = str(uuid4())
     search_config.id = search_id
     raw_search_config = search_config.construct_search_config()
-    basic_algo = BasicAlgorithm(OverpassProvider(os.environ.get('OSM_URL', 'https://overpass-api.de/api/interpreter')),
-                                cache_provider=cache_provider)
+    basic_algo = BasicAlgorithm(maps_provider, async_cache_provider=cache_provider,
+                                use_route_pools=bool(route_pools_interval_seconds),
+                                tiles_lease_seconds=tiles_lease_seconds)
     try:
-        cache_provider.save_user_search(raw_search_config)
-        background_tasks.add_task(basic_algo.search_nodes_ways, raw_search_config)
+        await cache_provider.save_user_search(raw_search_config)
+        # async tasks run on the event loop after the response is sent, no worker thread is held by the search
+        background_tasks.add_task(search_jobs.run, search_jobs.create(search_id), basic_algo, raw_search_config)
         return {"id": search_id}
     except Exception as e:
         logger.error(str(e))
         return {"error": True}
 
 
+@app.post("/search/batch")
+async def search_batch(batch_search_config: BatchSearchConfigModel,
+                       cache_provider: AsyncCacheProvider = Depends(get_cache_provider)):
+    """
+    Returns several routes from the same point, for routes_count routes of every distance and nodes_count variant
+    """
+    search_configs = batch_search_config.construct_search_configs(str(uuid4()))
+    if not 0 < len(search_configs) <= batch_routes_max_count:
+        raise HTTPException(status_code=422, detail=f'Between 1 and {batch_routes_max_count} routes are generated')
+    if any(config.distance <= 0 or config.nodes_count <= 0 for config in search_configs):
+        raise HTTPException(status_code=422, detail='Every route needs a positive distance and nodes_count')
+    basic_algo = BasicAlgorithm(maps_provider, async_cache_provider=cache_provider,
+                                tiles_lease_seconds=tiles_lease_seconds)
+    try:
+        batch_routes = await basic_algo.search_and_route_batch(search_configs)
+    except Exception as e:
+        logger.error(str(e))
+        return {"error": True}
+
+    return {"id": search_configs[0].id, "routes": [{
+        "distance": batch_route.search_config.distance,
+        "nodes_count": batch_route.search_config.nodes_count,
+        "nodes": [asdict(node) for node in batch_route.nodes],
+        "route": batch_route.route_url
+    } for batch_route in batch_routes]}
+
+
 @app.get("/search/{search_id}")
-def read_item(search_id: str,
-              cache_provider: CacheProvider = Depends(get_cache_provider)):
-    user_search = cache_provider.get_user_search(search_id)
-    user_search.pop("_id")
-    return user_search
+async def read_item(search_id: str, wait: float = 0,
+                    cache_provider: AsyncCacheProvider = Depends(get_cache_provider)):
+    """
+    Returns the search, with wait set the response is delayed until the search is done or wait seconds pass
+    """
+    if wait > 0:
+        return await search_jobs.wait(search_id, cache_provider, min(wait, long_poll_max_seconds))
+    return await search_jobs.read(search_id, cache_provider)
+
+
+@app.get("/search/{search_id}/events")
+async def read_item_events(search_id: str,
+                           cache_provider: AsyncCacheProvider = Depends(get_cache_provider)):
+    return StreamingResponse(search_jobs.events(search_id, cache_provider, search_events_timeout_seconds),
+                             media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 if __name__ == '__main__':
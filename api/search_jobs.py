@@ -0,0 +1,143 @@
+import json
+import time
+import asyncio
+import logging
+
+from dataclasses import dataclass, field
+from typing import Dict, Optional, AsyncIterator
+
+from base_algo import BasicAlgorithm
+from dto import SearchConfig
+from providers import AsyncCacheProvider
+
+logger = logging.getLogger(__name__)
+
+# stored status of the search while its job runs
+IN_PROGRESS_STATUS = 'in_progress'
+
+
+@dataclass
+class SearchJob:
+    id: str
+    # queued, then the stages of BasicAlgorithm.search_and_route and finished or failed
+    stage: str = 'queued'
+    # seconds spent in every stage
+    timings: Dict[str, float] = field(default_factory=dict)
+    error: Optional[str] = None
+    stage_started_at: float = field(default_factory=time.monotonic)
+    changed: asyncio.Event = field(default_factory=asyncio.Event)
+
+    @property
+    def done(self) -> bool:
+        return self.stage in ('finished', 'failed')
+
+    def to_dict(self) -> dict:
+        return {"stage": self.stage, "timings": dict(self.timings)}
+
+
+class SearchJobs:
+    """
+    Search jobs running in this process, waiters are woken up on every stage change. Jobs are kept for
+    keep_seconds after they are done, later requests read the search from the database only
+    """
+
+    def __init__(self, keep_seconds: float = 60):
+        self.keep_seconds = keep_seconds
+        self.__jobs: Dict[str, SearchJob] = {}
+
+    def create(self, search_id: str) -> SearchJob:
+        job = self.__jobs[search_id] = SearchJob(search_id)
+        return job
+
+    def get(self, search_id: str) -> Optional[SearchJob]:
+        return self.__jobs.get(search_id)
+
+    async def run(self, job: SearchJob, algorithm: BasicAlgorithm, search_config: SearchConfig):
+        try:
+            await algorithm.search_and_route(search_config, on_stage=lambda stage: self.__set_stage(job, stage))
+            self.__set_stage(job, 'finished')
+        except Exception as e:
+            logger.error(str(e))
+            job.error = str(e)
+            if algorithm.async_cache_provider:
+                try:
+                    await algorithm.async_cache_provider.save_user_search_error(search_config.id, job.error)
+                except ConnectionError as write_error:
+                    logger.error(str(write_error))
+            self.__set_stage(job, 'failed')
+        finally:
+            asyncio.get_running_loop().call_later(self.keep_seconds, self.__jobs.pop, job.id, None)
+
+    async def wait(self, search_id: str, cache_provider: AsyncCacheProvider, timeout: float,
+                   poll_seconds: float = 1) -> Optional[dict]:
+        """
+        Returns the search when it is done or when the timeout expires. Jobs of this process are awaited,
+        searches of other processes are polled from the database
+        """
+        deadline = time.monotonic() + timeout
+        job = self.get(search_id)
+        while job and not job.done and time.monotonic() < deadline:
+            await self.wait_change(job, deadline - time.monotonic())
+        if job:
+            return await self.read(search_id, cache_provider)
+
+        user_search = await cache_provider.get_user_search(search_id, projection={"_id": 0})
+        while user_search and user_search.get('status') == IN_PROGRESS_STATUS and time.monotonic() < deadline:
+            await asyncio.sleep(min(poll_seconds, max(deadline - time.monotonic(), 0)))
+            user_search = await cache_provider.get_user_search(search_id, projection={"_id": 0})
+
+        return user_search
+
+    async def read(self, search_id: str, cache_provider: AsyncCacheProvider) -> Optional[dict]:
+        """
+        Returns the stored search with the stage and timings of its job when it runs in this process
+        """
+        user_search = await cache_provider.get_user_search(search_id, projection={"_id": 0})
+        job = self.get(search_id)
+        if user_search is not None and job:
+            user_search.update(job.to_dict())
+
+        return user_search
+
+    async def events(self, search_id: str, cache_provider: AsyncCacheProvider, timeout: float,
+                     keep_alive_seconds: float = 15) -> AsyncIterator[str]:
+        """
+        Yields server-sent events: a stage event on every stage of a job of this process, then a result event
+        with the search when it is done or when the timeout expires
+        """
+        deadline = time.monotonic() + timeout
+        job, sent_stage = self.get(search_id), None
+        while job and not job.done and time.monotonic() < deadline:
+            if job.stage != sent_stage:
+                sent_stage = job.stage
+                yield format_event('stage', job.to_dict())
+            elif not await self.wait_change(job, min(keep_alive_seconds, deadline - time.monotonic())):
+                # comments keep proxies from closing idle connections
+                yield ': keep-alive\n\n'
+
+        yield format_event('result', await self.wait(search_id, cache_provider, deadline - time.monotonic()))
+
+    @staticmethod
+    async def wait_change(job: SearchJob, timeout: float) -> bool:
+        """
+        Waits for the next stage of the job, returns False when the timeout expires first
+        """
+        changed = job.changed
+        try:
+            await asyncio.wait_for(changed.wait(), max(timeout, 0))
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    @staticmethod
+    def __set_stage(job: SearchJob, stage: str):
+        now = time.monotonic()
+        job.timings[job.stage] = round(job.timings.get(job.stage, 0) + now - job.stage_started_at, 6)
+        job.stage, job.stage_started_at = stage, now
+        # waiters hold the previous event, a new one is awaited for the next change
+        changed, job.changed = job.changed, asyncio.Event()
+        changed.set()
+
+
+def format_event(event: str, data: Optional[dict]) -> str:
+    return 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data, default=str))
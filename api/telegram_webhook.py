@@ -0,0 +1,93 @@
+import asyncio
+import logging
+
+from typing import List, Optional
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+logger = logging.getLogger(__name__)
+
+
+class TelegramWebhook:
+    """
+    Feeds updates received by the webhook endpoint to the bot dispatcher. Updates of a chat always go to the same
+    worker task, so they are handled in order, and a worker handles all its queued updates, up to batch_size,
+    in one call of the thread pool, as handlers block on the database and the Bot API
+    """
+
+    def __init__(self, dispatcher: Dispatcher, workers_count: int = 4, batch_size: int = 16,
+                 max_queued_updates: int = 1000):
+        self.dispatcher = dispatcher
+        self.workers_count = workers_count
+        self.batch_size = batch_size
+        self.max_queued_updates = max_queued_updates
+        self.__queues: List[asyncio.Queue] = []
+        self.__tasks: List[asyncio.Task] = []
+
+    @property
+    def depth(self) -> int:
+        return sum(queue.qsize() for queue in self.__queues)
+
+    def start(self):
+        """
+        Starts the worker tasks on the running event loop
+        """
+        self.__queues = [asyncio.Queue(maxsize=max(self.max_queued_updates // self.workers_count, 1))
+                         for _ in range(self.workers_count)]
+        self.__tasks = [asyncio.create_task(self.__work(queue)) for queue in self.__queues]
+
+    async def stop(self, timeout_seconds: float = 10):
+        """
+        Waits up to timeout_seconds for the queued updates to be handled and stops the worker tasks
+        """
+        try:
+            await asyncio.wait_for(asyncio.gather(*[queue.join() for queue in self.__queues]), timeout_seconds)
+        except asyncio.TimeoutError:
+            logger.warning('%s queued updates are dropped on shutdown', self.depth)
+        for task in self.__tasks:
+            task.cancel()
+        await asyncio.gather(*self.__tasks, return_exceptions=True)
+        self.__tasks = []
+
+    def put(self, update_data: dict) -> bool:
+        """
+        Queues the update, returns False when the queue of its chat is full. Telegram sends the update again
+        when the webhook does not respond with success
+        """
+        update = Update.de_json(update_data, self.dispatcher.bot)
+        if update is None:
+            return True
+        chat_id = TelegramWebhook.__chat_id(update)
+        queue = self.__queues[hash(chat_id if chat_id is not None else update.update_id) % len(self.__queues)]
+        try:
+            queue.put_nowait(update)
+        except asyncio.QueueFull:
+            return False
+
+        return True
+
+    async def __work(self, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            updates = [await queue.get()]
+            while len(updates) < self.batch_size and not queue.empty():
+                updates.append(queue.get_nowait())
+            try:
+                await loop.run_in_executor(None, self.__process_updates, updates)
+            except Exception as e:
+                logger.error(str(e))
+            finally:
+                for _ in updates:
+                    queue.task_done()
+
+    def __process_updates(self, updates: List[Update]):
+        for update in updates:
+            # handler errors are passed to the error handlers of the dispatcher
+            self.dispatcher.process_update(update)
+
+    @staticmethod
+    def __chat_id(update: Update) -> Optional[int]:
+        if update.effective_chat:
+            return update.effective_chat.id
+        return update.effective_user.id if update.effective_user else None
@@ -1,203 +1,643 @@
 import os
+import time
 import logging
 import asyncio
-import codecs
 
-from typing import Tuple, List
-from random import sample, choice
+from array import array
+from typing import Tuple, List, Dict, Union, Iterable, Optional, Callable
+from random import Random
 from uuid import uuid4
-from json import loads
 from requests import Response
 
 from adapters.db_mongo_adapter import MongoDbAdapter
 from providers import calculate_square, MapsProviderBase, OverpassProvider, MapsRequestType, MapsRequestData, \
-    CacheProvider, calculate_squares_chunks, calculate_around_chunks
-from dto import Way, Node, Coordinates, SearchConfig
+    CacheProvider, AsyncCacheProvider, calculate_squares_chunks, calculate_around_chunks, calculate_tiles, \
+    calculate_tiles_square, calculate_tiles_rectangles, geohash_encode, group_by_tiles, calculate_distances, \
+    SpatialIndexCache, SingleFlight, TILE_PRECISION, HotRoutePools, RoutePoolKey, route_pool_key, \
+    route_pool_center_radius, ROUTE_POOL_SIZE
+from providers.route_pool import ROUTE_POOL_DISTANCE_STEP
+from providers.osm_parser import parse_osm_elements
+from providers.osm_provider import OSM_STREAM_CHUNK_SIZE
+from dto import Way, Node, NodeStore, Coordinates, SearchConfig, ChunkingStats, RoutePool, BatchRoute
+from route_engine import RouteEngine, BasicRouteEngine, RouteBudget, pick_spaced_nodes, ways_distances
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
+TILES_LEASE_POLL_SECONDS = 0.5
+# stop sets picked while building a route pool, for every stop set kept in it
+ROUTE_POOL_ATTEMPTS_FACTOR = 4
+ROUTE_POOLS_PRECOMPUTED_COUNT = 20
+
 
 class BasicAlgorithm:
+    spatial_index_cache = SpatialIndexCache()
+    single_flight = SingleFlight()
+    hot_route_pools = HotRoutePools()
 
     def __init__(self, maps_provider: MapsProviderBase,
                  maps_request_type: MapsRequestType = MapsRequestType.AROUND_POINT,
-                 cache_provider: CacheProvider = None):
+                 cache_provider: CacheProvider = None,
+                 tile_precision: int = TILE_PRECISION,
+                 tiles_lease_seconds: float = 0,
+                 async_cache_provider: AsyncCacheProvider = None,
+                 use_route_pools: bool = False,
+                 route_engine: RouteEngine = None,
+                 route_seed: int = None,
+                 route_budget: RouteBudget = None):
         self.maps_provider = maps_provider
         self.maps_request_type = maps_request_type
         self.cache_provider = cache_provider
+        # used by the async methods instead of cache_provider, so they do not block the event loop
+        self.async_cache_provider = async_cache_provider
+        self.tile_precision = tile_precision
+        # leases in the cache database coalesce tiles requests of several processes, 0 disables them
+        self.tiles_lease_seconds = tiles_lease_seconds
+        self.lease_owner = str(uuid4())
+        self.chunking_stats = ChunkingStats()
+        # searches are answered from the precomputed route pool of their tile when it exists
+        self.use_route_pools = use_route_pools
+        self.route_engine = route_engine or BasicRouteEngine()
+        # routes and route pools are reproducible with a seed, and random for every search without it
+        self.route_seed = route_seed
+        self.route_budget = route_budget
 
     def search_nodes_ways(self, search_config: SearchConfig,
                           maximum_chunk_distance: float = 20,
                           maximum_geo_requests_count: int = 15,
-                          maps_request_type: MapsRequestType = None) -> Tuple[list, list]:
-        nodes, ways = [], []
-        geo_request_count = 0
-        distance = search_config.distance
-        initial_coordinates = Coordinates(latitude=search_config.latitude, longitude=search_config.longitude)
+                          maps_request_type: MapsRequestType = None) -> Tuple[NodeStore, List[Way]]:
+        tiles_chunks, chunks_tiles, tiles_key = self.plan_search_tiles(search_config, maximum_chunk_distance,
+                                                                       maximum_geo_requests_count, maps_request_type)
+        nodes_ways = BasicAlgorithm.spatial_index_cache.get(tiles_key)
+        if nodes_ways:
+            return nodes_ways
+
+        tiles = self.cache_provider.get_tiles(list(chunks_tiles)) if self.cache_provider else {}
+        missing_tiles = self.find_missing_tiles(tiles_chunks, tiles)
+        if missing_tiles:
+            tiles.update(self.request_missing_tiles(tiles_chunks, missing_tiles))
+            self.log_chunking_stats()
+
+        return self.merge_search_tiles(tiles_key, chunks_tiles, tiles)
+
+    async def search_nodes_ways_async(self, search_config: SearchConfig,
+                                      maximum_chunk_distance: float = 20,
+                                      maximum_geo_requests_count: int = 15,
+                                      maps_request_type: MapsRequestType = None) -> Tuple[NodeStore, List[Way]]:
+        """
+        search_nodes_ways for asyncio applications, the maps provider and the cache are awaited directly
+        """
+        tiles_chunks, chunks_tiles, tiles_key = self.plan_search_tiles(search_config, maximum_chunk_distance,
+                                                                       maximum_geo_requests_count, maps_request_type)
+        nodes_ways = BasicAlgorithm.spatial_index_cache.get(tiles_key)
+        if nodes_ways:
+            return nodes_ways
+
+        tiles = await self.async_cache_provider.get_tiles(list(chunks_tiles)) if self.async_cache_provider else {}
+        missing_tiles = self.find_missing_tiles(tiles_chunks, tiles)
+        if missing_tiles:
+            tiles.update(await self.request_missing_tiles_async(tiles_chunks, missing_tiles))
+            self.log_chunking_stats()
+
+        # merging the tiles and building their spatial index are CPU bound, they run outside of the event loop
+        return await asyncio.get_running_loop().run_in_executor(None, self.merge_search_tiles, tiles_key,
+                                                                chunks_tiles, tiles)
+
+    def plan_search_tiles(self, search_config: SearchConfig, maximum_chunk_distance: float,
+                          maximum_geo_requests_count: int,
+                          maps_request_type: MapsRequestType = None) -> Tuple[List[List[str]], set, tuple]:
+        """
+        Returns tiles of every search chunk, all the tiles and the key of their dataset in the spatial index cache
+        """
+        if maps_request_type:
+            self.maps_request_type = maps_request_type
+        tiles_chunks, chunks_tiles = self.plan_tiles_chunks(search_config, maximum_chunk_distance,
+                                                            maximum_geo_requests_count)
+        return tiles_chunks, chunks_tiles, (self.tile_precision, tuple(sorted(chunks_tiles)))
+
+    @staticmethod
+    def find_missing_tiles(tiles_chunks: List[List[str]], tiles: Dict[str, Tuple[NodeStore, List[Way]]]) -> List[str]:
+        return [tile for chunk_tiles in tiles_chunks for tile in chunk_tiles if tile not in tiles]
+
+    def merge_search_tiles(self, tiles_key: tuple, chunks_tiles: set,
+                           tiles: Dict[str, Tuple[NodeStore, List[Way]]]) -> Tuple[NodeStore, List[Way]]:
+        nodes_ways = self.merge_nodes_ways(tiles.values())
+        # the spatial index is built with the dataset, which is shared by the searches of its tiles
+        nodes_ways[0].spatial_index
+        if len(tiles) == len(chunks_tiles):
+            # only complete datasets are kept, failed tiles are requested again by the next search
+            BasicAlgorithm.spatial_index_cache.put(tiles_key, nodes_ways)
+
+        return nodes_ways
+
+    async def search_and_route(self, search_config: SearchConfig, on_stage: Callable[[str], None] = None) -> str:
+        """
+        Searches nodes and ways around the search config point and saves the generated route, without blocking
+        the event loop on network calls. on_stage is called with fetch, route and persist when each stage starts,
+        responses are parsed while they are fetched
+        """
+        on_stage = on_stage or (lambda stage: None)
+        on_stage('fetch')
+        route_pool = await self.find_route_pool_async(search_config)
+        if route_pool:
+            on_stage('route')
+            result_nodes = self.choose_pooled_route_nodes(route_pool, search_config)
+        else:
+            nodes, ways = await self.search_nodes_ways_async(search_config)
+            on_stage('route')
+            result_nodes = await asyncio.get_running_loop().run_in_executor(None, self.choose_route_nodes, nodes, ways,
+                                                                            search_config)
+        route_url = self.create_route_url(result_nodes)
+        on_stage('persist')
+        if self.async_cache_provider:
+            await self.async_cache_provider.save_user_search_results(search_config.id, result_nodes, route_url,
+                                                                     search_config)
 
-        if self.cache_provider:
-            result = self.cache_provider.get_api_responses(search_config)
-            if result and len(result.get('responses')) > 0:
-                nodes, ways = self.process_responses(result.get('responses'))
-
-        if len(nodes) == 0:
-            request_data = MapsRequestData(initial_coordinates=initial_coordinates, distance=distance)
-            if maps_request_type:
-                self.maps_request_type = maps_request_type
-
-            coordinates = initial_coordinates
-            if distance <= maximum_chunk_distance:
-                while geo_request_count < maximum_geo_requests_count:
-                    try:
-                        if self.maps_request_type == MapsRequestType.AROUND_POINT:
-                            request_data.points_radius = {coordinates: distance}
-                        else:
-                            request_data.square_coordinates = calculate_square(coordinates, distance)
-
-                        nodes, ways = self.request_nodes_ways(request_data)
-                        break
-                    except ValueError as e:
-                        logger.error(str(e))
-                        coordinates = (coordinates[0] + 0.5, coordinates[1] + 0.5)
-            else:
-                if self.maps_request_type == MapsRequestType.AROUND_POINT:
-                    request_data.points_radius = calculate_around_chunks(coordinates, distance, maximum_chunk_distance,
-                                                                         maximum_geo_requests_count)
-                else:
-                    request_data.square_coordinates = calculate_squares_chunks(coordinates, distance,
-                                                                               maximum_chunk_distance,
-                                                                               maximum_geo_requests_count)
-
-                nodes, ways = self.request_nodes_ways(request_data, asynchronously=True)
-
-        return nodes, ways
-
-    def request_nodes_ways(self, request_data: MapsRequestData, asynchronously: bool = False):
-        if asynchronously:
-            nodes, ways = [], []
-            try:
-                loop = asyncio.get_event_loop()
-            except RuntimeError:
-                loop = asyncio.new_event_loop()
-            try:
-                # future = asyncio.ensure_future()
-                responses = loop.run_until_complete(
-                    self.maps_provider.get_osm_nodes_ways_async(request_data, self.maps_request_type))
+        return route_url
 
-                if self.cache_provider:
-                    search_config = SearchConfig(latitude=request_data.initial_coordinates.latitude,
-                                                 longitude=request_data.initial_coordinates.longitude,
-                                                 distance=request_data.distance)
-                    self.cache_provider.save_api_responses(search_config, responses)
+    def search_and_generate_route(self, search_config: SearchConfig) -> str:
+        route_pool = self.find_route_pool(search_config)
+        if not route_pool:
+            nodes, ways = self.search_nodes_ways(search_config)
+            return self.generate_route(nodes, ways, search_config)
 
-                nodes, ways = self.process_responses(responses)
+        result_nodes = self.choose_pooled_route_nodes(route_pool, search_config)
+        route_url = self.create_route_url(result_nodes)
+        if self.cache_provider:
+            self.cache_provider.save_user_search_results(search_config.id, result_nodes, route_url, search_config)
 
-            except Exception as e:
-                logger.error(str(e))
+        return route_url
 
-            return nodes, ways
+    async def search_and_route_batch(self, search_configs: List[SearchConfig]) -> List[BatchRoute]:
+        """
+        Searches nodes and ways once for the widest of the search configs, which share the search point,
+        and generates a route for every search config over them
+        """
+        nodes, ways = await self.search_nodes_ways_async(max(search_configs, key=lambda config: config.distance))
+        return await asyncio.get_running_loop().run_in_executor(None, self.generate_batch_routes, nodes, ways,
+                                                                search_configs)
+
+    def search_and_generate_batch_routes(self, search_configs: List[SearchConfig]) -> List[BatchRoute]:
+        nodes, ways = self.search_nodes_ways(max(search_configs, key=lambda config: config.distance))
+        return self.generate_batch_routes(nodes, ways, search_configs)
+
+    def generate_batch_routes(self, nodes: NodeStore, ways: List[Way],
+                              search_configs: List[SearchConfig]) -> List[BatchRoute]:
+        """
+        Routes of the batch are not saved, ways are narrowed to the distance of every search config
+        and routes of a seeded algorithm get seeds derived from its seed, so they differ
+        """
+        if not search_configs:
+            return []
+        initial_node = Node(0, longitude=search_configs[0].longitude, latitude=search_configs[0].latitude)
+        distances = ways_distances(ways, initial_node)
+        config_ways = {}
+        batch_routes = []
+        for index, search_config in enumerate(search_configs):
+            distance = search_config.distance or 15
+            if distance not in config_ways:
+                config_ways[distance] = [way for way, way_distance in zip(ways, distances) if way_distance <= distance]
+            seed = self.route_seed + index if self.route_seed is not None else None
+            result_nodes = self.choose_route_nodes(nodes, config_ways[distance], search_config, seed)
+            batch_routes.append(BatchRoute(search_config, result_nodes, self.create_route_url(result_nodes)))
+
+        return batch_routes
+
+    def find_route_pool(self, search_config: SearchConfig) -> Optional[RoutePool]:
+        """
+        Returns the route pool of the search when it has stop sets, searches without a pool are counted
+        for the precomputation
+        """
+        key = self.search_route_pool_key(search_config, self.cache_provider)
+        if key is None:
+            return None
+        return self.usable_route_pool(key, self.cache_provider.get_route_pool(key))
+
+    async def find_route_pool_async(self, search_config: SearchConfig) -> Optional[RoutePool]:
+        key = self.search_route_pool_key(search_config, self.async_cache_provider)
+        if key is None:
+            return None
+        return self.usable_route_pool(key, await self.async_cache_provider.get_route_pool(key))
+
+    def search_route_pool_key(self, search_config: SearchConfig, cache_provider) -> Optional[RoutePoolKey]:
+        return route_pool_key(search_config) if self.use_route_pools and cache_provider else None
+
+    @staticmethod
+    def usable_route_pool(key: RoutePoolKey, route_pool: Optional[RoutePool]) -> Optional[RoutePool]:
+        if route_pool is None:
+            BasicAlgorithm.hot_route_pools.record(key)
+
+        return route_pool if route_pool and route_pool.stops else None
+
+    def precompute_route_pools(self, count: int = ROUTE_POOLS_PRECOMPUTED_COUNT) -> int:
+        """
+        Builds route pools of the most searched keys which do not have one yet, returns the number of built pools
+        """
+        built_count = 0
+        for key in BasicAlgorithm.hot_route_pools.hot_keys(count):
+            if self.cache_provider.get_route_pool(key) is not None:
+                continue
+            nodes, ways = self.search_nodes_ways(route_pool_search_config(key))
+            # failed searches are retried by the next precomputation
+            if len(nodes) > 0:
+                self.cache_provider.save_route_pool(self.build_route_pool(nodes, ways, key, Random(self.route_seed)))
+                built_count += 1
+
+        return built_count
+
+    async def precompute_route_pools_async(self, count: int = ROUTE_POOLS_PRECOMPUTED_COUNT) -> int:
+        built_count = 0
+        for key in BasicAlgorithm.hot_route_pools.hot_keys(count):
+            if await self.async_cache_provider.get_route_pool(key) is not None:
+                continue
+            nodes, ways = await self.search_nodes_ways_async(route_pool_search_config(key))
+            if len(nodes) > 0:
+                # stop sets are picked in a worker thread, not to block the event loop
+                route_pool = await asyncio.get_running_loop().run_in_executor(None, self.build_route_pool, nodes,
+                                                                              ways, key, Random(self.route_seed))
+                await self.async_cache_provider.save_route_pool(route_pool)
+                built_count += 1
+
+        return built_count
+
+    @staticmethod
+    def build_route_pool(nodes: NodeStore, ways: List[Way], key: RoutePoolKey, rng: Random = None,
+                         pool_size: int = ROUTE_POOL_SIZE) -> RoutePool:
+        """
+        Picks stop sets from the tile center ranked by their shortest leg, the most spread out ones first.
+        Stops are kept the tile radius farther from the center than min_node_distance and closer than distance,
+        so they are valid from any point of the tile. Pools of areas with ways stay empty, routes along ways
+        are not precomputed
+        """
+        tile, distance, nodes_count = key
+        route_pool = RoutePool(tile, distance, nodes_count)
+        center, radius = route_pool_center_radius(tile)
+        # spacing of the longest distance of the bucket
+        min_node_distance = (distance + ROUTE_POOL_DISTANCE_STEP) / (nodes_count if nodes_count != 1 else 2)
+        if ways or len(nodes) == 0 or distance - radius <= min_node_distance + radius:
+            return route_pool
+
+        center_node = Node(0, latitude=center.latitude, longitude=center.longitude)
+        rng = rng or Random()
+        stops_count = nodes_count - 1 if nodes_count != 1 else 1
+        ranked_stops = {}
+        for _ in range(pool_size * ROUTE_POOL_ATTEMPTS_FACTOR):
+            stops = pick_spaced_nodes(nodes, center_node, stops_count, min_node_distance + radius, distance - radius,
+                                      rng)
+            if len(stops) != stops_count:
+                continue
+            center_distances = calculate_distances(center, [stop.latitude for stop in stops],
+                                                   [stop.longitude for stop in stops])
+            legs = [calculate_distances(previous_stop, [stop.latitude], [stop.longitude])[0]
+                    for previous_stop, stop in zip([center_node] + stops, stops)]
+            # nearest nodes are picked when no node is far enough, such stop sets are not kept
+            if center_distances.max() <= distance - radius and legs[0] >= min_node_distance + radius and \
+                    min(legs[1:], default=min_node_distance) >= min_node_distance:
+                ranked_stops[tuple(stop.id for stop in stops)] = (min(legs), stops)
+
+        route_pool.stops = [stops for _, stops in sorted(ranked_stops.values(), key=lambda ranked: ranked[0],
+                                                         reverse=True)[:pool_size]]
+        return route_pool
+
+    def choose_pooled_route_nodes(self, route_pool: RoutePool, search_config: SearchConfig) -> List[Node]:
+        initial_node = Node(0, longitude=search_config.longitude, latitude=search_config.latitude)
+        # a random stop set of the pool keeps routes unpredictable
+        return [initial_node] + list(Random(self.route_seed).choice(route_pool.stops))
+
+    def plan_tiles_chunks(self, search_config: SearchConfig, maximum_chunk_distance: float,
+                          maximum_geo_requests_count: int) -> Tuple[List[List[str]], set]:
+        """
+        Returns tiles of every search chunk, each tile belongs to one chunk only, and all the tiles
+        """
+        distance = search_config.distance
+        initial_coordinates = Coordinates(latitude=search_config.latitude, longitude=search_config.longitude)
+
+        if distance <= maximum_chunk_distance:
+            squares_chunks = [calculate_square(initial_coordinates, distance)]
+        elif self.maps_request_type == MapsRequestType.AROUND_POINT:
+            points_radius = calculate_around_chunks(initial_coordinates, distance, maximum_chunk_distance,
+                                                    maximum_geo_requests_count)
+            squares_chunks = [calculate_square(coordinates, radius) for coordinates, radius in points_radius.items()]
         else:
-            response = self.maps_provider.get_osm_nodes_ways(request_data, self.maps_request_type)
+            squares_chunks = calculate_squares_chunks(initial_coordinates, distance, maximum_chunk_distance,
+                                                      maximum_geo_requests_count)
+
+        self.chunking_stats = ChunkingStats(maximum_chunk_distance=maximum_chunk_distance,
+                                            chunks_count=len(squares_chunks))
+        tiles_chunks, chunks_tiles = [], set()
+        for square_coordinates in squares_chunks:
+            square_tiles = calculate_tiles(square_coordinates, self.tile_precision)
+            # tiles are assigned to the first chunk covering them, so overlapping chunks do not request them twice
+            chunk_tiles = [tile for tile in square_tiles if tile not in chunks_tiles]
+            chunks_tiles.update(chunk_tiles)
+            tiles_chunks.append(chunk_tiles)
+            self.chunking_stats.chunks_tiles_count += len(square_tiles)
+        self.chunking_stats.unique_tiles_count = len(chunks_tiles)
+
+        return tiles_chunks, chunks_tiles
+
+    def log_chunking_stats(self):
+        stats = self.chunking_stats
+        logger.info('Chunking with maximum distance %s: %s chunks, %s tiles covered %s times (%.0f%% overlap), '
+                    '%s nodes received for %s unique ones (%.0f%% duplicates), %s ways for %s unique ones',
+                    stats.maximum_chunk_distance, stats.chunks_count, stats.unique_tiles_count,
+                    stats.chunks_tiles_count, stats.tiles_duplication * 100, stats.received_nodes_count,
+                    stats.unique_nodes_count, stats.nodes_duplication * 100, stats.received_ways_count,
+                    stats.unique_ways_count)
+
+    def request_missing_tiles(self, tiles_chunks: List[List[str]],
+                              missing_tiles: List[str]) -> Dict[str, Tuple[NodeStore, List[Way]]]:
+        """
+        Requests only the tiles which are not being requested by concurrent searches, and waits for the others
+        """
+        claimed_tiles, in_flight_tiles = BasicAlgorithm.single_flight.claim(missing_tiles)
+        uses_leases = self.uses_tiles_leases(self.cache_provider)
+        tiles = {}
+        try:
+            leased_tiles = set(self.cache_provider.acquire_tiles_leases(
+                list(claimed_tiles), self.lease_owner, self.tiles_lease_seconds) if uses_leases else claimed_tiles)
+            try:
+                tiles.update(self.request_tiles(self.filter_tiles_chunks(tiles_chunks, leased_tiles)))
+            finally:
+                if uses_leases and leased_tiles:
+                    self.cache_provider.release_tiles_leases(list(leased_tiles), self.lease_owner)
+
+            leased_elsewhere_tiles = [tile for tile in claimed_tiles if tile not in leased_tiles]
+            if leased_elsewhere_tiles:
+                tiles.update(self.wait_leased_tiles(tiles_chunks, leased_elsewhere_tiles))
+        finally:
+            self.resolve_claimed_tiles(claimed_tiles, tiles)
+
+        return self.add_in_flight_tiles(tiles, {tile: future.result() for tile, future in in_flight_tiles.items()})
+
+    async def request_missing_tiles_async(self, tiles_chunks: List[List[str]],
+                                          missing_tiles: List[str]) -> Dict[str, Tuple[NodeStore, List[Way]]]:
+        claimed_tiles, in_flight_tiles = BasicAlgorithm.single_flight.claim(missing_tiles)
+        uses_leases = self.uses_tiles_leases(self.async_cache_provider)
+        tiles = {}
+        try:
+            leased_tiles = set(await self.async_cache_provider.acquire_tiles_leases(
+                list(claimed_tiles), self.lease_owner, self.tiles_lease_seconds) if uses_leases else claimed_tiles)
+            try:
+                tiles.update(await self.request_tiles_async(self.filter_tiles_chunks(tiles_chunks, leased_tiles)))
+            finally:
+                if uses_leases and leased_tiles:
+                    await self.async_cache_provider.release_tiles_leases(list(leased_tiles), self.lease_owner)
+
+            leased_elsewhere_tiles = [tile for tile in claimed_tiles if tile not in leased_tiles]
+            if leased_elsewhere_tiles:
+                tiles.update(await self.wait_leased_tiles_async(tiles_chunks, leased_elsewhere_tiles))
+        finally:
+            self.resolve_claimed_tiles(claimed_tiles, tiles)
+
+        # the futures may be resolved by searches running in other threads
+        in_flight_results = await asyncio.gather(*[asyncio.wrap_future(future) for future in in_flight_tiles.values()])
+        return self.add_in_flight_tiles(tiles, dict(zip(in_flight_tiles, in_flight_results)))
+
+    def uses_tiles_leases(self, cache_provider) -> bool:
+        return bool(cache_provider and self.tiles_lease_seconds)
+
+    @staticmethod
+    def resolve_claimed_tiles(claimed_tiles: List[str], tiles: Dict[str, Tuple[NodeStore, List[Way]]]):
+        for tile in claimed_tiles:
+            BasicAlgorithm.single_flight.resolve(tile, tiles.get(tile))
+
+    @staticmethod
+    def add_in_flight_tiles(tiles: Dict[str, Tuple[NodeStore, List[Way]]],
+                            in_flight_results: Dict[str, Optional[Tuple[NodeStore, List[Way]]]]) \
+            -> Dict[str, Tuple[NodeStore, List[Way]]]:
+        # concurrent searches resolve their failed tiles with None
+        tiles.update((tile, result) for tile, result in in_flight_results.items() if result is not None)
+        return tiles
+
+    def wait_leased_tiles(self, tiles_chunks: List[List[str]],
+                          leased_tiles: List[str]) -> Dict[str, Tuple[NodeStore, List[Way]]]:
+        """
+        Waits for tiles leased by other processes to appear in the cache, requests them after the lease expires
+        """
+        tiles, pending_tiles = {}, set(leased_tiles)
+        deadline = time.monotonic() + self.tiles_lease_seconds
+        while pending_tiles and time.monotonic() < deadline:
+            time.sleep(TILES_LEASE_POLL_SECONDS)
+            self.add_cached_tiles(tiles, pending_tiles, self.cache_provider.get_tiles(list(pending_tiles)))
+
+        tiles.update(self.request_tiles(self.expired_leases_chunks(tiles_chunks, pending_tiles)))
+        return tiles
+
+    async def wait_leased_tiles_async(self, tiles_chunks: List[List[str]],
+                                      leased_tiles: List[str]) -> Dict[str, Tuple[NodeStore, List[Way]]]:
+        tiles, pending_tiles = {}, set(leased_tiles)
+        deadline = time.monotonic() + self.tiles_lease_seconds
+        while pending_tiles and time.monotonic() < deadline:
+            await asyncio.sleep(TILES_LEASE_POLL_SECONDS)
+            self.add_cached_tiles(tiles, pending_tiles, await self.async_cache_provider.get_tiles(list(pending_tiles)))
+
+        tiles.update(await self.request_tiles_async(self.expired_leases_chunks(tiles_chunks, pending_tiles)))
+        return tiles
+
+    @staticmethod
+    def add_cached_tiles(tiles: Dict[str, Tuple[NodeStore, List[Way]]], pending_tiles: set,
+                         cached_tiles: Dict[str, Tuple[NodeStore, List[Way]]]):
+        tiles.update(cached_tiles)
+        pending_tiles.difference_update(cached_tiles)
+
+    @staticmethod
+    def expired_leases_chunks(tiles_chunks: List[List[str]], pending_tiles: set) -> List[List[str]]:
+        if pending_tiles:
+            logger.warning('Tiles lease expired, requesting %s tiles', len(pending_tiles))
+        return BasicAlgorithm.filter_tiles_chunks(tiles_chunks, pending_tiles)
+
+    @staticmethod
+    def filter_tiles_chunks(tiles_chunks: List[List[str]], tiles: Iterable[str]) -> List[List[str]]:
+        tiles = set(tiles)
+        tiles_chunks = [[tile for tile in chunk_tiles if tile in tiles] for chunk_tiles in tiles_chunks]
+        return [chunk_tiles for chunk_tiles in tiles_chunks if chunk_tiles]
+
+    def request_tiles(self, tiles_chunks: List[List[str]]) -> Dict[str, Tuple[NodeStore, List[Way]]]:
+        if not tiles_chunks:
+            return {}
+        tiles_chunks, request_data = self.plan_tiles_request(tiles_chunks)
+        tiles = self.split_tiles(tiles_chunks, self.request_nodes_ways(request_data))
+        if self.cache_provider and tiles:
+            self.cache_provider.save_tiles(tiles)
+
+        return tiles
+
+    async def request_tiles_async(self, tiles_chunks: List[List[str]]) -> Dict[str, Tuple[NodeStore, List[Way]]]:
+        if not tiles_chunks:
+            return {}
+        tiles_chunks, request_data = self.plan_tiles_request(tiles_chunks)
+        responses = await self.request_nodes_ways_async(request_data)
+        tiles = await asyncio.get_running_loop().run_in_executor(None, self.split_tiles, tiles_chunks, responses)
+        if self.async_cache_provider and tiles:
+            await self.async_cache_provider.save_tiles(tiles)
+
+        return tiles
+
+    def plan_tiles_request(self, tiles_chunks: List[List[str]]) -> Tuple[List[List[str]], MapsRequestData]:
+        """
+        Splits the chunks into rectangles of tiles, returns them with the request data of their squares
+        """
+        tiles_chunks = self.split_tiles_rectangles(tiles_chunks)
+        return tiles_chunks, MapsRequestData(square_coordinates=[calculate_tiles_square(chunk_tiles)
+                                                                 for chunk_tiles in tiles_chunks])
+
+    @staticmethod
+    def split_tiles_rectangles(tiles_chunks: List[List[str]]) -> List[List[str]]:
+        """
+        Splits chunks into rectangles of their tiles, the bounding square of a chunk with cached tiles
+        or tiles of other chunks would request them again
+        """
+        return [rectangle for chunk_tiles in tiles_chunks for rectangle in calculate_tiles_rectangles(chunk_tiles)]
+
+    def split_tiles(self, tiles_chunks: List[List[str]], responses: list) -> Dict[str, Tuple[NodeStore, List[Way]]]:
+        """
+        Processes responses of the chunks and splits their nodes and ways by tiles
+        """
+        tiles, processed_responses = {}, {}
+        for chunk_tiles, response in zip(tiles_chunks, responses):
+            # chunks merged into one union query share the response, it is processed once
+            if id(response) not in processed_responses:
+                try:
+                    nodes, ways = self.process_response(response)
+                    processed_responses[id(response)] = (nodes, ways, *self.group_nodes_ways(nodes, ways))
+                    self.chunking_stats.received_nodes_count += len(nodes)
+                    self.chunking_stats.received_ways_count += len(ways)
+                except (ValueError, OSError) as e:
+                    # OSError covers connection errors raised while a streamed body is read
+                    logger.error(str(e))
+                    processed_responses[id(response)] = None
+            if processed_responses[id(response)] is None:
+                continue
+            nodes, ways, nodes_tiles, ways_tiles = processed_responses[id(response)]
+            # the chunk square is made of whole tiles, so tiles without nodes are complete (empty) too
+            for tile in chunk_tiles:
+                tile_nodes, tile_ways = NodeStore(), []
+                tile_nodes.extend(nodes, nodes_tiles.get(tile, []))
+                for way in ways_tiles.get(tile, []):
+                    # nodes of the way outside of the tile are stored with the tile as well
+                    nodes_mapping = tile_nodes.extend(nodes, way.nodes_indexes)
+                    tile_ways.append(Way(tile_nodes, array('i', (nodes_mapping[i] for i in way.nodes_indexes)),
+                                         id=way.id))
+                tiles[tile] = (tile_nodes.drop_index(), tile_ways)
+                # every node belongs to exactly one tile, ways are counted in the tile of their first node
+                self.chunking_stats.unique_nodes_count += len(nodes_tiles.get(tile, []))
+                self.chunking_stats.unique_ways_count += len(tile_ways)
+
+        return tiles
+
+    def group_nodes_ways(self, nodes: NodeStore, ways: List[Way]) -> Tuple[Dict[str, List[int]], Dict[str, List[Way]]]:
+        nodes_tiles = group_by_tiles(nodes.latitudes, nodes.longitudes, self.tile_precision)
+        ways_tiles = {}
+        for way in ways:
+            if len(way.nodes_indexes) > 0:
+                first_node = nodes[way.nodes_indexes[0]]
+                ways_tiles.setdefault(geohash_encode(first_node, self.tile_precision), []).append(way)
+
+        return nodes_tiles, ways_tiles
+
+    @staticmethod
+    def merge_nodes_ways(nodes_ways: Iterable[Tuple[NodeStore, List[Way]]]) -> Tuple[NodeStore, List[Way]]:
+        """
+        Merges nodes and ways of several responses or tiles, elements are deduplicated by OSM id
+        """
+        nodes, ways, ways_ids = NodeStore(), [], set()
+        for part_nodes, part_ways in nodes_ways:
+            nodes_mapping = nodes.extend(part_nodes)
+            for way in part_ways:
+                if way.id:
+                    if way.id in ways_ids:
+                        continue
+                    ways_ids.add(way.id)
+                ways.append(Way(nodes, array('i', (nodes_mapping[i] for i in way.nodes_indexes)), id=way.id))
+
+        return nodes.drop_index(), ways
 
-            if self.cache_provider:
-                search_config = SearchConfig(latitude=request_data.initial_coordinates.latitude,
-                                             longitude=request_data.initial_coordinates.longitude,
-                                             distance=request_data.distance)
-                self.cache_provider.save_api_responses(search_config, [response])
+    def request_nodes_ways(self, request_data: MapsRequestData) -> list:
+        """
+        Returns responses of the request data, or no responses when the maps provider fails,
+        so tiles claimed by the search are resolved without results instead of failing concurrent searches
+        """
+        try:
+            return self.maps_provider.get_osm_nodes_ways_areas(request_data, MapsRequestType.SQUARE_COORDINATES)
+        except Exception as e:
+            logger.error(str(e))
+            return []
 
-            return self.process_response(response)
+    async def request_nodes_ways_async(self, request_data: MapsRequestData) -> list:
+        try:
+            return await self.maps_provider.get_osm_nodes_ways_async(request_data, MapsRequestType.SQUARE_COORDINATES)
+        except Exception as e:
+            logger.error(str(e))
+            return []
 
-    def process_responses(self, responses: list) -> Tuple[list, list]:
-        nodes, ways = [], []
+    def process_responses(self, responses: list) -> Tuple[NodeStore, List[Way]]:
+        nodes_ways = []
         for response in responses:
             try:
-                nodes_request, ways_request = self.process_response(response)
-                nodes.extend(nodes_request)
-                ways.extend(ways_request)
+                nodes_ways.append(self.process_response(response))
             except ValueError as e:
                 logger.error(str(e))
 
-        return nodes, ways
+        return self.merge_nodes_ways(nodes_ways)
+
+    def process_response(self, osm_response: Union[Response, bytes, tuple, Exception]) -> Tuple[NodeStore, List[Way]]:
+        if isinstance(osm_response, tuple):
+            # already parsed while streaming
+            return osm_response
+        if isinstance(osm_response, Exception):
+            raise ValueError(str(osm_response))
 
-    def process_response(self, osm_response: Response) -> Tuple[list, list]:
         try:
             if osm_response.status_code == 400:
-                raise ValueError('Api call error: {}'.format(codecs.decode(osm_response.raw.data)))
+                raise ValueError('Api call error: {}'.format(osm_response.text))
 
-            osm_response.raw.decode_content = True
-            osm_response = codecs.decode(osm_response.raw.data)
+            chunks = osm_response.iter_content(chunk_size=OSM_STREAM_CHUNK_SIZE)
         except AttributeError:
-            osm_response = codecs.decode(osm_response, encoding="UTF-8")
+            chunks = [osm_response]
 
-        nodes_index, ways_list = {}, []
-        try:
-            osm_response = loads(osm_response)
-        except:
-            raise ValueError('Api call error: {}'.format(str(osm_response)))
-        for element in osm_response.get('elements'):
-            if element.get('type') == 'node':
-                node_id = str(element.get('id'))
-                nodes_index[node_id] = Node(node_id, longitude=float(element.get('lon')),
-                                            latitude=float(element.get('lat')))
-            elif element.get('type') == 'way':
-                way = Way()
-                for node in element.get("nodes"):
-                    try:
-                        way.nodes.append(nodes_index[str(node)])
-                    except KeyError:
-                        continue
-                ways_list.extend([way])
+        return parse_osm_elements(chunks)
 
-        return list(nodes_index.values()), ways_list
+    def generate_route(self, nodes: NodeStore, ways: List[Way], search_config: SearchConfig) -> str:
+        result_nodes = self.choose_route_nodes(nodes, ways, search_config)
+        route_url = self.create_route_url(result_nodes)
 
-    def generate_route(self, nodes: List[Node], ways: List[Way], search_config: SearchConfig) -> str:
-        distance = search_config.distance or 15
-        nodes_count = search_config.nodes_count or 3
-        coordinates = Coordinates(latitude=search_config.latitude, longitude=search_config.longitude)
-        initial_node = Node(str(uuid4()), longitude=coordinates.longitude, latitude=coordinates.latitude)
-        min_node_distance = distance / (nodes_count if nodes_count != 1 else 2)
-        result_nodes = [initial_node]
+        if self.cache_provider:
+            self.cache_provider.save_user_search_results(search_config.id, result_nodes, route_url, search_config)
 
-        max_search_iterations = len(ways)
-        search_iteration = 0
+        return route_url
 
-        while search_iteration < max_search_iterations:
-            search_iteration += 1
-            way = choice(ways)
-            try:
-                random_node = choice(way.nodes)
-                matching_siblings = way.find_matching_siblings(random_node, min_node_distance)
-                result_nodes.extend(sample(matching_siblings, nodes_count - 1))
-            except ValueError:
-                continue
-            if len(result_nodes) == nodes_count:
-                print("nodes found.")
-                break
+    def choose_route_nodes(self, nodes: NodeStore, ways: List[Way], search_config: SearchConfig,
+                           seed: int = None) -> List[Node]:
+        seed = self.route_seed if seed is None else seed
+        route_stops = self.route_engine.choose_stops(nodes, ways, search_config, seed, self.route_budget)
+        if route_stops.budget_exhausted:
+            logger.info('Route budget exhausted after %s iterations in %.3f seconds', route_stops.iterations,
+                        route_stops.elapsed_seconds)
 
-        if len(result_nodes) != nodes_count or len(result_nodes) == 1:
-            try:
-                result_nodes = [initial_node]
-                result_nodes.extend(sample(nodes, (nodes_count - 1) if nodes_count != 1 else 1))
-            except ValueError:
-                pass
+        return route_stops.nodes
 
+    @staticmethod
+    def create_route_url(result_nodes: List[Node]) -> str:
         route_url = 'https://www.google.com/maps/dir/'
         for node in result_nodes:
             route_url += str(node) + '/'
-        route_url += f'@{str(initial_node)}'
-
-        if self.cache_provider:
-            self.cache_provider.save_user_search_results(search_config.id, result_nodes, route_url)
+        route_url += f'@{str(result_nodes[0])}'
 
         return route_url
 
 
+def route_pool_search_config(key: RoutePoolKey) -> SearchConfig:
+    tile, distance, nodes_count = key
+    center, _ = route_pool_center_radius(tile)
+    return SearchConfig(latitude=center.latitude, longitude=center.longitude, distance=distance,
+                        nodes_count=nodes_count)
+
+
 # Press the green button in the gutter to run the script.
 if __name__ == '__main__':
-    from uuid import uuid4
     search_config = SearchConfig(id=str(uuid4()), nodes_count=3, latitude=50.4021368, longitude=30.2525113, distance=50)
     cache_provider = CacheProvider(MongoDbAdapter(host=os.environ.get('MONGODB_HOST', '127.0.0.1'),
                                                   db_name=os.environ.get('MONGODB_DATABASE', 'road_trip'),
@@ -1,7 +1,14 @@
-from typing import List, Optional
+import numpy as np
+
+from array import array
+from collections.abc import Sequence
+from typing import List, Optional, Iterable, Dict, TYPE_CHECKING
 from dataclasses import dataclass, field
 from pydantic import BaseModel
 
+if TYPE_CHECKING:
+    from providers import SpatialIndex
+
 
 @dataclass
 class Coordinates:
@@ -27,6 +34,28 @@ class SearchConfigModel(BaseModel):
                             nodes_count=self.nodes_count)
 
 
+class RouteVariantModel(BaseModel):
+    distance: float
+    nodes_count: int
+
+
+class BatchSearchConfigModel(BaseModel):
+    latitude: float
+    longitude: float
+    distance: Optional[float]
+    nodes_count: Optional[int]
+    # routes generated for every variant
+    routes_count: int = 1
+    # distance and nodes_count combinations, the ones of the model when empty
+    variants: List[RouteVariantModel] = []
+
+    def construct_search_configs(self, batch_id: str) -> List["SearchConfig"]:
+        variants = self.variants or [RouteVariantModel(distance=self.distance or 0, nodes_count=self.nodes_count or 0)]
+        return [SearchConfig(id=batch_id, latitude=self.latitude, longitude=self.longitude,
+                             distance=variant.distance, nodes_count=variant.nodes_count)
+                for variant in variants for _ in range(self.routes_count)]
+
+
 @dataclass
 class SearchConfig:
     latitude: float
@@ -38,21 +67,151 @@ class SearchConfig:
 
 @dataclass
 class Node:
-    id: str
-    latitude: float = field(default=-1)
-    longitude: float = field(default=-1)
+    __slots__ = ('id', 'latitude', 'longitude')
+
+    id: int
+    latitude: float
+    longitude: float
 
     def __str__(self):
         return f"'{self.latitude},{self.longitude}'"
 
 
+class NodeStore(Sequence):
+    """
+    Columnar storage of nodes: int64 ids and float64 coordinates, Node views are created on demand
+    """
+
+    def __init__(self, ids: array = None, latitudes: array = None, longitudes: array = None):
+        self.ids = ids if ids is not None else array('q')
+        self.latitudes = latitudes if latitudes is not None else array('d')
+        self.longitudes = longitudes if longitudes is not None else array('d')
+        self.__index = None
+        self.__spatial_index = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return Node(self.ids[index], latitude=self.latitudes[index], longitude=self.longitudes[index])
+
+    def __repr__(self):
+        return f"NodeStore({len(self)} nodes)"
+
+    @property
+    def spatial_index(self) -> "SpatialIndex":
+        from providers import SpatialIndex
+
+        spatial_index = self.__spatial_index
+        if spatial_index is None or len(spatial_index) != len(self):
+            spatial_index = self.__spatial_index = SpatialIndex(self)
+        return spatial_index
+
+    def index_of(self, node_id: int) -> Optional[int]:
+        if self.__index is None:
+            self.__index = {node_id: index for index, node_id in enumerate(self.ids)}
+        return self.__index.get(node_id)
+
+    def drop_index(self) -> "NodeStore":
+        """
+        Releases the ids dict, it takes more memory than the columns and is only needed while nodes are added,
+        index_of builds it again when it is called
+        """
+        self.__index = None
+        return self
+
+    def add(self, node_id: int, latitude: float, longitude: float) -> int:
+        index = self.index_of(node_id)
+        if index is None:
+            index = len(self.ids)
+            self.__index[node_id] = index
+            self.ids.append(node_id)
+            self.latitudes.append(latitude)
+            self.longitudes.append(longitude)
+
+        return index
+
+    def extend(self, other: "NodeStore", indexes: Iterable[int] = None) -> Dict[int, int]:
+        """
+        Adds nodes of other store skipping the known ids, returns mapping of other store indexes to this store ones
+        """
+        indexes = range(len(other)) if indexes is None else indexes
+        return {index: self.add(other.ids[index], other.latitudes[index], other.longitudes[index])
+                for index in indexes}
+
+
 @dataclass
 class Way:
-    nodes: List[Node] = field(default_factory=list)
+    store: NodeStore = field(default_factory=NodeStore)
+    nodes_indexes: array = field(default_factory=lambda: array('i'))
+    id: int = field(default=0)
+
+    @property
+    def nodes(self) -> List[Node]:
+        return [self.store[index] for index in self.nodes_indexes]
 
     def find_matching_siblings(self, start_node: Node, min_distance: float) -> List[Node]:
-        from providers import calculate_distance
+        from providers import calculate_distances
+
+        nodes_indexes = np.asarray(self.nodes_indexes)
+        distances = calculate_distances(start_node, np.asarray(self.store.latitudes)[nodes_indexes],
+                                        np.asarray(self.store.longitudes)[nodes_indexes])
+        return [self.store[index] for index in nodes_indexes[distances > min_distance].tolist()]
+
+
+@dataclass
+class ChunkingStats:
+    """
+    Duplication produced by the chunking plan of a search: overlapping chunks cover the same tiles,
+    and responses of neighbour chunks contain the same elements
+    """
+    maximum_chunk_distance: float = 0
+    chunks_count: int = 0
+    chunks_tiles_count: int = 0
+    unique_tiles_count: int = 0
+    received_nodes_count: int = 0
+    unique_nodes_count: int = 0
+    received_ways_count: int = 0
+    unique_ways_count: int = 0
+
+    @property
+    def tiles_duplication(self) -> float:
+        return self.chunks_tiles_count / self.unique_tiles_count - 1 if self.unique_tiles_count else 0
+
+    @property
+    def nodes_duplication(self) -> float:
+        return self.received_nodes_count / self.unique_nodes_count - 1 if self.unique_nodes_count else 0
+
+
+@dataclass
+class RoutePool:
+    """
+    Ranked stop sets of the searches starting in one tile within a distance bucket, every stop set is valid
+    from any point of the tile
+    """
+    tile: str
+    distance: float
+    nodes_count: int
+    stops: List[List[Node]] = field(default_factory=list)
+
+
+@dataclass
+class RouteStops:
+    """
+    Stops chosen by a route engine, starting with the search point, with the work spent choosing them
+    """
+    nodes: List[Node] = field(default_factory=list)
+    # ways, when the stops were found walking a way, or spaced_nodes
+    strategy: str = ''
+    iterations: int = 0
+    elapsed_seconds: float = 0
+    budget_exhausted: bool = False
 
-        return [node for node in self.nodes
-                if calculate_distance((start_node.longitude, start_node.latitude),
-                                      (node.longitude, node.latitude)) > min_distance]
+
+@dataclass
+class BatchRoute:
+    search_config: SearchConfig
+    nodes: List[Node]
+    route_url: str
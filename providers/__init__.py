@@ -1,4 +1,13 @@
-from .formulas_provider import calculate_square, calculate_distance, calculate_squares_chunks, calculate_around_chunks
+from .formulas_provider import calculate_square, calculate_distance, calculate_squares_chunks, \
+    calculate_around_chunks, calculate_distances, calculate_tiles, calculate_tiles_square, \
+    geohash_encode, geohash_bounds, calculate_tiles_rectangles, group_by_tiles, TILE_PRECISION
 from .maps_provider import MapsProviderBase, MapsRequestData, MapsRequestType
+from .request_scheduler import RequestScheduler
 from .osm_provider import OverpassProvider
-from .cache_provider import CacheProvider
+from .local_extract_provider import LocalExtractProvider, build_local_extract
+from .memory_cache import MemoryCache, MemoryCacheStats
+from .route_pool import HotRoutePools, RoutePoolKey, route_pool_key, route_pool_center_radius, ROUTE_POOL_SIZE
+from .cache_provider import CacheProvider, AsyncCacheProvider
+from .session_store import SessionStore
+from .spatial_index import SpatialIndex, SpatialIndexCache
+from .single_flight import SingleFlight
@@ -1,66 +1,402 @@
-from typing import List
+import sys
+import time
+
+from array import array
+from datetime import datetime, timezone
+from typing import List, Dict, Tuple, Optional
 from dataclasses import asdict
 
-from adapters.db_base_adapter import BaseDbAdapter
-from dto import SearchConfig, Node
+from adapters.db_base_adapter import BaseDbAdapter, BaseAsyncDbAdapter, DbWriteOperation, DbOperationType
+from adapters.documents import project_document
+from dto import SearchConfig, Node, NodeStore, Way, RoutePool
+from providers.memory_cache import MemoryCache
+from providers.route_pool import RoutePoolKey
+
+# POIs change slowly, cached tiles are refreshed from the maps provider after a week
+TILES_TTL_SECONDS = 7 * 24 * 3600
+# tiles written in one bulk request, packed tiles are up to a few MB each
+TILES_BATCH_SIZE = 32
+# estimated memory of python objects around the arrays of a cached tile and of a way
+TILE_OVERHEAD_BYTES = 512
+WAY_OVERHEAD_BYTES = 200
+STOP_OVERHEAD_BYTES = 100
 
 
-class CacheProvider:
+class CacheProviderBase:
+    """
+    Memory tier shared by CacheProvider and AsyncCacheProvider, their methods only add the database calls
+    """
 
-    def __init__(self, db_adapter: BaseDbAdapter):
+    def __init__(self, db_adapter, tiles_ttl_seconds: int = TILES_TTL_SECONDS,
+                 tiles_batch_size: int = TILES_BATCH_SIZE, memory_cache: MemoryCache = None,
+                 user_search_ttl_seconds: float = 0):
         self.db_adapter = db_adapter
+        self.tiles_ttl_seconds = tiles_ttl_seconds
+        self.tiles_batch_size = tiles_batch_size
+        # memory tier in front of the database, tiles are kept unpacked
+        self.memory_cache = memory_cache
+        # user searches are kept in memory only when set, their documents are changed by other processes too
+        self.user_search_ttl_seconds = user_search_ttl_seconds
+
+    @property
+    def caches_user_searches(self) -> bool:
+        return bool(self.memory_cache and self.user_search_ttl_seconds)
+
+    def indexes(self) -> List[Tuple[List[str], dict]]:
+        """
+        Returns keys and options of the indexes: user searches by user_id, expiry of tiles leases and of cached
+        tiles, tiles are looked up by their _id
+        """
+        indexes = [(["user_id"], {"partial_filter": {"user_id": {"$exists": True}}}),
+                   # leases of crashed owners are removed when they expire
+                   (["lease_expires_at"], {"expire_after_seconds": 0})]
+        if self.tiles_ttl_seconds:
+            indexes.append((["cached_at"], {"expire_after_seconds": self.tiles_ttl_seconds}))
+        return indexes
+
+    def tiles_batches(self, tiles: Dict[str, Tuple[NodeStore, List[Way]]]) -> List[List[DbWriteOperation]]:
+        # tiles are cached by geohash only, so every search covering the tile can reuse it
+        cached_at = datetime.now(timezone.utc)
+        tiles = list(tiles.items())
+        return [[DbWriteOperation(DbOperationType.REPLACE, {"_id": {"tile": tile}},
+                                  {"_id": {"tile": tile}, "cached_at": cached_at, **pack_tile(nodes, ways)})
+                 for tile, (nodes, ways) in tiles[batch_start:batch_start + self.tiles_batch_size]]
+                for batch_start in range(0, len(tiles), self.tiles_batch_size)]
+
+    def cache_tiles(self, tiles: Dict[str, Tuple[NodeStore, List[Way]]]):
+        if self.memory_cache:
+            for tile, (nodes, ways) in tiles.items():
+                # tile_size counts the columns only, the ids dict would take several times more memory
+                self.memory_cache.put(("tile", tile), (nodes.drop_index(), ways), tile_size(nodes, ways))
+
+    def get_cached_tiles(self, tiles: List[str]) -> Dict[str, Tuple[NodeStore, List[Way]]]:
+        tiles_nodes_ways = {}
+        if self.memory_cache:
+            for tile in tiles:
+                nodes_ways = self.memory_cache.get(("tile", tile))
+                if nodes_ways is not None:
+                    tiles_nodes_ways[tile] = nodes_ways
+
+        return tiles_nodes_ways
+
+    def cache_route_pool(self, pool: RoutePool):
+        if self.memory_cache:
+            self.memory_cache.put(("route_pool", route_pool_key_of(pool)), pool, route_pool_size(pool))
+
+    def get_cached_route_pool(self, key: RoutePoolKey) -> Optional[RoutePool]:
+        return self.memory_cache.get(("route_pool", key)) if self.memory_cache else None
+
+    def get_cached_user_search(self, user_id: str) -> Optional[dict]:
+        return self.memory_cache.get(("user_search", user_id)) if self.caches_user_searches else None
+
+    def cache_user_search(self, user_search: dict):
+        if self.caches_user_searches:
+            self.memory_cache.put(("user_search", user_search["user_id"]), user_search, len(str(user_search)),
+                                  ttl_seconds=self.user_search_ttl_seconds)
+
+    def update_cached_user_search(self, user_id: str, fields: dict):
+        if self.caches_user_searches:
+            user_search = self.memory_cache.peek(("user_search", user_id))
+            if user_search is not None:
+                self.cache_user_search({**user_search, **fields})
+
+
+class CacheProvider(CacheProviderBase):
+    db_adapter: BaseDbAdapter
+
+    def ensure_indexes(self):
+        for keys, options in self.indexes():
+            self.db_adapter.ensure_index(keys, **options)
 
     def save_user_search(self, search_config: SearchConfig):
-        self.db_adapter.remove({"user_id": search_config.id})
-        self.db_adapter.save({"user_id": search_config.id, "search_config": asdict(search_config),
-                              "status": "in_progress", "results": {}})
+        user_search = user_search_document(search_config)
+        self.db_adapter.replace({"user_id": search_config.id}, dict(user_search))
+        self.cache_user_search(user_search)
 
     def update_user_search(self, search_config: SearchConfig):
-        self.db_adapter.update({
-            "user_id": search_config.id
-        }, {
-            "search_config": asdict(search_config)
-        })
-
-    def save_user_search_results(self, user_id: str, result_nodes: List[Node], route: str):
-        self.db_adapter.update({
-            "user_id": user_id
-        }, {
-            "status": "finished",
-            "results": {
-                "nodes": [asdict(node) for node in result_nodes],
-                "route": route
-            }
-        })
-
-    def get_user_search(self, user_id: str = None):
-        return self.db_adapter.select({
-            "user_id": user_id
-        })
-
-    def save_api_responses(self, search_config: SearchConfig, api_responses: list):
-        if api_responses and len(api_responses) > 0:
-            # we can't use unique id because we want to save api responses for general search criteria
-            # we cache response for coordinate and distance without nodes_count
-            search_config_dict = asdict(search_config)
-            try:
-                search_config_dict.pop("id")
-                search_config_dict.pop("nodes_count")
-            except KeyError:
-                pass
-            self.db_adapter.remove({"_id": {"search_config": search_config_dict}})
-            self.db_adapter.save({"_id": {"search_config": search_config_dict},
-                                  "responses": api_responses})
-
-    def get_api_responses(self, search_config: SearchConfig):
-        # we can't use unique id because we want to get api responses for general search criteria
-        # we cache response for coordinate and distance without nodes_count
-        search_config_dict = asdict(search_config)
-        try:
-            search_config_dict.pop("id")
-            search_config_dict.pop("nodes_count")
-        except KeyError:
-            pass
-        return self.db_adapter.select({
-            "_id": {"search_config": search_config_dict}
-        })
+        fields = {"search_config": asdict(search_config)}
+        self.db_adapter.update({"user_id": search_config.id}, fields)
+        self.update_cached_user_search(search_config.id, fields)
+
+    def save_user_search_results(self, user_id: str, result_nodes: List[Node], route: str,
+                                 search_config: SearchConfig = None):
+        results = user_search_results(result_nodes, route, search_config)
+        self.db_adapter.update({"user_id": user_id}, results)
+        self.update_cached_user_search(user_id, results)
+
+    def save_user_search_error(self, user_id: str, error: str):
+        results = {"status": "failed", "error": error}
+        self.db_adapter.update({"user_id": user_id}, results)
+        self.update_cached_user_search(user_id, results)
+
+    def get_user_search(self, user_id: str = None, projection: dict = None):
+        if not self.caches_user_searches:
+            return self.db_adapter.select({"user_id": user_id}, projection=projection)
+
+        user_search = self.get_cached_user_search(user_id)
+        if user_search is None:
+            user_search = self.db_adapter.select({"user_id": user_id})
+            if user_search is None:
+                return None
+            self.cache_user_search(user_search)
+        return project_document(user_search, projection)
+
+    def save_tiles(self, tiles: Dict[str, Tuple[NodeStore, List[Way]]]):
+        for operations in self.tiles_batches(tiles):
+            self.db_adapter.bulk_write(operations)
+        self.cache_tiles(tiles)
+
+    def get_tiles(self, tiles: List[str]) -> Dict[str, Tuple[NodeStore, List[Way]]]:
+        tiles_nodes_ways = self.get_cached_tiles(tiles)
+        tiles = [tile for tile in tiles if tile not in tiles_nodes_ways]
+        if not tiles:
+            return tiles_nodes_ways
+        selected_tiles = unpack_tiles(self.db_adapter.select(tiles_filter(tiles), multiple=True))
+        self.cache_tiles(selected_tiles)
+        tiles_nodes_ways.update(selected_tiles)
+
+        return tiles_nodes_ways
+
+    def save_route_pool(self, pool: RoutePool):
+        # pools are derived from cached tiles, so they expire with them
+        route_pool = route_pool_document(pool)
+        self.db_adapter.replace({"_id": route_pool["_id"]}, route_pool)
+        self.cache_route_pool(pool)
+
+    def get_route_pool(self, key: RoutePoolKey) -> Optional[RoutePool]:
+        pool = self.get_cached_route_pool(key)
+        if pool is None:
+            result = self.db_adapter.select({"_id": route_pool_id(key)})
+            if result is None:
+                return None
+            pool = unpack_route_pool(result)
+            self.cache_route_pool(pool)
+
+        return pool
+
+    def acquire_tiles_leases(self, tiles: List[str], owner: str, lease_seconds: float) -> List[str]:
+        """
+        Returns tiles leased by the owner, the lease is taken when it does not exist or has expired
+        """
+        acquired = self.db_adapter.bulk_write(leases_operations(tiles, owner, lease_seconds))
+        return [tile for tile, tile_acquired in zip(tiles, acquired) if tile_acquired]
+
+    def release_tiles_leases(self, tiles: List[str], owner: str):
+        if tiles:
+            self.db_adapter.remove(leases_filter(tiles, owner))
+
+
+class AsyncCacheProvider(CacheProviderBase):
+    """
+    CacheProvider for asyncio applications, stores the same documents through an async database adapter
+    """
+    db_adapter: BaseAsyncDbAdapter
+
+    async def ensure_indexes(self):
+        for keys, options in self.indexes():
+            await self.db_adapter.ensure_index(keys, **options)
+
+    async def save_user_search(self, search_config: SearchConfig):
+        user_search = user_search_document(search_config)
+        await self.db_adapter.replace({"user_id": search_config.id}, dict(user_search))
+        self.cache_user_search(user_search)
+
+    async def update_user_search(self, search_config: SearchConfig):
+        fields = {"search_config": asdict(search_config)}
+        await self.db_adapter.update({"user_id": search_config.id}, fields)
+        self.update_cached_user_search(search_config.id, fields)
+
+    async def save_user_search_results(self, user_id: str, result_nodes: List[Node], route: str,
+                                       search_config: SearchConfig = None):
+        results = user_search_results(result_nodes, route, search_config)
+        await self.db_adapter.update({"user_id": user_id}, results)
+        self.update_cached_user_search(user_id, results)
+
+    async def save_user_search_error(self, user_id: str, error: str):
+        results = {"status": "failed", "error": error}
+        await self.db_adapter.update({"user_id": user_id}, results)
+        self.update_cached_user_search(user_id, results)
+
+    async def get_user_search(self, user_id: str = None, projection: dict = None):
+        if not self.caches_user_searches:
+            return await self.db_adapter.select({"user_id": user_id}, projection=projection)
+
+        user_search = self.get_cached_user_search(user_id)
+        if user_search is None:
+            user_search = await self.db_adapter.select({"user_id": user_id})
+            if user_search is None:
+                return None
+            self.cache_user_search(user_search)
+        return project_document(user_search, projection)
+
+    async def save_tiles(self, tiles: Dict[str, Tuple[NodeStore, List[Way]]]):
+        for operations in self.tiles_batches(tiles):
+            await self.db_adapter.bulk_write(operations)
+        self.cache_tiles(tiles)
+
+    async def get_tiles(self, tiles: List[str]) -> Dict[str, Tuple[NodeStore, List[Way]]]:
+        tiles_nodes_ways = self.get_cached_tiles(tiles)
+        tiles = [tile for tile in tiles if tile not in tiles_nodes_ways]
+        if not tiles:
+            return tiles_nodes_ways
+        selected_tiles = unpack_tiles(await self.db_adapter.select(tiles_filter(tiles), multiple=True))
+        self.cache_tiles(selected_tiles)
+        tiles_nodes_ways.update(selected_tiles)
+
+        return tiles_nodes_ways
+
+    async def save_route_pool(self, pool: RoutePool):
+        route_pool = route_pool_document(pool)
+        await self.db_adapter.replace({"_id": route_pool["_id"]}, route_pool)
+        self.cache_route_pool(pool)
+
+    async def get_route_pool(self, key: RoutePoolKey) -> Optional[RoutePool]:
+        pool = self.get_cached_route_pool(key)
+        if pool is None:
+            result = await self.db_adapter.select({"_id": route_pool_id(key)})
+            if result is None:
+                return None
+            pool = unpack_route_pool(result)
+            self.cache_route_pool(pool)
+
+        return pool
+
+    async def acquire_tiles_leases(self, tiles: List[str], owner: str, lease_seconds: float) -> List[str]:
+        acquired = await self.db_adapter.bulk_write(leases_operations(tiles, owner, lease_seconds))
+        return [tile for tile, tile_acquired in zip(tiles, acquired) if tile_acquired]
+
+    async def release_tiles_leases(self, tiles: List[str], owner: str):
+        if tiles:
+            await self.db_adapter.remove(leases_filter(tiles, owner))
+
+
+def user_search_document(search_config: SearchConfig) -> dict:
+    return {"user_id": search_config.id, "search_config": asdict(search_config), "status": "in_progress",
+            "results": {}}
+
+
+def user_search_results(result_nodes: List[Node], route: str, search_config: SearchConfig = None) -> dict:
+    results = {
+        "status": "finished",
+        "results": {
+            "nodes": [asdict(node) for node in result_nodes],
+            "route": route
+        }
+    }
+    if search_config:
+        # the final search config is saved with the results, instead of a separate update
+        results["search_config"] = asdict(search_config)
+    return results
+
+
+def tiles_filter(tiles: List[str]) -> dict:
+    return {"_id": {"$in": [{"tile": tile} for tile in tiles]}}
+
+
+def unpack_tiles(results: Optional[List[dict]]) -> Dict[str, Tuple[NodeStore, List[Way]]]:
+    return {result["_id"]["tile"]: unpack_tile(result) for result in results or []}
+
+
+def leases_operations(tiles: List[str], owner: str, lease_seconds: float) -> List[DbWriteOperation]:
+    now = time.time()
+    # the date is removed by the TTL index, the timestamp is compared by the lease upserts
+    lease_expires_at = datetime.fromtimestamp(now + lease_seconds, timezone.utc)
+    return [DbWriteOperation(DbOperationType.UPSERT, {"_id": {"lease": tile}, "expires_at": {"$lt": now}},
+                             {"owner": owner, "expires_at": now + lease_seconds, "lease_expires_at": lease_expires_at})
+            for tile in tiles]
+
+
+def leases_filter(tiles: List[str], owner: str) -> dict:
+    return {"_id": {"$in": [{"lease": tile} for tile in tiles]}, "owner": owner}
+
+
+def route_pool_document(pool: RoutePool) -> dict:
+    return {"_id": route_pool_id(route_pool_key_of(pool)), "cached_at": datetime.now(timezone.utc),
+            **pack_route_pool(pool)}
+
+
+def route_pool_key_of(pool: RoutePool) -> RoutePoolKey:
+    return pool.tile, pool.distance, pool.nodes_count
+
+
+def tile_size(nodes: NodeStore, ways: List[Way]) -> int:
+    size = TILE_OVERHEAD_BYTES + len(nodes) * (nodes.ids.itemsize + nodes.latitudes.itemsize +
+                                               nodes.longitudes.itemsize)
+    for way in ways:
+        size += WAY_OVERHEAD_BYTES + len(way.nodes_indexes) * way.nodes_indexes.itemsize
+
+    return size
+
+
+def pack_tile(nodes: NodeStore, ways: List[Way]) -> dict:
+    # columnar layout: node ids/coordinates and ways as offsets into a flat array of node indexes
+    ways_ids, ways_nodes, ways_offsets = array('q'), array('i'), array('i', [0])
+    for way in ways:
+        ways_ids.append(way.id)
+        ways_nodes.extend(way.nodes_indexes)
+        ways_offsets.append(len(ways_nodes))
+
+    columns = {"ids": nodes.ids, "latitudes": nodes.latitudes, "longitudes": nodes.longitudes,
+               "ways_ids": ways_ids, "ways_nodes": ways_nodes, "ways_offsets": ways_offsets}
+    if sys.byteorder != 'little':
+        columns = {name: array(column.typecode, column) for name, column in columns.items()}
+        for column in columns.values():
+            column.byteswap()
+
+    return {name: column.tobytes() for name, column in columns.items()}
+
+
+def unpack_tile(tile: dict) -> Tuple[NodeStore, List[Way]]:
+    columns = {"ids": array('q'), "latitudes": array('d'), "longitudes": array('d'),
+               "ways_ids": array('q'), "ways_nodes": array('i'), "ways_offsets": array('i')}
+    for name, column in columns.items():
+        column.frombytes(tile.get(name, b''))
+        if sys.byteorder != 'little':
+            column.byteswap()
+
+    nodes = NodeStore(columns["ids"], columns["latitudes"], columns["longitudes"])
+    ways_ids, ways_nodes, ways_offsets = columns["ways_ids"], columns["ways_nodes"], columns["ways_offsets"]
+    ways = [Way(nodes, array('i', ways_nodes[ways_offsets[i]:ways_offsets[i + 1]]),
+                id=ways_ids[i] if i < len(ways_ids) else 0)
+            for i in range(len(ways_offsets) - 1)]
+
+    return nodes, ways
+
+
+def route_pool_id(key: RoutePoolKey) -> dict:
+    tile, distance, nodes_count = key
+    return {"route_pool": tile, "distance": distance, "nodes_count": nodes_count}
+
+
+def route_pool_size(pool: RoutePool) -> int:
+    return TILE_OVERHEAD_BYTES + sum(len(stops) for stops in pool.stops) * STOP_OVERHEAD_BYTES
+
+
+def pack_route_pool(pool: RoutePool) -> dict:
+    # stop sets have the same number of stops, they are stored one after another
+    columns = {"ids": array('q'), "latitudes": array('d'), "longitudes": array('d')}
+    for stops in pool.stops:
+        for node in stops:
+            columns["ids"].append(node.id)
+            columns["latitudes"].append(node.latitude)
+            columns["longitudes"].append(node.longitude)
+    if sys.byteorder != 'little':
+        for column in columns.values():
+            column.byteswap()
+
+    return {"stops_count": len(pool.stops[0]) if pool.stops else 0,
+            **{name: column.tobytes() for name, column in columns.items()}}
+
+
+def unpack_route_pool(route_pool: dict) -> RoutePool:
+    columns = {"ids": array('q'), "latitudes": array('d'), "longitudes": array('d')}
+    for name, column in columns.items():
+        column.frombytes(route_pool.get(name, b''))
+        if sys.byteorder != 'little':
+            column.byteswap()
+
+    nodes = NodeStore(columns["ids"], columns["latitudes"], columns["longitudes"])
+    stops_count = route_pool["stops_count"]
+    pool_id = route_pool["_id"]
+    return RoutePool(pool_id["route_pool"], pool_id["distance"], pool_id["nodes_count"],
+                     [nodes[i:i + stops_count] for i in range(0, len(nodes), stops_count)] if stops_count else [])
@@ -1,18 +1,23 @@
-from math import cos, pi, asin, sqrt
-from typing import Union, List
+import numpy as np
+
+from math import cos, pi, asin, sqrt, radians, floor
+from typing import Union, List, Dict, Iterable, Sequence
 from random import sample
 
 from dto import Coordinates
 
 EARTH_SPHERE_DEGREE = 360
 EARTH_CIRCUMFERENCE = 40057
+EARTH_DIAMETER = 12742
+GEOHASH_ALPHABET = '0123456789bcdefghjkmnpqrstuvwxyz'
+TILE_PRECISION = 4
 
 
 def calculate_center_radius(coordinates: Coordinates, distance: float, count: int, left: bool = True) -> dict:
     result = {}
     last_lon, last_lat = coordinates.longitude, coordinates.latitude
     for i in range(count):
-        lon_distance = abs(2 * distance * (EARTH_SPHERE_DEGREE / (cos(last_lat) * EARTH_CIRCUMFERENCE)))
+        lon_distance = abs(2 * distance * (EARTH_SPHERE_DEGREE / (cos(radians(last_lat)) * EARTH_CIRCUMFERENCE)))
         last_lon = bound_longitude(last_lon - lon_distance) if left else bound_longitude(last_lon + lon_distance)
         coordinates = Coordinates(latitude=last_lat, longitude=last_lon)
         result[coordinates] = distance
@@ -29,9 +34,9 @@ def calculate_square(coordinates: Union[Coordinates, list], distance: float, lef
         longitude, latitude = coordinates.longitude, coordinates.latitude
 
         latitude_distance = abs(maximum_chunk_distance * EARTH_SPHERE_DEGREE / EARTH_CIRCUMFERENCE)
-        longitude_distance_left = abs(distance * (EARTH_SPHERE_DEGREE / (cos(latitude) * EARTH_CIRCUMFERENCE)))
+        longitude_distance_left = abs(distance * (EARTH_SPHERE_DEGREE / (cos(radians(latitude)) * EARTH_CIRCUMFERENCE)))
         longitude_distance_right = abs(
-            maximum_chunk_distance * (EARTH_SPHERE_DEGREE / (cos(latitude) * EARTH_CIRCUMFERENCE)))
+            maximum_chunk_distance * (EARTH_SPHERE_DEGREE / (cos(radians(latitude)) * EARTH_CIRCUMFERENCE)))
 
         result_lon_left = bound_longitude(longitude - longitude_distance_left)
         result_lat_left = bound_latitude(latitude)
@@ -45,7 +50,7 @@ def calculate_square(coordinates: Union[Coordinates, list], distance: float, lef
             coordinates[0].longitude, coordinates[0].latitude, coordinates[1].longitude, coordinates[1].latitude
 
         latitude_distance = abs(distance * EARTH_SPHERE_DEGREE / EARTH_CIRCUMFERENCE)
-        longitude_distance = abs(distance * (EARTH_SPHERE_DEGREE / (cos(lat_top_left) * EARTH_CIRCUMFERENCE)))
+        longitude_distance = abs(distance * (EARTH_SPHERE_DEGREE / (cos(radians(lat_top_left)) * EARTH_CIRCUMFERENCE)))
 
         result_lon_left = bound_longitude(lon_top_left + longitude_distance)
         result_lat_left = bound_latitude(lat_top_left)
@@ -58,7 +63,7 @@ def calculate_square(coordinates: Union[Coordinates, list], distance: float, lef
         longitude, latitude = coordinates.longitude, coordinates.latitude
 
         latitude_distance = abs(distance * EARTH_SPHERE_DEGREE / EARTH_CIRCUMFERENCE)
-        longitude_distance = abs(distance * (EARTH_SPHERE_DEGREE / (cos(latitude) * EARTH_CIRCUMFERENCE)))
+        longitude_distance = abs(distance * (EARTH_SPHERE_DEGREE / (cos(radians(latitude)) * EARTH_CIRCUMFERENCE)))
 
         result_lon_left = bound_longitude(longitude - longitude_distance)
         result_lat_left = bound_latitude(latitude - latitude_distance)
@@ -82,6 +87,18 @@ def calculate_distance(point1: tuple, point2: tuple) -> float:
     return 12742 * asin(sqrt(a))
 
 
+def calculate_distances(origin: Coordinates, latitudes: Sequence[float], longitudes: Sequence[float]) -> np.ndarray:
+    """
+    Vectorized haversine distances in kilometers from the origin to every point
+    """
+    latitudes, longitudes = np.radians(np.asarray(latitudes, dtype=np.float64)), \
+        np.radians(np.asarray(longitudes, dtype=np.float64))
+    origin_latitude, origin_longitude = radians(origin.latitude), radians(origin.longitude)
+    a = np.sin((latitudes - origin_latitude) / 2) ** 2 + \
+        cos(origin_latitude) * np.cos(latitudes) * np.sin((longitudes - origin_longitude) / 2) ** 2
+    return EARTH_DIAMETER * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
 def calculate_squares_chunks(coordinates: Coordinates,
                              distance: float,
                              maximum_chunk_distance: float,
@@ -144,3 +161,134 @@ def bound_latitude(latitude: float) -> float:
         return 180 - abs(latitude)
     else:
         return latitude
+
+
+def geohash_encode(coordinates: Coordinates, precision: int = TILE_PRECISION) -> str:
+    """
+    Taken from https://en.wikipedia.org/wiki/Geohash
+    """
+    latitude_range, longitude_range = [-90.0, 90.0], [-180.0, 180.0]
+    geohash, bits, bits_count, even_bit = [], 0, 0, True
+    while len(geohash) < precision:
+        value, value_range = (coordinates.longitude, longitude_range) if even_bit \
+            else (coordinates.latitude, latitude_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        even_bit = not even_bit
+        bits_count += 1
+        if bits_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits, bits_count = 0, 0
+
+    return ''.join(geohash)
+
+
+def geohash_cell_size(precision: int = TILE_PRECISION) -> tuple:
+    bits = precision * 5
+    latitude_bits, longitude_bits = bits // 2, bits - bits // 2
+    return 180 / (1 << latitude_bits), 360 / (1 << longitude_bits)
+
+
+def geohash_bounds(geohash: str) -> List[Coordinates]:
+    latitude_range, longitude_range = [-90.0, 90.0], [-180.0, 180.0]
+    even_bit = True
+    for char in geohash:
+        bits = GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            value_range = longitude_range if even_bit else latitude_range
+            middle = (value_range[0] + value_range[1]) / 2
+            if (bits >> shift) & 1:
+                value_range[0] = middle
+            else:
+                value_range[1] = middle
+            even_bit = not even_bit
+
+    return [Coordinates(latitude=latitude_range[0], longitude=longitude_range[0]),
+            Coordinates(latitude=latitude_range[1], longitude=longitude_range[1])]
+
+
+def calculate_tiles(square_coordinates: List[Coordinates], precision: int = TILE_PRECISION) -> List[str]:
+    """
+    Returns geohash tiles covering square given by bottom left and top right coordinates
+    """
+    latitude_step, longitude_step = geohash_cell_size(precision)
+    longitude_cells = int(round(360 / longitude_step))
+    bottom_left, top_right = square_coordinates
+
+    bottom = floor((bound_latitude(bottom_left.latitude) + 90) / latitude_step)
+    top = min(floor((bound_latitude(top_right.latitude) + 90) / latitude_step), int(round(180 / latitude_step)) - 1)
+    left = floor((bound_longitude(bottom_left.longitude) + 180) / longitude_step)
+    right = floor((bound_longitude(top_right.longitude) + 180) / longitude_step)
+    if right < left:
+        right += longitude_cells
+
+    tiles = []
+    for latitude_cell in range(bottom, top + 1):
+        for longitude_cell in range(left, right + 1):
+            center = Coordinates(latitude=(latitude_cell + 0.5) * latitude_step - 90,
+                                 longitude=((longitude_cell % longitude_cells) + 0.5) * longitude_step - 180)
+            tiles.append(geohash_encode(center, precision))
+
+    return tiles
+
+
+def calculate_tiles_square(tiles: Iterable[str]) -> List[Coordinates]:
+    bounds = [geohash_bounds(tile) for tile in tiles]
+    return [Coordinates(latitude=min(bottom_left.latitude for bottom_left, _ in bounds),
+                        longitude=min(bottom_left.longitude for bottom_left, _ in bounds)),
+            Coordinates(latitude=max(top_right.latitude for _, top_right in bounds),
+                        longitude=max(top_right.longitude for _, top_right in bounds))]
+
+
+def calculate_tiles_rectangles(tiles: Iterable[str]) -> List[List[str]]:
+    """
+    Splits tiles of the same precision into rectangles made of these tiles only, so the bounding square
+    of every rectangle does not cover other tiles
+    """
+    cells_tiles = {}
+    for tile in tiles:
+        latitude_step, longitude_step = geohash_cell_size(len(tile))
+        bottom_left, _ = geohash_bounds(tile)
+        cells_tiles[(int(round((bottom_left.latitude + 90) / latitude_step)),
+                     int(round((bottom_left.longitude + 180) / longitude_step)))] = tile
+
+    rectangles, covered_cells = [], set()
+    for row, column in sorted(cells_tiles):
+        if (row, column) in covered_cells:
+            continue
+        # the rectangle grows right along the row, then up while whole rows of it are not covered yet
+        right = column
+        while (row, right + 1) in cells_tiles and (row, right + 1) not in covered_cells:
+            right += 1
+        top = row
+        while all((top + 1, cell_column) in cells_tiles and (top + 1, cell_column) not in covered_cells
+                  for cell_column in range(column, right + 1)):
+            top += 1
+        rectangle_cells = [(cell_row, cell_column) for cell_row in range(row, top + 1)
+                           for cell_column in range(column, right + 1)]
+        covered_cells.update(rectangle_cells)
+        rectangles.append([cells_tiles[cell] for cell in rectangle_cells])
+
+    return rectangles
+
+
+def group_by_tiles(latitudes: Sequence[float], longitudes: Sequence[float],
+                   precision: int = TILE_PRECISION) -> Dict[str, List[int]]:
+    """
+    Groups indexes of the coordinates by geohash tiles they belong to
+    """
+    latitude_step, longitude_step = geohash_cell_size(precision)
+    cells_tiles, groups = {}, {}
+    for index, (latitude, longitude) in enumerate(zip(latitudes, longitudes)):
+        cell = (floor((latitude + 90) / latitude_step), floor((longitude + 180) / longitude_step))
+        tile = cells_tiles.get(cell)
+        if tile is None:
+            tile = cells_tiles[cell] = geohash_encode(Coordinates(latitude=latitude, longitude=longitude), precision)
+        groups.setdefault(tile, []).append(index)
+
+    return groups
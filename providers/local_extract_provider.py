@@ -0,0 +1,251 @@
+import sys
+import struct
+import argparse
+import numpy as np
+
+from array import array
+from math import cos, radians, floor
+from typing import List, Tuple, Optional, Union
+
+from providers.maps_provider import MapsProviderBase, MapsRequestData, MapsRequestType
+from providers.osm_parser import OsmElementsParser
+from providers.formulas_provider import calculate_distances, EARTH_SPHERE_DEGREE, EARTH_CIRCUMFERENCE
+from dto import Coordinates, NodeStore
+
+EXTRACT_MAGIC = b'RTPOI001'
+# magic, cell size, nodes count, bounds: south, west, north, east
+EXTRACT_HEADER = struct.Struct('<8sdQdddd')
+EXTRACT_READ_CHUNK_SIZE = 1024 * 1024
+# node filters of the Overpass queries, a node can match both
+POI_TOURISM = 1
+POI_CITY_OR_TOWN = 2
+
+
+class LocalExtractProvider(MapsProviderBase):
+    """
+    Answers requests from a POI file built from a regional OSM extract by build_local_extract. Nodes are
+    sorted by grid cell, so an area is read from the memory mapped file with a few binary searches.
+    Areas outside of the extract bounds are requested from the fallback provider
+    """
+
+    def __init__(self, extract_path: str, fallback: MapsProviderBase = None):
+        self.extract_path = extract_path
+        self.fallback = fallback
+        with open(extract_path, 'rb') as extract_file:
+            magic, self.cell_size, self.nodes_count, *self.bounds = \
+                EXTRACT_HEADER.unpack(extract_file.read(EXTRACT_HEADER.size))
+        if magic != EXTRACT_MAGIC:
+            raise ValueError('{} is not a local extract file'.format(extract_path))
+        self.__columns = int(np.ceil(EARTH_SPHERE_DEGREE / self.cell_size))
+
+        offset = EXTRACT_HEADER.size
+        columns = []
+        for dtype in ('<i8', '<i8', '<f8', '<f8', 'u1'):
+            if self.nodes_count:
+                columns.append(np.memmap(extract_path, dtype=dtype, mode='r', offset=offset,
+                                         shape=(self.nodes_count,)))
+            else:
+                columns.append(np.empty(0, dtype=dtype))
+            offset += np.dtype(dtype).itemsize * self.nodes_count
+        self.__keys, self.ids, self.latitudes, self.longitudes, self.flags = columns
+
+    def get_osm_nodes_ways(self, request_data: MapsRequestData, request_type: MapsRequestType):
+        areas = LocalExtractProvider.__request_areas(request_data, request_type)[:1]
+        if not self.covers(areas[0]) and self.fallback:
+            return self.fallback.get_osm_nodes_ways(request_data, request_type)
+
+        return self.find_nodes_ways(areas[0], request_data.only_cities_and_towns)
+
+    def get_osm_nodes_ways_areas(self, request_data: MapsRequestData, request_type: MapsRequestType) -> list:
+        results, fallback_indexes, fallback_data = self.__find_areas(request_data, request_type)
+        if fallback_indexes:
+            for area_index, result in zip(fallback_indexes,
+                                          self.fallback.get_osm_nodes_ways_areas(fallback_data, request_type)):
+                results[area_index] = result
+
+        return results
+
+    async def get_osm_nodes_ways_async(self, request_data: MapsRequestData, request_type: MapsRequestType):
+        """
+        Returns nodes and ways of every square or point of the request data, in the same order
+        """
+        results, fallback_indexes, fallback_data = self.__find_areas(request_data, request_type)
+        if fallback_indexes:
+            for area_index, result in zip(fallback_indexes,
+                                          await self.fallback.get_osm_nodes_ways_async(fallback_data, request_type)):
+                results[area_index] = result
+
+        return results
+
+    def covers(self, area: tuple) -> bool:
+        south, west, north, east = self.bounds
+        (bottom, left), (top, right) = LocalExtractProvider.__area_bounds(area)
+        return south <= bottom and top <= north and west <= left and right <= east
+
+    def find_nodes_ways(self, area: tuple, only_cities_and_towns: bool = False) -> Tuple[NodeStore, list]:
+        """
+        Returns nodes of the square ([bottom left, top right]) or circle ((center, radius)) area,
+        extracts do not contain ways
+        """
+        if not self.covers(area):
+            raise ValueError('Api call error: area is outside of the local extract {}'.format(self.extract_path))
+        (bottom, left), (top, right) = LocalExtractProvider.__area_bounds(area)
+        candidates = self.__candidates(bottom, left, top, right)
+        latitudes, longitudes = self.latitudes[candidates], self.longitudes[candidates]
+        if isinstance(area[1], Coordinates):
+            mask = (latitudes >= bottom) & (latitudes <= top) & (longitudes >= left) & (longitudes <= right)
+        else:
+            coordinates, radius = area
+            mask = calculate_distances(coordinates, latitudes, longitudes) <= radius
+        mask &= (self.flags[candidates] & (POI_CITY_OR_TOWN if only_cities_and_towns else POI_TOURISM)) > 0
+        candidates = candidates[mask]
+
+        return NodeStore(array('q', self.ids[candidates].tobytes()), array('d', self.latitudes[candidates].tobytes()),
+                         array('d', self.longitudes[candidates].tobytes())), []
+
+    def close(self):
+        if self.fallback and hasattr(self.fallback, 'close'):
+            self.fallback.close()
+
+    async def close_async(self):
+        if self.fallback and hasattr(self.fallback, 'close_async'):
+            await self.fallback.close_async()
+
+    def __candidates(self, bottom: float, left: float, top: float, right: float) -> np.ndarray:
+        left_column = floor((left + 180) / self.cell_size)
+        right_column = min(floor((right + 180) / self.cell_size), self.__columns - 1)
+        slices = []
+        for row in range(floor((bottom + 90) / self.cell_size), floor((top + 90) / self.cell_size) + 1):
+            # keys of one row and columns range are contiguous in the sorted order
+            start = np.searchsorted(self.__keys, row * self.__columns + left_column, side='left')
+            end = np.searchsorted(self.__keys, row * self.__columns + right_column, side='right')
+            if end > start:
+                slices.append(np.arange(start, end))
+
+        return np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
+
+    def __find_areas(self, request_data: MapsRequestData,
+                     request_type: MapsRequestType) -> Tuple[list, List[int], Optional[MapsRequestData]]:
+        """
+        Returns results of the areas covered by the extract, indexes of the other areas and their request data
+        for the fallback provider
+        """
+        areas = LocalExtractProvider.__request_areas(request_data, request_type)
+        results: List[Union[Tuple[NodeStore, list], Exception]] = [None] * len(areas)
+        fallback_indexes = []
+        for area_index, area in enumerate(areas):
+            if self.covers(area) or not self.fallback:
+                try:
+                    results[area_index] = self.find_nodes_ways(area, request_data.only_cities_and_towns)
+                except ValueError as e:
+                    results[area_index] = e
+            else:
+                fallback_indexes.append(area_index)
+
+        if not fallback_indexes:
+            return results, fallback_indexes, None
+        if request_type == MapsRequestType.SQUARE_COORDINATES:
+            fallback_data = MapsRequestData(square_coordinates=[list(areas[i]) for i in fallback_indexes],
+                                            only_cities_and_towns=request_data.only_cities_and_towns)
+        else:
+            fallback_data = MapsRequestData(points_radius={areas[i][0]: areas[i][1] for i in fallback_indexes},
+                                            only_cities_and_towns=request_data.only_cities_and_towns)
+        return results, fallback_indexes, fallback_data
+
+    @staticmethod
+    def __request_areas(request_data: MapsRequestData, request_type: MapsRequestType) -> List[tuple]:
+        if request_type == MapsRequestType.SQUARE_COORDINATES:
+            squares = request_data.square_coordinates
+            if isinstance(squares[0], Coordinates):
+                squares = [squares]
+            return [tuple(square) for square in squares]
+        return list(request_data.points_radius.items())
+
+    @staticmethod
+    def __area_bounds(area: tuple) -> Tuple[Tuple[float, float], Tuple[float, float]]:
+        if isinstance(area[1], Coordinates):
+            bottom_left, top_right = area
+            return (bottom_left.latitude, bottom_left.longitude), (top_right.latitude, top_right.longitude)
+        coordinates, radius = area
+        latitude_distance = radius * EARTH_SPHERE_DEGREE / EARTH_CIRCUMFERENCE
+        max_latitude = min(abs(coordinates.latitude) + latitude_distance, 90)
+        longitude_distance = EARTH_SPHERE_DEGREE if max_latitude >= 89.9 else \
+            latitude_distance / cos(radians(max_latitude))
+        return (coordinates.latitude - latitude_distance, coordinates.longitude - longitude_distance), \
+               (coordinates.latitude + latitude_distance, coordinates.longitude + longitude_distance)
+
+
+def build_local_extract(source_path: str, extract_path: str, cell_size: float = 0.1,
+                        bounds: Optional[Tuple[float, float, float, float]] = None) -> int:
+    """
+    Writes nodes of the source matching Overpass query filters (tourism, or city/town type) to an extract file,
+    sorted by grid cell. Source is an .osm.pbf/.osm file (needs osmium package) or Overpass json dump with tags.
+    Bounds (south, west, north, east) are the area covered by the source, nodes extent is used by default.
+    Returns the number of written nodes
+    """
+    ids, latitudes, longitudes, flags = array('q'), array('d'), array('d'), array('B')
+
+    def add_node(node_id: int, latitude: float, longitude: float, tags):
+        node_flags = (POI_TOURISM if 'tourism' in tags else 0) | \
+            (POI_CITY_OR_TOWN if tags.get('type') in ('city', 'town') else 0)
+        if node_flags:
+            ids.append(node_id)
+            latitudes.append(latitude)
+            longitudes.append(longitude)
+            flags.append(node_flags)
+
+    if source_path.endswith('.json'):
+        def add_element(element: dict):
+            if element.get('type') == 'node':
+                add_node(int(element['id']), float(element['lat']), float(element['lon']), element.get('tags', {}))
+
+        parser = OsmElementsParser(on_element=add_element)
+        with open(source_path, 'rb') as source_file:
+            for chunk in iter(lambda: source_file.read(EXTRACT_READ_CHUNK_SIZE), b''):
+                parser.feed(chunk)
+        parser.close()
+    else:
+        try:
+            import osmium
+        except ImportError:
+            raise ImportError('osmium package is required to read {}, install it with pip install osmium'
+                              .format(source_path))
+
+        class NodesHandler(osmium.SimpleHandler):
+            def node(self, node):
+                if node.location.valid():
+                    add_node(node.id, node.location.lat, node.location.lon, node.tags)
+
+        NodesHandler().apply_file(source_path)
+
+    latitudes_array, longitudes_array = np.frombuffer(latitudes, dtype=np.float64), \
+        np.frombuffer(longitudes, dtype=np.float64)
+    if bounds is None:
+        bounds = (float(latitudes_array.min()), float(longitudes_array.min()),
+                  float(latitudes_array.max()), float(longitudes_array.max())) if len(ids) else (0, 0, 0, 0)
+
+    columns_count = int(np.ceil(EARTH_SPHERE_DEGREE / cell_size))
+    rows = np.floor((latitudes_array + 90) / cell_size).astype(np.int64)
+    columns = np.floor((longitudes_array + 180) / cell_size).astype(np.int64) % columns_count
+    keys = rows * columns_count + columns
+    order = np.argsort(keys, kind='stable')
+
+    with open(extract_path, 'wb') as extract_file:
+        extract_file.write(EXTRACT_HEADER.pack(EXTRACT_MAGIC, cell_size, len(ids), *bounds))
+        for column, dtype in ((keys, '<i8'), (np.frombuffer(ids, dtype=np.int64), '<i8'), (latitudes_array, '<f8'),
+                              (longitudes_array, '<f8'), (np.frombuffer(flags, dtype=np.uint8), 'u1')):
+            extract_file.write(column[order].astype(dtype).tobytes())
+
+    return len(ids)
+
+
+if __name__ == '__main__':
+    arguments_parser = argparse.ArgumentParser(description='Builds local POI extract for LocalExtractProvider')
+    arguments_parser.add_argument('source', help='.osm.pbf, .osm or Overpass .json dump of the region')
+    arguments_parser.add_argument('extract', help='extract file to write')
+    arguments_parser.add_argument('--cell-size', type=float, default=0.1, help='grid cell size in degrees')
+    arguments_parser.add_argument('--bounds', type=lambda value: tuple(float(v) for v in value.split(',')),
+                                  help='south,west,north,east covered by the source')
+    arguments = arguments_parser.parse_args()
+    count = build_local_extract(arguments.source, arguments.extract, arguments.cell_size, arguments.bounds)
+    print('{} nodes written to {}'.format(count, arguments.extract), file=sys.stderr)
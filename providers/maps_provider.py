@@ -27,6 +27,21 @@ class MapsProviderBase(ABC):
         raise NotImplementedError('Method get_osm_nodes_ways must be implemented for MapsProviderBase instance')
 
     @abstractmethod
-    async def get_osm_nodes_ways_async(self, request_data: MapsRequestData, request_type: MapsRequestType,
-                                       requests_interval_seconds: int = 3):
+    async def get_osm_nodes_ways_async(self, request_data: MapsRequestData, request_type: MapsRequestType):
         raise NotImplementedError('Method get_osm_nodes_ways_async must be implemented for MapsProviderBase instance')
+
+    def get_osm_nodes_ways_areas(self, request_data: MapsRequestData, request_type: MapsRequestType) -> list:
+        """
+        Returns a response for every square or point of the request data, like get_osm_nodes_ways_async,
+        providers may merge the areas into fewer requests
+        """
+        if request_type == MapsRequestType.SQUARE_COORDINATES:
+            areas_data = [MapsRequestData(square_coordinates=square_coordinates,
+                                          only_cities_and_towns=request_data.only_cities_and_towns)
+                          for square_coordinates in request_data.square_coordinates]
+        else:
+            areas_data = [MapsRequestData(points_radius={coordinates: radius},
+                                          only_cities_and_towns=request_data.only_cities_and_towns)
+                          for coordinates, radius in request_data.points_radius.items()]
+
+        return [self.get_osm_nodes_ways(area_data, request_type) for area_data in areas_data]
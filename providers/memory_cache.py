@@ -0,0 +1,94 @@
+import time
+import threading
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Hashable, Optional, Any
+
+
+@dataclass
+class MemoryCacheStats:
+    hits: int = 0
+    misses: int = 0
+    # items removed to keep the cache within max_bytes
+    evictions: int = 0
+    expirations: int = 0
+    items_count: int = 0
+    size_bytes: int = 0
+
+    @property
+    def hit_ratio(self) -> float:
+        requests_count = self.hits + self.misses
+        return self.hits / requests_count if requests_count else 0
+
+
+class MemoryCache:
+    """
+    In-process LRU cache bounded by the estimated size of its values in bytes, items expire after their TTL
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, ttl_seconds: float = 600):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.__items = OrderedDict()
+        self.__size_bytes = 0
+        self.__stats = MemoryCacheStats()
+        self.__lock = threading.Lock()
+
+    @property
+    def stats(self) -> MemoryCacheStats:
+        with self.__lock:
+            return MemoryCacheStats(hits=self.__stats.hits, misses=self.__stats.misses,
+                                    evictions=self.__stats.evictions, expirations=self.__stats.expirations,
+                                    items_count=len(self.__items), size_bytes=self.__size_bytes)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.__lock:
+            item = self.__items.get(key)
+            if item is None:
+                self.__stats.misses += 1
+                return None
+            expires_at, size, value = item
+            if time.monotonic() > expires_at:
+                self.__remove(key)
+                self.__stats.expirations += 1
+                self.__stats.misses += 1
+                return None
+            self.__items.move_to_end(key)
+            self.__stats.hits += 1
+            return value
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """
+        Returns the value without counting the access and without refreshing its position in the LRU order
+        """
+        with self.__lock:
+            item = self.__items.get(key)
+            if item is None or time.monotonic() > item[0]:
+                return None
+            return item[2]
+
+    def put(self, key: Hashable, value: Any, size: int, ttl_seconds: float = None):
+        """
+        Stores the value with its estimated size in bytes, values larger than the whole cache are not stored
+        """
+        with self.__lock:
+            if key in self.__items:
+                self.__remove(key)
+            if size > self.max_bytes:
+                return
+            expires_at = time.monotonic() + (ttl_seconds if ttl_seconds is not None else self.ttl_seconds)
+            self.__items[key] = (expires_at, size, value)
+            self.__size_bytes += size
+            while self.__size_bytes > self.max_bytes:
+                self.__remove(next(iter(self.__items)))
+                self.__stats.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        with self.__lock:
+            if key in self.__items:
+                self.__remove(key)
+
+    def __remove(self, key: Hashable):
+        _, size, _ = self.__items.pop(key)
+        self.__size_bytes -= size
@@ -0,0 +1,104 @@
+import re
+import codecs
+
+from json import JSONDecoder, JSONDecodeError
+from typing import Iterable, AsyncIterable, Tuple, List, Callable
+
+from dto import NodeStore, Way
+
+ELEMENTS_START = re.compile(r'"elements"\s*:\s*\[')
+ELEMENT_SEPARATOR = re.compile(r'[\s,]*')
+
+
+class OsmElementsParser:
+    """
+    Incremental parser of the Overpass json `elements` array, so the response body is never kept in memory at once
+    """
+
+    def __init__(self, store: NodeStore = None, on_element: Callable[[dict], None] = None):
+        self.store = store if store is not None else NodeStore()
+        self.ways = []
+        # elements are passed to on_element instead of being stored when it is set, e.g. to read their tags
+        self.on_element = on_element
+        self.__decoder = JSONDecoder()
+        self.__text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.__buffer = ''
+        self.__head = ''
+        self.__in_elements = False
+        self.__finished = False
+
+    def feed(self, chunk: bytes):
+        self.__buffer += self.__text_decoder.decode(chunk)
+        self.__parse()
+
+    def close(self):
+        self.__buffer += self.__text_decoder.decode(b'', final=True)
+        self.__parse()
+        if not self.__in_elements:
+            raise ValueError('Api call error: {}'.format(self.__head + self.__buffer))
+        if not self.__finished and self.__buffer.strip():
+            raise ValueError('Api call error: truncated response')
+        # ways are resolved, parsed nodes are not looked up by id anymore
+        self.store.drop_index()
+
+    def __parse(self):
+        if not self.__in_elements:
+            match = ELEMENTS_START.search(self.__buffer)
+            if not match:
+                # keep the beginning of the body for error messages, the tail may contain the elements key
+                self.__head += self.__buffer[:-32]
+                self.__head = self.__head[:1024]
+                self.__buffer = self.__buffer[-32:]
+                return
+            self.__in_elements = True
+            self.__buffer = self.__buffer[match.end():]
+
+        position = 0
+        while not self.__finished:
+            position = ELEMENT_SEPARATOR.match(self.__buffer, position).end()
+            if position == len(self.__buffer):
+                break
+            if self.__buffer[position] == ']':
+                self.__finished = True
+                break
+            try:
+                element, position_end = self.__decoder.raw_decode(self.__buffer, position)
+            except JSONDecodeError:
+                # element is not received completely yet
+                break
+            position = position_end
+            if self.on_element:
+                self.on_element(element)
+            else:
+                self.__add_element(element)
+        self.__buffer = '' if self.__finished else self.__buffer[position:]
+
+    def __add_element(self, element: dict):
+        if element.get('type') == 'node':
+            self.store.add(int(element.get('id')), float(element.get('lat')), float(element.get('lon')))
+        elif element.get('type') == 'way':
+            way = Way(self.store, id=int(element.get('id', 0)))
+            for node_id in element.get('nodes'):
+                node_index = self.store.index_of(int(node_id))
+                if node_index is not None:
+                    way.nodes_indexes.append(node_index)
+            self.ways.append(way)
+
+
+def parse_osm_elements(chunks: Iterable[bytes]) -> Tuple[NodeStore, List[Way]]:
+    parser = OsmElementsParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+
+    return parser.store, parser.ways
+
+
+async def parse_osm_elements_async(chunks: AsyncIterable[bytes]) -> Tuple[NodeStore, List[Way]]:
+    parser = OsmElementsParser()
+    async for chunk in chunks:
+        parser.feed(chunk)
+    parser.close()
+
+    return parser.store, parser.ways
+
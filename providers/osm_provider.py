@@ -1,91 +1,260 @@
+import time
+import logging
 import requests
 import asyncio
+import threading
 
-from aiohttp import ClientSession
-from typing import List
+from aiohttp import ClientSession, ClientError, ClientTimeout, TCPConnector
+from requests.adapters import HTTPAdapter
+from weakref import WeakKeyDictionary
+from math import pi, cos, radians
+from typing import List, Tuple
 
 from providers import MapsProviderBase, MapsRequestData, MapsRequestType
+from providers.osm_parser import parse_osm_elements, parse_osm_elements_async
+from providers.request_scheduler import RequestScheduler, retry_after
+from providers.formulas_provider import EARTH_CIRCUMFERENCE, EARTH_SPHERE_DEGREE
 from dto import Coordinates
 
+OSM_STREAM_CHUNK_SIZE = 64 * 1024
+RETRY_STATUSES = (429, 503, 504)
+REQUEST_HEADERS = {"Content-Type": "application/x-www-form-urlencoded"}
+OVERPASS_MAXSIZE = 200370824
+OVERPASS_TIMEOUT = 60
+OVERPASS_MAX_TIMEOUT = 180
+
+logger = logging.getLogger(__name__)
+
 
 class OverpassProvider(MapsProviderBase):
 
-    def __init__(self, base_url: str = "https://overpass-api.de/api/interpreter"):
+    def __init__(self, base_url: str = "https://overpass-api.de/api/interpreter", stream_responses: bool = True,
+                 scheduler: RequestScheduler = None, max_retries: int = 3, status_url: str = None,
+                 pool_size: int = 10, keepalive_timeout: float = 60, request_timeout: float = 240,
+                 max_union_areas: int = 8, estimated_bytes_per_km2: float = 2000, maxsize_usage: float = 0.5):
         self.base_url = base_url
+        self.stream_responses = stream_responses
+        self.scheduler = scheduler or RequestScheduler()
+        self.max_retries = max_retries
+        self.status_url = status_url or (base_url.rsplit('/', 1)[0] + '/status'
+                                         if base_url.endswith('/interpreter') else None)
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        # union queries are planned with an estimation of response size per area, so they fit into maxsize
+        self.max_union_areas = max_union_areas
+        self.estimated_bytes_per_km2 = estimated_bytes_per_km2
+        self.maxsize_usage = maxsize_usage
+        self.__session = None
+        self.__async_sessions = WeakKeyDictionary()
+        self.__lock = threading.Lock()
+
+    @property
+    def session(self) -> requests.Session:
+        with self.__lock:
+            if self.__session is None:
+                self.__session = requests.Session()
+                self.__session.headers.update(REQUEST_HEADERS)
+                self.__session.mount(self.base_url, HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+            return self.__session
+
+    def get_async_session(self) -> ClientSession:
+        """
+        Returns pooled session of the running event loop, aiohttp sessions can not be shared between loops
+        """
+        loop = asyncio.get_event_loop()
+        with self.__lock:
+            session = self.__async_sessions.get(loop)
+            if session is None or session.closed:
+                session = self.__async_sessions[loop] = ClientSession(
+                    headers=REQUEST_HEADERS,
+                    connector=TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout),
+                    timeout=ClientTimeout(total=self.request_timeout))
+            return session
+
+    def close(self):
+        """
+        Closes sync session and async sessions of the event loops which are not running
+        """
+        with self.__lock:
+            session, self.__session = self.__session, None
+            async_sessions = list(self.__async_sessions.items())
+        if session is not None:
+            session.close()
+        for loop, async_session in async_sessions:
+            if not async_session.closed and not loop.is_closed() and not loop.is_running():
+                loop.run_until_complete(async_session.close())
+
+    async def close_async(self):
+        """
+        Closes async session of the running event loop, to be called from the application shutdown hook
+        """
+        with self.__lock:
+            session = self.__async_sessions.pop(asyncio.get_event_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
 
     def get_osm_nodes_ways(self, request_data: MapsRequestData, request_type: MapsRequestType):
-        response = requests.get(self.base_url, stream=True,
-                                raw=f'data={OverpassProvider.__create_request_data(request_type, request_data)}',
-                                headers={'Content-Type': 'application/x-www-form-urlencoded'})
-        return response
-
-    async def get_osm_nodes_ways_async(self, request_data: MapsRequestData,
-                                       request_type: MapsRequestType,
-                                       requests_interval_seconds: int = 2):
-        tasks = []
-
-        async with ClientSession() as session:
-            if request_type == MapsRequestType.SQUARE_COORDINATES:
-                for squares_coordinate in request_data.square_coordinates:
-                    task = asyncio.ensure_future(self.__fetch_nodes_ways(
-                        session, OverpassProvider.__create_request_data(request_type,
-                                                                        square_coordinates=squares_coordinate)))
-                    tasks.append(task)
-                    await asyncio.sleep(requests_interval_seconds)
-            elif request_type == MapsRequestType.AROUND_POINT:
-                for point_radius in request_data.points_radius.items():
-                    task = asyncio.ensure_future(self.__fetch_nodes_ways(
-                        session, OverpassProvider.__create_request_data(request_type,
-                                                                        points_radius=point_radius)
-                    ))
-                    tasks.append(task)
-                    await asyncio.sleep(requests_interval_seconds)
-
-            responses = await asyncio.gather(*tasks)
-
-        return responses
+        self.__update_status_sync()
+        return self.__request(f'data={OverpassProvider.__create_request_data(request_type, request_data)}')
+
+    def get_osm_nodes_ways_areas(self, request_data: MapsRequestData, request_type: MapsRequestType) -> list:
+        """
+        get_osm_nodes_ways_async for sync callers, union queries are requested one after another
+        """
+        requests_plan = self.plan_requests(request_data, request_type)
+        self.__update_status_sync()
+        responses = []
+        for data, _ in requests_plan:
+            try:
+                responses.append(self.__fetch_nodes_ways_sync(data))
+            except (requests.RequestException, ValueError) as e:
+                responses.append(e)
+
+        return OverpassProvider.__areas_responses(requests_plan, responses)
+
+    async def get_osm_nodes_ways_async(self, request_data: MapsRequestData, request_type: MapsRequestType):
+        """
+        Returns a response for every square or point of the request data, areas merged into one union query
+        share the same response
+        """
+        requests_plan = self.plan_requests(request_data, request_type)
+
+        session = self.get_async_session()
+        await self.__update_status(session)
+        # requests are started as soon as the scheduler allows, instead of a fixed interval between them
+        responses = await asyncio.gather(*[self.__fetch_nodes_ways(session, data) for data, _ in requests_plan],
+                                         return_exceptions=True)
+
+        return OverpassProvider.__areas_responses(requests_plan, responses)
+
+    def plan_requests(self, request_data: MapsRequestData,
+                      request_type: MapsRequestType) -> List[Tuple[str, List[int]]]:
+        """
+        Merges areas of the request data into union queries, each one is estimated to fit into Overpass maxsize.
+        Returns request data of every query with indexes of the areas it covers. Areas are not deduplicated,
+        callers request areas which do not overlap
+        """
+        if request_type == MapsRequestType.SQUARE_COORDINATES:
+            areas = [(OverpassProvider.__square_selector(square_coordinates),
+                      OverpassProvider.__square_area(square_coordinates))
+                     for square_coordinates in request_data.square_coordinates]
+        else:
+            areas = [(OverpassProvider.__around_selector(coordinates, radius), pi * radius ** 2)
+                     for coordinates, radius in request_data.points_radius.items()]
+
+        max_query_area = OVERPASS_MAXSIZE * self.maxsize_usage / self.estimated_bytes_per_km2
+        requests_plan, selectors, areas_indexes, query_area = [], [], [], 0
+        for area_index, (selector, area) in enumerate(areas):
+            if selectors and (query_area + area > max_query_area or len(selectors) >= self.max_union_areas):
+                requests_plan.append((selectors, areas_indexes))
+                selectors, areas_indexes, query_area = [], [], 0
+            selectors.append(selector)
+            areas_indexes.append(area_index)
+            query_area += area
+        if selectors:
+            requests_plan.append((selectors, areas_indexes))
+
+        return [(OverpassProvider.__create_union_request_data(selectors, request_data.only_cities_and_towns),
+                 areas_indexes) for selectors, areas_indexes in requests_plan]
 
     @staticmethod
     def __create_request_data(request_type: MapsRequestType, request_data: MapsRequestData = None,
                               square_coordinates: List[Coordinates] = None, points_radius: tuple = None,
                               is_only_cities_and_towns: bool = False):
-        data = ''
         only_cities_and_towns = request_data.only_cities_and_towns if request_data else is_only_cities_and_towns
         if request_type == MapsRequestType.SQUARE_COORDINATES:
             square_coordinates: List[Coordinates] = request_data.square_coordinates if request_data \
                 else square_coordinates
-            if only_cities_and_towns:
-                data = ''.format('[out:json][timeout:60][maxsize:200370824];'
-                                 '(node["type"="town"]({0},{1},{2},{3});'
-                                 'node["type"="city"]({0},{1},{2},{3});'
-                                 ');(._;>;);out;',
-                                 square_coordinates[0].latitude, square_coordinates[0].longitude,
-                                 square_coordinates[1].latitude, square_coordinates[1].longitude
-                                 )
-            else:
-                data = ''.format('[out:json][timeout:60][maxsize:200370824];'
-                                 '(node["type"="town"]({0},{1},{2},{3});'
-                                 'node["type"="city"]({0},{1},{2},{3});'
-                                 'node["amenity"="arts_centre"]({0},{1},{2},{3});'
-                                 'node["amenity"="place_of_worship"]({0},{1},{2},{3});'
-                                 ');(._;>;);out;',
-                                 square_coordinates[0].latitude, square_coordinates[0].longitude,
-                                 square_coordinates[1].latitude, square_coordinates[1].longitude
-                                 )
-        elif request_type == MapsRequestType.AROUND_POINT:
-            coordinates, radius = request_data.points_radius.popitem() if request_data else points_radius
-            if only_cities_and_towns:
-                data = '[out:json][timeout:60][maxsize:200370824];' \
-                       '(node(around:{0},{1},{2})["type"="city"]; node(around:{0},{1},{2})["type"="town"]);(._;>;);out;' \
-                    .format(radius * 1000, coordinates.latitude, coordinates.longitude)
-            else:
-                data = '[out:json][timeout:60][maxsize:200370824];' \
-                       'node(around:{0},{1},{2})["tourism"];out;'.format(radius * 1000, coordinates.latitude,
-                                                                         coordinates.longitude)
-
-        return data
-
-    async def __fetch_nodes_ways(self, session, request_data):
-        session.headers.update({"Content-Type": "application/x-www-form-urlencoded"})
-        async with session.get(self.base_url, data=request_data) as response:
-            return await response.content.read()
+            selector = OverpassProvider.__square_selector(square_coordinates)
+        else:
+            coordinates, radius = next(iter(request_data.points_radius.items())) if request_data else points_radius
+            selector = OverpassProvider.__around_selector(coordinates, radius)
+
+        return OverpassProvider.__create_union_request_data([selector], only_cities_and_towns)
+
+    @staticmethod
+    def __create_union_request_data(selectors: List[str], only_cities_and_towns: bool = False) -> str:
+        timeout = min(OVERPASS_TIMEOUT * len(selectors), OVERPASS_MAX_TIMEOUT)
+        if only_cities_and_towns:
+            statements = ''.join('node{0}["type"="city"];node{0}["type"="town"];'.format(selector)
+                                 for selector in selectors)
+            return f'[out:json][timeout:{timeout}][maxsize:{OVERPASS_MAXSIZE}];({statements});(._;>;);out;'
+        statements = ''.join('node{0}["tourism"];'.format(selector) for selector in selectors)
+        return f'[out:json][timeout:{timeout}][maxsize:{OVERPASS_MAXSIZE}];({statements});out;'
+
+    @staticmethod
+    def __square_selector(square_coordinates: List[Coordinates]) -> str:
+        return '({0},{1},{2},{3})'.format(square_coordinates[0].latitude, square_coordinates[0].longitude,
+                                          square_coordinates[1].latitude, square_coordinates[1].longitude)
+
+    @staticmethod
+    def __around_selector(coordinates: Coordinates, radius: float) -> str:
+        return '(around:{0},{1},{2})'.format(radius * 1000, coordinates.latitude, coordinates.longitude)
+
+    @staticmethod
+    def __square_area(square_coordinates: List[Coordinates]) -> float:
+        bottom_left, top_right = square_coordinates
+        kilometers_per_degree = EARTH_CIRCUMFERENCE / EARTH_SPHERE_DEGREE
+        latitude_distance = abs(top_right.latitude - bottom_left.latitude) * kilometers_per_degree
+        longitude_distance = abs(top_right.longitude - bottom_left.longitude) * kilometers_per_degree * \
+            cos(radians((top_right.latitude + bottom_left.latitude) / 2))
+        return latitude_distance * longitude_distance
+
+    @staticmethod
+    def __areas_responses(requests_plan: List[Tuple[str, List[int]]], responses: list) -> list:
+        areas_responses = [None] * sum(len(areas_indexes) for _, areas_indexes in requests_plan)
+        for (_, areas_indexes), response in zip(requests_plan, responses):
+            for area_index in areas_indexes:
+                areas_responses[area_index] = response
+        return areas_responses
+
+    def __request(self, request_data: str) -> requests.Response:
+        for attempt in range(self.max_retries + 1):
+            time.sleep(self.scheduler.reserve())
+            response = self.session.get(self.base_url, data=request_data, stream=True, timeout=self.request_timeout)
+            if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                return response
+            response.close()
+            self.scheduler.pause(retry_after(response.headers, attempt))
+
+    def __fetch_nodes_ways_sync(self, request_data: str):
+        with self.__request(f'data={request_data}') as response:
+            if not self.stream_responses:
+                return response.content
+            if response.status_code != 200:
+                raise ValueError('Api call error: {}'.format(response.text))
+            # responses are parsed before the next query, so their connections go back to the pool
+            return parse_osm_elements(response.iter_content(chunk_size=OSM_STREAM_CHUNK_SIZE))
+
+    def __update_status_sync(self):
+        if not self.status_url:
+            return
+        try:
+            with self.session.get(self.status_url, timeout=self.request_timeout) as response:
+                self.scheduler.update_status(response.text)
+        except requests.RequestException as e:
+            logger.warning('Could not get Overpass status: %s', str(e))
+
+    async def __update_status(self, session: ClientSession):
+        if not self.status_url:
+            return
+        try:
+            async with session.get(self.status_url) as response:
+                self.scheduler.update_status(await response.text())
+        except (ClientError, asyncio.TimeoutError) as e:
+            logger.warning('Could not get Overpass status: %s', str(e))
+
+    async def __fetch_nodes_ways(self, session: ClientSession, request_data: str):
+        for attempt in range(self.max_retries + 1):
+            async with self.scheduler.slot():
+                async with session.get(self.base_url, data=request_data) as response:
+                    if response.status in RETRY_STATUSES and attempt < self.max_retries:
+                        self.scheduler.pause(retry_after(response.headers, attempt))
+                        continue
+                    if not self.stream_responses:
+                        return await response.content.read()
+                    if response.status != 200:
+                        raise ValueError('Api call error: {}'.format(await response.text()))
+                    # elements are parsed while the body is being received, so only parsed nodes and ways are kept
+                    return await parse_osm_elements_async(response.content.iter_chunked(OSM_STREAM_CHUNK_SIZE))
@@ -0,0 +1,75 @@
+import re
+import time
+import asyncio
+import threading
+
+from contextlib import asynccontextmanager
+from weakref import WeakKeyDictionary
+from typing import Mapping, Optional
+
+RATE_LIMIT_PATTERN = re.compile(r'Rate limit:\s*(\d+)')
+SLOTS_AVAILABLE_PATTERN = re.compile(r'(\d+)\s+slots? available now')
+SLOT_WAIT_PATTERN = re.compile(r'Slot available after:.*?in\s+(-?\d+)\s+seconds')
+
+
+class RequestScheduler:
+    """
+    Limits requests sent to a maps server: at most max_in_flight concurrent requests per event loop and
+    requests_per_second started requests (with burst) shared by all threads, server back off pauses everything
+    """
+
+    def __init__(self, max_in_flight: int = 2, requests_per_second: float = 2, burst: int = 2):
+        self.max_in_flight = max_in_flight
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.__lock = threading.Lock()
+        self.__next_start = 0.0
+        self.__paused_until = 0.0
+        self.__semaphores = WeakKeyDictionary()
+
+    def reserve(self) -> float:
+        """
+        Reserves a start time for the next request and returns how many seconds the caller has to wait for it
+        """
+        interval = 1 / self.requests_per_second if self.requests_per_second > 0 else 0
+        with self.__lock:
+            now = time.monotonic()
+            next_start = max(self.__next_start, now)
+            start = max(now, next_start - (self.burst - 1) * interval, self.__paused_until)
+            self.__next_start = max(next_start, start) + interval
+
+        return start - now
+
+    def pause(self, seconds: float):
+        with self.__lock:
+            self.__paused_until = max(self.__paused_until, time.monotonic() + seconds)
+
+    def update_status(self, status: str):
+        """
+        Applies Overpass /api/status text: waits for the next slot when none of them is available now
+        """
+        rate_limit = RATE_LIMIT_PATTERN.search(status)
+        slots_available = SLOTS_AVAILABLE_PATTERN.search(status)
+        if not rate_limit or int(rate_limit.group(1)) == 0 or slots_available:
+            return
+        waits = [int(wait) for wait in SLOT_WAIT_PATTERN.findall(status)]
+        if waits:
+            self.pause(max(min(waits), 0))
+
+    @asynccontextmanager
+    async def slot(self):
+        loop = asyncio.get_event_loop()
+        semaphore = self.__semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self.__semaphores[loop] = asyncio.Semaphore(self.max_in_flight)
+        async with semaphore:
+            await asyncio.sleep(self.reserve())
+            yield
+
+
+def retry_after(headers: Mapping[str, str], attempt: int) -> float:
+    value: Optional[str] = headers.get('Retry-After')
+    try:
+        return max(float(value), 0)
+    except (TypeError, ValueError):
+        return float(2 ** attempt)
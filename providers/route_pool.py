@@ -0,0 +1,68 @@
+import threading
+
+from collections import Counter
+from math import floor
+from typing import List, Tuple, Optional
+
+from dto import Coordinates, SearchConfig
+from providers.formulas_provider import geohash_encode, geohash_bounds, calculate_distances
+
+# ~5x5 km tiles, stop sets are shrunk by the tile radius so they are valid from any point of the tile
+ROUTE_POOL_PRECISION = 5
+# searches of 50-54 km share the pool of the 50 km bucket
+ROUTE_POOL_DISTANCE_STEP = 5
+ROUTE_POOL_SIZE = 64
+
+RoutePoolKey = Tuple[str, int, int]
+
+
+def route_pool_key(search_config: SearchConfig) -> Optional[RoutePoolKey]:
+    """
+    Returns tile, distance bucket and nodes count of the search, searches shorter than one bucket are not pooled
+    """
+    distance = floor(search_config.distance / ROUTE_POOL_DISTANCE_STEP) * ROUTE_POOL_DISTANCE_STEP
+    if distance <= 0:
+        return None
+    coordinates = Coordinates(latitude=search_config.latitude, longitude=search_config.longitude)
+    return geohash_encode(coordinates, ROUTE_POOL_PRECISION), distance, search_config.nodes_count or 3
+
+
+def route_pool_center_radius(tile: str) -> Tuple[Coordinates, float]:
+    """
+    Returns center of the tile and the distance from it to the farthest point of the tile
+    """
+    bottom_left, top_right = geohash_bounds(tile)
+    center = Coordinates(latitude=(bottom_left.latitude + top_right.latitude) / 2,
+                         longitude=(bottom_left.longitude + top_right.longitude) / 2)
+    # the bottom corners are farther from the center in the northern hemisphere and the top ones in the southern
+    corners_latitudes = [bottom_left.latitude, bottom_left.latitude, top_right.latitude, top_right.latitude]
+    corners_longitudes = [bottom_left.longitude, top_right.longitude, bottom_left.longitude, top_right.longitude]
+    radius = float(calculate_distances(center, corners_latitudes, corners_longitudes).max())
+
+    return center, radius
+
+
+class HotRoutePools:
+    """
+    Counts searches of every route pool key in the process, the most searched keys are precomputed
+    """
+
+    def __init__(self):
+        self.__counter = Counter()
+        self.__lock = threading.Lock()
+
+    def record(self, key: RoutePoolKey):
+        with self.__lock:
+            self.__counter[key] += 1
+
+    def hot_keys(self, count: int, min_searches: int = 2) -> List[RoutePoolKey]:
+        """
+        Returns up to count most searched keys and halves the counters, so the keys which are not searched
+        anymore cool down
+        """
+        with self.__lock:
+            keys = [key for key, searches in self.__counter.most_common(count) if searches >= min_searches]
+            self.__counter = Counter({key: searches // 2 for key, searches in self.__counter.items()
+                                      if searches > 1})
+
+        return keys
@@ -0,0 +1,124 @@
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from functools import partial
+from typing import Optional, Dict, Tuple
+
+from dto import SearchConfig
+from providers.cache_provider import CacheProvider
+
+logger = logging.getLogger(__name__)
+
+
+class SessionStore:
+    """
+    In-progress searches of the bot users kept in memory, least recently used ones are evicted over max_sessions
+    or after ttl_seconds. Searches are written to the database in the background (write-behind), only when they
+    are finished or evicted, so interactions do not wait for the database
+    """
+
+    def __init__(self, cache_provider: CacheProvider, max_sessions: int = 10000, ttl_seconds: float = 3600):
+        self.cache_provider = cache_provider
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.__sessions = OrderedDict()
+        # evicted searches until they are written, the database does not have them yet
+        self.__evicted: Dict[str, Tuple[Future, SearchConfig]] = {}
+        # reentrant, a write may be done by the time its callback is added under the lock
+        self.__lock = threading.RLock()
+        # one writer keeps the writes of a user in order
+        self.__writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='session-writer')
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__sessions)
+
+    def get(self, user_id: str) -> Optional[SearchConfig]:
+        """
+        Returns the search of the user, searches which are not in memory anymore are read from the database
+        """
+        with self.__lock:
+            session = self.__sessions.get(user_id)
+            if session is not None:
+                expires_at, search_config, _ = session
+                if time.monotonic() <= expires_at:
+                    self.__sessions.move_to_end(user_id)
+                    return search_config
+                self.__evict(user_id)
+            evicted = self.__evicted.get(user_id)
+            if evicted is not None:
+                # the database does not have it until the write is done, it is kept unwritten in case the write fails
+                self.put(evicted[1])
+                return evicted[1]
+
+        user_search = self.cache_provider.get_user_search(user_id, projection={"search_config": 1})
+        if not user_search or not user_search.get('search_config'):
+            return None
+        search_config = SearchConfig(**user_search['search_config'])
+        self.put(search_config, written=True)
+
+        return search_config
+
+    def put(self, search_config: SearchConfig, written: bool = False):
+        """
+        Keeps the search in memory, it is written on eviction unless it is already written
+        """
+        with self.__lock:
+            self.__sessions.pop(search_config.id, None)
+            # the search in memory is newer than the one being written
+            self.__evicted.pop(search_config.id, None)
+            self.__sessions[search_config.id] = (time.monotonic() + self.ttl_seconds, search_config, written)
+            now = time.monotonic()
+            while self.__sessions:
+                user_id, (expires_at, _, _) = next(iter(self.__sessions.items()))
+                if len(self.__sessions) <= self.max_sessions and expires_at >= now:
+                    break
+                self.__evict(user_id)
+
+    def finish(self, search_config: SearchConfig) -> Future:
+        """
+        Writes the finished search, the returned future is done when it is written. The search stays in memory,
+        so it is not written again on eviction, which would replace its results
+        """
+        self.put(search_config, written=True)
+        return self.__writer.submit(self.cache_provider.save_user_search, search_config)
+
+    def close(self):
+        """
+        Writes the searches which are still in memory and waits for the writes, failed writes are tried once more
+        """
+        with self.__lock:
+            for user_id in list(self.__sessions):
+                self.__evict(user_id)
+            futures = [future for future, _ in self.__evicted.values()]
+        wait(futures)
+        with self.__lock:
+            for user_id, (future, search_config) in list(self.__evicted.items()):
+                if future.exception() is not None:
+                    self.__write(user_id, search_config)
+        self.__writer.shutdown(wait=True)
+
+    def __evict(self, user_id: str):
+        _, search_config, written = self.__sessions.pop(user_id)
+        if not written:
+            self.__write(user_id, search_config)
+
+    def __write(self, user_id: str, search_config: SearchConfig):
+        future = self.__writer.submit(self.cache_provider.save_user_search, search_config)
+        self.__evicted[user_id] = (future, search_config)
+        future.add_done_callback(partial(self.__written, user_id))
+
+    def __written(self, user_id: str, future: Future):
+        with self.__lock:
+            # a search which could not be written is kept, get returns it and it is written again on eviction
+            if future.exception() is None and self.__evicted.get(user_id, (None,))[0] is future:
+                del self.__evicted[user_id]
+        log_write_error(future)
+
+
+def log_write_error(future: Future):
+    if future.exception() is not None:
+        logger.error('Could not write session: %s', str(future.exception()))
@@ -0,0 +1,36 @@
+import threading
+
+from concurrent.futures import Future
+from typing import Hashable, Iterable, Dict, Tuple, Any
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent work on the same keys: the first caller claims a key and does the work,
+    callers claiming it meanwhile get a future resolved with the result of the first one
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__calls: Dict[Hashable, Future] = {}
+
+    def claim(self, keys: Iterable[Hashable]) -> Tuple[Dict[Hashable, Future], Dict[Hashable, Future]]:
+        """
+        Returns futures of the claimed keys which the caller has to resolve, and futures of the keys in flight
+        """
+        claimed, in_flight = {}, {}
+        with self.__lock:
+            for key in keys:
+                future = self.__calls.get(key)
+                if future is None:
+                    claimed[key] = self.__calls[key] = Future()
+                else:
+                    in_flight[key] = future
+
+        return claimed, in_flight
+
+    def resolve(self, key: Hashable, result: Any):
+        with self.__lock:
+            future = self.__calls.pop(key, None)
+        if future is not None:
+            future.set_result(result)
@@ -0,0 +1,122 @@
+import numpy as np
+
+from math import cos, radians, floor
+from typing import Hashable, Optional, Tuple, List
+
+from dto import Coordinates, NodeStore, Way
+from providers.formulas_provider import calculate_distances, EARTH_SPHERE_DEGREE, EARTH_CIRCUMFERENCE
+from providers.memory_cache import MemoryCache
+from providers.cache_provider import tile_size
+
+# datasets kept when the cache is not given a shared memory cache
+SPATIAL_INDEX_CACHE_BYTES = 128 * 1024 * 1024
+# estimated memory of a dataset node besides its columns: the ids dictionary of the store
+# and coordinates copies, grid keys and order of its spatial index
+DATASET_NODE_OVERHEAD_BYTES = 130
+
+
+class SpatialIndex:
+    """
+    Uniform latitude/longitude grid over nodes of the store, answers radius, ring and nearest queries
+    visiting only the grid cells around the point
+    """
+
+    def __init__(self, nodes: NodeStore, cell_size: float = 0.1):
+        self.nodes = nodes
+        self.nodes_count = len(nodes)
+        self.cell_size = cell_size
+        # copies, so the store can still grow while the index is used
+        self.latitudes = np.array(nodes.latitudes, dtype=np.float64)
+        self.longitudes = np.array(nodes.longitudes, dtype=np.float64)
+
+        self.__columns = int(np.ceil(EARTH_SPHERE_DEGREE / cell_size))
+        rows = np.floor((self.latitudes + 90) / cell_size).astype(np.int64)
+        columns = np.floor((self.longitudes + 180) / cell_size).astype(np.int64) % self.__columns
+        keys = rows * self.__columns + columns
+        self.__order = np.argsort(keys, kind='stable')
+        self.__keys = keys[self.__order]
+
+    def __len__(self):
+        return self.nodes_count
+
+    def within(self, coordinates: Coordinates, distance: float) -> np.ndarray:
+        return self.ring(coordinates, 0, distance)
+
+    def ring(self, coordinates: Coordinates, min_distance: float, max_distance: float) -> np.ndarray:
+        """
+        Returns indexes of the nodes which are between min_distance and max_distance kilometers from the coordinates
+        """
+        candidates = self.__candidates(coordinates, max_distance)
+        if len(candidates) == 0:
+            return candidates
+        distances = calculate_distances(coordinates, self.latitudes[candidates], self.longitudes[candidates])
+        return candidates[(distances >= min_distance) & (distances <= max_distance)]
+
+    def nearest(self, coordinates: Coordinates, count: int) -> np.ndarray:
+        """
+        Returns indexes of count nearest nodes ordered by distance
+        """
+        count = min(count, self.nodes_count)
+        distance = self.cell_size * EARTH_CIRCUMFERENCE / EARTH_SPHERE_DEGREE
+        while True:
+            candidates = self.within(coordinates, distance)
+            if len(candidates) >= count or distance >= EARTH_CIRCUMFERENCE / 2:
+                break
+            distance *= 2
+
+        distances = calculate_distances(coordinates, self.latitudes[candidates], self.longitudes[candidates])
+        return candidates[np.argsort(distances, kind='stable')[:count]]
+
+    def __candidates(self, coordinates: Coordinates, distance: float) -> np.ndarray:
+        latitude_distance = distance * EARTH_SPHERE_DEGREE / EARTH_CIRCUMFERENCE
+        bottom = max(coordinates.latitude - latitude_distance, -90)
+        top = min(coordinates.latitude + latitude_distance, 90)
+        max_latitude = max(abs(bottom), abs(top))
+        if max_latitude >= 89.9:
+            longitude_distance = EARTH_SPHERE_DEGREE
+        else:
+            longitude_distance = latitude_distance / cos(radians(max_latitude))
+
+        if longitude_distance * 2 >= EARTH_SPHERE_DEGREE:
+            columns_ranges = [(0, self.__columns - 1)]
+        else:
+            left = floor((coordinates.longitude - longitude_distance + 180) / self.cell_size)
+            right = floor((coordinates.longitude + longitude_distance + 180) / self.cell_size)
+            if left < 0:
+                columns_ranges = [(left + self.__columns, self.__columns - 1), (0, right)]
+            elif right >= self.__columns:
+                columns_ranges = [(left, self.__columns - 1), (0, right - self.__columns)]
+            else:
+                columns_ranges = [(left, right)]
+
+        # keys of one row and columns range are contiguous in the sorted order
+        slices = []
+        for row in range(floor((bottom + 90) / self.cell_size), floor((top + 90) / self.cell_size) + 1):
+            for left, right in columns_ranges:
+                start = np.searchsorted(self.__keys, row * self.__columns + left, side='left')
+                end = np.searchsorted(self.__keys, row * self.__columns + right, side='right')
+                if end > start:
+                    slices.append(self.__order[start:end])
+
+        return np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
+
+
+class SpatialIndexCache:
+    """
+    Keeps recently searched datasets in process, so their merged nodes and spatial index are reused.
+    Datasets are kept in a memory cache, which bounds them by their estimated size in bytes
+    """
+
+    def __init__(self, memory_cache: MemoryCache = None, ttl_seconds: float = 3600):
+        self.memory_cache = memory_cache if memory_cache is not None else MemoryCache(SPATIAL_INDEX_CACHE_BYTES)
+        self.ttl_seconds = ttl_seconds
+
+    def get(self, key: Hashable) -> Optional[Tuple[NodeStore, List[Way]]]:
+        return self.memory_cache.get(("spatial_index", key))
+
+    def put(self, key: Hashable, nodes_ways: Tuple[NodeStore, List[Way]]):
+        self.memory_cache.put(("spatial_index", key), nodes_ways, dataset_size(*nodes_ways), self.ttl_seconds)
+
+
+def dataset_size(nodes: NodeStore, ways: List[Way]) -> int:
+    return tile_size(nodes, ways) + len(nodes) * DATASET_NODE_OVERHEAD_BYTES
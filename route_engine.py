@@ -0,0 +1,163 @@
+import time
+import numpy as np
+
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from random import Random
+from statistics import mean
+from typing import List, Optional, Iterable
+
+from providers import calculate_distances
+from dto import Way, Node, NodeStore, SearchConfig, RouteStops, Coordinates
+
+
+@dataclass
+class RouteBudget:
+    # ways walked before falling back to spaced nodes, the number of ways when not set
+    max_iterations: Optional[int] = None
+    max_seconds: Optional[float] = None
+
+
+@dataclass
+class RouteEngineStats:
+    routes_count: int = 0
+    # routes with all the requested stops
+    complete_routes_count: int = 0
+    budget_exhausted_count: int = 0
+    mean_seconds: float = 0
+    max_seconds: float = 0
+    # shortest distance between consecutive stops, averaged over the routes
+    mean_min_leg: float = 0
+
+
+class RouteEngine(ABC):
+    """
+    Chooses stops of a route among the nodes and ways found around the search point. Engines draw random numbers
+    only from a Random seeded with the seed argument, so the same seed and data give the same stops
+    """
+
+    @abstractmethod
+    def choose_stops(self, nodes: NodeStore, ways: List[Way], search_config: SearchConfig, seed: int = None,
+                     budget: RouteBudget = None) -> RouteStops:
+        raise NotImplementedError('Method choose_stops must be implemented for RouteEngine instance')
+
+
+class BasicRouteEngine(RouteEngine):
+    """
+    Walks random ways for nodes_count - 1 nodes far enough from a random node of the way,
+    then picks random spaced nodes around the search point
+    """
+
+    def choose_stops(self, nodes: NodeStore, ways: List[Way], search_config: SearchConfig, seed: int = None,
+                     budget: RouteBudget = None) -> RouteStops:
+        started_at = time.perf_counter()
+        rng = Random(seed)
+        budget = budget or RouteBudget()
+        distance = search_config.distance or 15
+        nodes_count = search_config.nodes_count or 3
+        initial_node = Node(0, longitude=search_config.longitude, latitude=search_config.latitude)
+        min_node_distance = distance / (nodes_count if nodes_count != 1 else 2)
+        deadline = started_at + budget.max_seconds if budget.max_seconds is not None else None
+        max_iterations = len(ways) if budget.max_iterations is None else min(budget.max_iterations, len(ways))
+        route_stops = RouteStops(nodes=[initial_node], strategy='ways')
+
+        while route_stops.iterations < max_iterations:
+            if deadline is not None and time.perf_counter() >= deadline:
+                route_stops.budget_exhausted = True
+                break
+            route_stops.iterations += 1
+            way = rng.choice(ways)
+            try:
+                random_node = rng.choice(way.nodes)
+                matching_siblings = way.find_matching_siblings(random_node, min_node_distance)
+                route_stops.nodes.extend(rng.sample(matching_siblings, nodes_count - 1))
+            except (ValueError, IndexError):
+                continue
+            if len(route_stops.nodes) == nodes_count:
+                break
+        else:
+            route_stops.budget_exhausted = max_iterations < len(ways)
+
+        if len(route_stops.nodes) != nodes_count or len(route_stops.nodes) == 1:
+            route_stops.nodes = [initial_node] + pick_spaced_nodes(nodes, initial_node,
+                                                                   (nodes_count - 1) if nodes_count != 1 else 1,
+                                                                   min_node_distance, distance, rng)
+            route_stops.strategy = 'spaced_nodes'
+        route_stops.elapsed_seconds = time.perf_counter() - started_at
+
+        return route_stops
+
+
+def pick_spaced_nodes(nodes: NodeStore, initial_node: Node, count: int, min_node_distance: float, distance: float,
+                      rng: Random = None) -> List[Node]:
+    """
+    Picks random nodes within distance from the initial node, each one at least min_node_distance
+    from the previous stop, only grid cells around the stops are visited
+    """
+    if len(nodes) == 0:
+        return []
+    rng = rng or Random()
+    spatial_index = nodes.spatial_index
+    picked_indexes, previous_node = [], initial_node
+    for _ in range(count):
+        candidates = spatial_index.ring(previous_node, min_node_distance, max(distance, min_node_distance))
+        candidates = candidates[calculate_distances(initial_node, spatial_index.latitudes[candidates],
+                                                    spatial_index.longitudes[candidates]) <= distance]
+        candidates = candidates[~np.isin(candidates, picked_indexes)]
+        if len(candidates) == 0:
+            candidates = spatial_index.nearest(previous_node, count + len(picked_indexes))
+            candidates = candidates[~np.isin(candidates, picked_indexes)]
+        if len(candidates) == 0:
+            break
+        picked_indexes.append(int(rng.choice(candidates)))
+        previous_node = nodes[picked_indexes[-1]]
+
+    return [nodes[index] for index in picked_indexes]
+
+
+def ways_distances(ways: List[Way], coordinates: Coordinates) -> np.ndarray:
+    """
+    Returns the distance from the coordinates to the nearest node of every way, inf for ways without nodes
+    """
+    stores_distances, result = {}, np.full(len(ways), np.inf)
+    for index, way in enumerate(ways):
+        if len(way.nodes_indexes) == 0:
+            continue
+        # ways of merged datasets share one store, its distances are calculated once
+        distances = stores_distances.get(id(way.store))
+        if distances is None:
+            distances = stores_distances[id(way.store)] = calculate_distances(
+                coordinates, np.asarray(way.store.latitudes), np.asarray(way.store.longitudes))
+        result[index] = distances[np.asarray(way.nodes_indexes)].min()
+
+    return result
+
+
+def route_min_leg(route_nodes: List[Node]) -> float:
+    """
+    Returns the shortest distance between consecutive stops of the route, 0 for routes without stops
+    """
+    return min((float(calculate_distances(previous_node, [node.latitude], [node.longitude])[0])
+                for previous_node, node in zip(route_nodes, route_nodes[1:])), default=0)
+
+
+def benchmark_route_engine(route_engine: RouteEngine, nodes: NodeStore, ways: List[Way],
+                           search_configs: Iterable[SearchConfig], seed: int = 0,
+                           budget: RouteBudget = None) -> RouteEngineStats:
+    """
+    Chooses stops of every search config with seeds derived from the seed, so engines are compared
+    on the same random choices
+    """
+    routes_stops = [(search_config, route_engine.choose_stops(nodes, ways, search_config, seed + index, budget))
+                    for index, search_config in enumerate(search_configs)]
+    if not routes_stops:
+        return RouteEngineStats()
+
+    return RouteEngineStats(
+        routes_count=len(routes_stops),
+        complete_routes_count=sum(len(route_stops.nodes) == max(search_config.nodes_count or 3, 2)
+                                  for search_config, route_stops in routes_stops),
+        budget_exhausted_count=sum(route_stops.budget_exhausted for _, route_stops in routes_stops),
+        mean_seconds=mean(route_stops.elapsed_seconds for _, route_stops in routes_stops),
+        max_seconds=max(route_stops.elapsed_seconds for _, route_stops in routes_stops),
+        mean_min_leg=mean(route_min_leg(route_stops.nodes) for _, route_stops in routes_stops))
@@ -0,0 +1,78 @@
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, Future
+from dataclasses import dataclass
+from enum import Enum
+from typing import Callable, Dict, Hashable, Any
+
+
+class RouteJobStatus(Enum):
+    QUEUED = 'queued'
+    # a job of the same user is still queued or running
+    DUPLICATE = 'duplicate'
+    QUEUE_FULL = 'queue_full'
+
+
+@dataclass
+class RouteJobSubmission:
+    status: RouteJobStatus
+    # jobs queued or running before this one was submitted
+    jobs_ahead: int = 0
+    future: Future = None
+
+
+class RouteJobQueue:
+    """
+    Bounded queue of route generation jobs served by a pool of worker threads, each user has one job at a time.
+    Jobs are refused when the queue is full, so a burst of long searches does not pile up behind the workers
+    """
+
+    def __init__(self, workers_count: int = 4, max_queued_jobs: int = 50):
+        self.workers_count = workers_count
+        self.max_queued_jobs = max_queued_jobs
+        self.__executor = ThreadPoolExecutor(max_workers=workers_count, thread_name_prefix='route-job')
+        self.__jobs: Dict[Hashable, Future] = {}
+        self.__lock = threading.Lock()
+
+    @property
+    def depth(self) -> int:
+        """
+        Returns the number of queued and running jobs
+        """
+        with self.__lock:
+            return len(self.__jobs)
+
+    def submit(self, user_id: Hashable, job: Callable[[], Any],
+               on_done: Callable[[Future], None] = None) -> RouteJobSubmission:
+        """
+        Queues the job of the user, on_done is called in the worker thread with the future of the finished job
+        """
+        with self.__lock:
+            jobs_ahead = len(self.__jobs)
+            if user_id in self.__jobs:
+                return RouteJobSubmission(RouteJobStatus.DUPLICATE, jobs_ahead, self.__jobs[user_id])
+            if jobs_ahead >= self.workers_count + self.max_queued_jobs:
+                return RouteJobSubmission(RouteJobStatus.QUEUE_FULL, jobs_ahead)
+            future = self.__executor.submit(job)
+            self.__jobs[user_id] = future
+
+        # the job may be finished already, then the callback runs in this thread
+        future.add_done_callback(lambda done_future: self.__finish(user_id, done_future, on_done))
+        return RouteJobSubmission(RouteJobStatus.QUEUED, jobs_ahead, future)
+
+    def close(self, wait: bool = True):
+        """
+        Stops accepting jobs, queued jobs are cancelled and running ones are waited for when wait is set
+        """
+        with self.__lock:
+            futures = list(self.__jobs.values())
+        for future in futures:
+            future.cancel()
+        self.__executor.shutdown(wait=wait)
+
+    def __finish(self, user_id: Hashable, future: Future, on_done: Callable[[Future], None] = None):
+        with self.__lock:
+            if self.__jobs.get(user_id) is future:
+                del self.__jobs[user_id]
+        if on_done and not future.cancelled():
+            on_done(future)
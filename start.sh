@@ -1,4 +1,7 @@
 #!/bin/bash
 
-nohup python telegram-bot.py &
+# with a webhook url the bot is served by the API process
+if [ -z "$TELEGRAM_WEBHOOK_URL" ]; then
+  nohup python telegram_bot.py &
+fi
 uvicorn api.main:app --host "0.0.0.0" --port 80
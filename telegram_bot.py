@@ -0,0 +1,309 @@
+import os
+import logging
+import warnings
+
+from concurrent.futures import Future
+
+from queue import Queue
+
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.ext import Updater, Dispatcher, CommandHandler, MessageHandler, Filters, CallbackContext, \
+    CallbackQueryHandler
+
+from providers import CacheProvider, OverpassProvider, LocalExtractProvider, MemoryCache, SpatialIndexCache, \
+    SessionStore, MapsProviderBase
+from adapters.db_registry import DbAdapterRegistry, MongoClientSettings
+from dto import SearchConfig
+from base_algo import BasicAlgorithm
+from route_jobs import RouteJobQueue, RouteJobStatus
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class BotContext:
+    """
+    Providers used by the handlers of a dispatcher, kept in its bot_data. The webhook of the API passes the
+    providers of the API, so the bot does not open other database clients and caches in its process
+    """
+
+    def __init__(self, cache_provider: CacheProvider, maps_provider: MapsProviderBase, use_route_pools: bool = False,
+                 tiles_lease_seconds: float = 0):
+        self.cache_provider = cache_provider
+        self.maps_provider = maps_provider
+        # searches are answered from route pools, which are precomputed by the application owning the providers
+        self.use_route_pools = use_route_pools
+        self.tiles_lease_seconds = tiles_lease_seconds
+        # searches are kept in memory while the user chooses their options, and written when the route is requested
+        self.sessions = SessionStore(cache_provider, max_sessions=int(os.environ.get('SESSIONS_MAX_COUNT', 10000)))
+        # routes are generated by a pool of workers, so long searches do not hold the dispatcher threads
+        self.route_jobs = RouteJobQueue(workers_count=int(os.environ.get('ROUTE_WORKERS', 4)),
+                                        max_queued_jobs=int(os.environ.get('ROUTE_QUEUE_SIZE', 50)))
+
+    def create_algorithm(self) -> BasicAlgorithm:
+        return BasicAlgorithm(self.maps_provider, cache_provider=self.cache_provider,
+                              use_route_pools=self.use_route_pools, tiles_lease_seconds=self.tiles_lease_seconds)
+
+    def close(self) -> None:
+        """
+        Waits for the route jobs, they edit the messages of their users, and writes the sessions
+        """
+        self.route_jobs.close()
+        self.sessions.close()
+
+
+def get_bot_context(callback_context: CallbackContext) -> BotContext:
+    return callback_context.bot_data['bot_context']
+
+
+def bot_error_handler(update: Update, callback_context: CallbackContext):
+    logger.error(str(callback_context.error))
+    try:
+        update.message.reply_text('Sorry I have faced some internal error. Please, try again later')
+    except AttributeError:
+        try:
+            update.callback_query.edit_message_text('Sorry I have faced some internal error. Please, try again later')
+        except AttributeError:
+            logger.error('Update does not have message or callback')
+
+
+def error_handler(update: Update, error_msg: str):
+    logger.error(error_msg)
+    try:
+        update.message.reply_text('Sorry I have faced some internal error. Please, try again later')
+    except AttributeError:
+        try:
+            update.callback_query.edit_message_text('Sorry I have faced some internal error. Please, try again later')
+        except AttributeError:
+            logger.error('Update does not have message or callback')
+
+
+def start(update: Update, _: CallbackContext) -> None:
+    update.message.reply_text('Hi! I can help you to make a route for your roadtrip. Just send me your location.')
+
+
+def help_command(update: Update, _: CallbackContext) -> None:
+    update.message.reply_text('You can send location via message in format latitude/longitude e.g.: 50.27/30.31 '
+                              'or attach location.')
+
+
+def location(update: Update, callback_context: CallbackContext):
+    sessions = get_bot_context(callback_context).sessions
+    user_id = str(update.message.from_user.id)
+    if update.edited_message:
+        message = update.edited_message
+    else:
+        message = update.message
+    if message.location:
+        search_config = SearchConfig(id=user_id, longitude=message.location.longitude,
+                                     latitude=message.location.latitude)
+        sessions.put(search_config)
+        distance_choice(update, callback_context)
+    else:
+        try:
+            message_text = message.text.replace(' ', '')
+            message_location = message_text.split('/')
+
+            search_config = SearchConfig(id=user_id, latitude=float(message_location[0].replace(',', '.')),
+                                         longitude=float(message_location[1].replace(',', '.')))
+            sessions.put(search_config)
+            distance_choice(update, callback_context)
+        except Exception as e:
+            logger.error(e)
+            update.message.reply_text('Sorry, I can not parse this location. Please, '
+                                      'send it in the format: latitude/longitude')
+
+
+def distance_choice(update: Update, _: CallbackContext) -> None:
+    keyboard = [
+        [
+            InlineKeyboardButton("50 km", callback_data='50km'),
+            InlineKeyboardButton("100 km", callback_data='100km'),
+            InlineKeyboardButton("500 km", callback_data='500km'),
+            InlineKeyboardButton("1000 km", callback_data='1000km'),
+        ]
+    ]
+
+    reply_markup = InlineKeyboardMarkup(keyboard)
+
+    update.message.reply_text(
+        'You need to choose approximate distance in kilometers of searching area and amount of places to search. '
+        '\n\nPlease, choose approximate searching distance:', reply_markup=reply_markup)
+
+
+def button(update: Update, callback_context: CallbackContext) -> None:
+    bot_context = get_bot_context(callback_context)
+    sessions, route_jobs = bot_context.sessions, bot_context.route_jobs
+    user_id = str(update.callback_query.from_user.id)
+    query = update.callback_query
+
+    # CallbackQueries need to be answered, even if no notification to the user is needed
+    # Some clients may have trouble otherwise. See https://core.telegram.org/bots/api#callbackquery
+    query.answer()
+
+    callback_data = query.data
+    try:
+        search_config = sessions.get(user_id)
+        if search_config is None:
+            query.edit_message_text('Please, send your location first.')
+            return
+
+        if 'km' in callback_data:
+
+            sessions.put(SearchConfig(id=user_id, longitude=search_config.longitude, latitude=search_config.latitude,
+                                      distance=int(callback_data[:-2])))
+
+            keyboard = [
+                [
+                    InlineKeyboardButton("1", callback_data='1'),
+                    InlineKeyboardButton("2", callback_data='2'),
+                    InlineKeyboardButton("3", callback_data='3'),
+                ]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            query.edit_message_text(
+                'You need choose approximate distance in kilometers of searching area and amount of places to search. '
+                '\n\nPlease, choose amount of places:', reply_markup=reply_markup)
+
+        else:
+            search_config = SearchConfig(id=user_id, longitude=search_config.longitude,
+                                         latitude=search_config.latitude, distance=search_config.distance,
+                                         nodes_count=int(callback_data))
+            algorithm = bot_context.create_algorithm()
+            # the message is edited before the job is queued, so it can not overwrite the link of a finished job
+            jobs_ahead = route_jobs.depth
+            if jobs_ahead >= route_jobs.workers_count:
+                query.edit_message_text(text=f"Your route is generating, {jobs_ahead} routes are ahead of yours, "
+                                             f"please wait...")
+            else:
+                query.edit_message_text(text="Your route is generating, please wait...")
+            submission = route_jobs.submit(user_id, lambda: generate_route(sessions, algorithm, search_config),
+                                           lambda future: route_generated(update, future))
+            if submission.status == RouteJobStatus.DUPLICATE:
+                query.edit_message_text(text="Your previous route is still generating, please wait...")
+            elif submission.status == RouteJobStatus.QUEUE_FULL:
+                query.edit_message_text(text="Too many routes are generating now, please try again in a minute.")
+    except ConnectionError as e:
+        error_handler(update, str(e))
+
+
+def generate_route(sessions: SessionStore, algorithm: BasicAlgorithm, search_config: SearchConfig) -> str:
+    # results update the written search, so the route job waits for the write instead of the handler
+    sessions.finish(search_config).result()
+    return algorithm.search_and_generate_route(search_config)
+
+
+def route_generated(update: Update, future: Future) -> None:
+    try:
+        route_url = future.result()
+        update.callback_query.edit_message_text(text=f"Your route is generated! Please, follow the link: {route_url}")
+    except Exception as e:
+        error_handler(update, str(e))
+
+
+def precompute_route_pools(callback_context: CallbackContext) -> None:
+    try:
+        built_count = get_bot_context(callback_context).create_algorithm().precompute_route_pools()
+        if built_count:
+            logger.info('%s route pools precomputed', built_count)
+    except ConnectionError as e:
+        logger.error(str(e))
+
+
+def log_memory_cache_stats(callback_context: CallbackContext) -> None:
+    memory_cache = callback_context.job.context
+    stats = memory_cache.stats
+    logger.info('Memory cache: %s items, %s of %s bytes, hit ratio %.2f, %s evictions, %s expirations',
+                stats.items_count, stats.size_bytes, memory_cache.max_bytes, stats.hit_ratio, stats.evictions,
+                stats.expirations)
+
+
+def add_handlers(dispatcher: Dispatcher) -> None:
+    # on different commands - answer in Telegram
+    dispatcher.add_handler(CommandHandler("start", start))
+    dispatcher.add_handler(CommandHandler("help", help_command))
+    dispatcher.add_handler(CommandHandler('search', distance_choice))
+    dispatcher.add_handler(CallbackQueryHandler(button))
+    dispatcher.add_handler(MessageHandler(Filters.text, location))
+    dispatcher.add_handler(MessageHandler(Filters.location, location))
+    dispatcher.add_error_handler(bot_error_handler)
+
+
+def create_webhook_dispatcher(bot: Bot, cache_provider: CacheProvider, maps_provider: MapsProviderBase,
+                              use_route_pools: bool = False, tiles_lease_seconds: float = 0) -> Dispatcher:
+    """
+    Returns a dispatcher for updates received by a webhook, they are passed to its process_update by the caller.
+    The providers belong to the caller, bot_context of the dispatcher is closed by it on shutdown
+    """
+    # handlers do not use run_async, so the dispatcher does not need worker threads
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore', message='Asynchronous callbacks can not be processed')
+        dispatcher = Dispatcher(bot, Queue(), workers=0)
+    dispatcher.bot_data['bot_context'] = BotContext(cache_provider, maps_provider, use_route_pools,
+                                                    tiles_lease_seconds)
+    add_handlers(dispatcher)
+
+    return dispatcher
+
+
+def main() -> None:
+    """Start the bot."""
+    db_registry = DbAdapterRegistry(MongoClientSettings.from_env(),
+                                    db_name=os.environ.get('MONGODB_DATABASE', 'road_trip'),
+                                    sqlite_path=os.environ.get('SQLITE_PATH'))
+    memory_cache = MemoryCache(max_bytes=int(os.environ.get('MEMORY_CACHE_MB', 256)) * 1024 ** 2)
+    # merged datasets of recent searches share the memory budget of the cached tiles
+    BasicAlgorithm.spatial_index_cache = SpatialIndexCache(memory_cache)
+    # user searches are read from memory for this long, 0 keeps them in the database only
+    user_search_cache_seconds = float(os.environ.get('USER_SEARCH_CACHE_SECONDS', 0))
+    cache_provider = CacheProvider(db_registry.get(os.environ.get('MONGODB_SERIES', 'user_search')),
+                                   memory_cache=memory_cache, user_search_ttl_seconds=user_search_cache_seconds)
+    maps_provider = OverpassProvider(os.environ.get('OSM_URL', 'https://overpass-api.de/api/interpreter'),
+                                     pool_size=int(os.environ.get('OSM_POOL_SIZE', 10)))
+    # areas of a preprocessed regional extract are answered locally, other areas are still requested from Overpass
+    if os.environ.get('OSM_EXTRACT_PATH'):
+        maps_provider = LocalExtractProvider(os.environ['OSM_EXTRACT_PATH'], fallback=maps_provider)
+    # route pools of the most searched tiles are precomputed in the background at this interval, 0 disables them
+    route_pools_interval_seconds = float(os.environ.get('ROUTE_POOLS_INTERVAL_SECONDS', 300))
+    # tiles requested by a search are leased in the database, so other processes wait for them, 0 disables leases
+    tiles_lease_seconds = float(os.environ.get('TILES_LEASE_SECONDS', 60))
+
+    # Create the Updater and pass it your bot's token.
+    updater = Updater(os.environ.get('TELEGRAM_API_TOKEN'))
+
+    try:
+        cache_provider.ensure_indexes()
+    except ConnectionError as e:
+        logger.error(str(e))
+
+    # Get the dispatcher to register handlers
+    bot_context = BotContext(cache_provider, maps_provider, use_route_pools=bool(route_pools_interval_seconds),
+                             tiles_lease_seconds=tiles_lease_seconds)
+    updater.dispatcher.bot_data['bot_context'] = bot_context
+    add_handlers(updater.dispatcher)
+
+    if route_pools_interval_seconds:
+        updater.job_queue.run_repeating(precompute_route_pools, interval=route_pools_interval_seconds)
+    # hits and evictions of the memory cache are logged at this interval, 0 disables them
+    memory_cache_stats_seconds = float(os.environ.get('MEMORY_CACHE_STATS_SECONDS', 600))
+    if memory_cache_stats_seconds:
+        updater.job_queue.run_repeating(log_memory_cache_stats, interval=memory_cache_stats_seconds,
+                                        context=memory_cache)
+
+    # Start the Bot
+    updater.start_polling()
+
+    # Run the bot until you press Ctrl-C or the process receives SIGINT,
+    # SIGTERM or SIGABRT. This should be used most of the time, since
+    # start_polling() is non-blocking and will stop the bot gracefully.
+    updater.idle()
+
+    bot_context.close()
+    maps_provider.close()
+    db_registry.close()
+
+
+if __name__ == '__main__':
+    main()
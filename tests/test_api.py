@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from adapters.db_sqlite_adapter import SqliteAsyncDbAdapter
+from base_algo import BasicAlgorithm
+from providers import AsyncCacheProvider, SpatialIndexCache, MemoryCache
+from tests.test_async_search import GridMapsProvider, LATITUDE, LONGITUDE
+
+# the app opens its database with motor
+pytest.importorskip('motor')
+import httpx  # noqa: E402
+
+import api.main  # noqa: E402
+
+
+def request(method: str, path: str, body: dict = None) -> httpx.Response:
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=api.main.app),
+                                     base_url='http://api') as client:
+            return await client.request(method, path, json=body)
+
+    return asyncio.run(run())
+
+
+@pytest.fixture
+def maps_provider(tmp_path, monkeypatch):
+    maps_provider = GridMapsProvider()
+    db_adapter = SqliteAsyncDbAdapter(str(tmp_path / 'api.sqlite'), 'user_search')
+    monkeypatch.setattr(api.main, 'maps_provider', maps_provider)
+    monkeypatch.setattr(api.main, 'batch_routes_max_count', 6)
+    monkeypatch.setattr(BasicAlgorithm, 'spatial_index_cache', SpatialIndexCache(MemoryCache()))
+    api.main.app.dependency_overrides[api.main.get_cache_provider] = lambda: AsyncCacheProvider(db_adapter)
+    yield maps_provider
+    api.main.app.dependency_overrides.clear()
+    db_adapter.close()
+
+
+def test_batch_routes_are_generated_over_one_fetch(maps_provider):
+    response = request('POST', '/search/batch', {
+        "latitude": LATITUDE, "longitude": LONGITUDE, "routes_count": 3,
+        "variants": [{"distance": 3, "nodes_count": 3}, {"distance": 5, "nodes_count": 4}]})
+
+    assert response.status_code == 200
+    routes = response.json()["routes"]
+    assert [(route["distance"], route["nodes_count"], len(route["nodes"])) for route in routes] == \
+        [(3, 3, 3)] * 3 + [(5, 4, 4)] * 3
+    assert all(route["route"].startswith('https://') for route in routes)
+    assert maps_provider.requests_count == 1
+
+
+@pytest.mark.parametrize('batch_search_config', [
+    {"latitude": LATITUDE, "longitude": LONGITUDE, "distance": 5, "nodes_count": 3, "routes_count": 7},
+    {"latitude": LATITUDE, "longitude": LONGITUDE, "distance": 5, "nodes_count": 3, "routes_count": 0},
+    {"latitude": LATITUDE, "longitude": LONGITUDE, "distance": 0, "nodes_count": 3},
+])
+def test_batch_over_the_limits_is_rejected(maps_provider, batch_search_config):
+    response = request('POST', '/search/batch', batch_search_config)
+
+    assert response.status_code == 422
+    assert maps_provider.requests_count == 0
+
+
+def test_memory_cache_stats(monkeypatch):
+    memory_cache = MemoryCache(max_bytes=1000)
+    monkeypatch.setattr(api.main, 'memory_cache', memory_cache)
+    memory_cache.put('key', 'value', 100)
+    memory_cache.get('key')
+    memory_cache.get('missing')
+
+    response = request('GET', '/stats')
+
+    assert response.json()["memory_cache"] == {"hits": 1, "misses": 1, "evictions": 0, "expirations": 0,
+                                               "items_count": 1, "size_bytes": 100, "hit_ratio": 0.5,
+                                               "max_bytes": 1000}
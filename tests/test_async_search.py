@@ -0,0 +1,119 @@
+import asyncio
+import threading
+import time
+
+from base_algo import BasicAlgorithm
+from dto import Coordinates, NodeStore, SearchConfig
+from providers import MapsProviderBase, MapsRequestData, MapsRequestType, SpatialIndexCache, MemoryCache
+from route_engine import BasicRouteEngine
+
+LATITUDE, LONGITUDE = 50.05, 30.05
+
+
+class GridMapsProvider(MapsProviderBase):
+    """
+    Answers every square with a grid of nodes, parsed like a streamed response, and counts the requests
+    """
+
+    def __init__(self):
+        self.requests_count = 0
+
+    def get_osm_nodes_ways(self, request_data: MapsRequestData, request_type: MapsRequestType):
+        raise NotImplementedError()
+
+    def get_osm_nodes_ways_areas(self, request_data: MapsRequestData, request_type: MapsRequestType) -> list:
+        self.requests_count += 1
+        return [grid_nodes(bottom_left, top_right) for bottom_left, top_right in request_data.square_coordinates]
+
+    async def get_osm_nodes_ways_async(self, request_data: MapsRequestData, request_type: MapsRequestType) -> list:
+        return self.get_osm_nodes_ways_areas(request_data, request_type)
+
+
+def grid_nodes(bottom_left: Coordinates, top_right: Coordinates, steps: int = 10) -> tuple:
+    nodes = NodeStore()
+    for row in range(steps):
+        for column in range(steps):
+            nodes.add(len(nodes) + int(bottom_left.latitude * 1e6) * 1000 + int(bottom_left.longitude * 1e3),
+                      bottom_left.latitude + (top_right.latitude - bottom_left.latitude) * (row + 0.5) / steps,
+                      bottom_left.longitude + (top_right.longitude - bottom_left.longitude) * (column + 0.5) / steps)
+    return nodes, []
+
+
+class SlowRouteEngine(BasicRouteEngine):
+    def choose_stops(self, *args, **kwargs):
+        time.sleep(0.3)
+        return super().choose_stops(*args, **kwargs)
+
+
+class RecordingAlgorithm(BasicAlgorithm):
+    """
+    Records the threads of the CPU bound stages
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stages_threads = {}
+
+    def split_tiles(self, *args):
+        self.stages_threads['split_tiles'] = threading.current_thread()
+        return super().split_tiles(*args)
+
+    def merge_search_tiles(self, *args):
+        self.stages_threads['merge_search_tiles'] = threading.current_thread()
+        return super().merge_search_tiles(*args)
+
+    def generate_batch_routes(self, *args):
+        self.stages_threads['generate_batch_routes'] = threading.current_thread()
+        return super().generate_batch_routes(*args)
+
+    def choose_route_nodes(self, *args):
+        self.stages_threads['choose_route_nodes'] = threading.current_thread()
+        return super().choose_route_nodes(*args)
+
+
+def test_cpu_stages_run_outside_of_the_event_loop(monkeypatch):
+    monkeypatch.setattr(BasicAlgorithm, 'spatial_index_cache', SpatialIndexCache(MemoryCache()))
+    algorithm = RecordingAlgorithm(GridMapsProvider(), tile_precision=5, route_engine=SlowRouteEngine(),
+                                   route_seed=1)
+    ticks = []
+
+    async def ticker():
+        while True:
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.05)
+
+    async def run():
+        ticker_task = asyncio.ensure_future(ticker())
+        started_at = time.monotonic()
+        try:
+            route_url = await algorithm.search_and_route(SearchConfig(LATITUDE, LONGITUDE, distance=5, nodes_count=3))
+        finally:
+            ticker_task.cancel()
+        return route_url, started_at
+
+    route_url, started_at = asyncio.run(run())
+
+    assert route_url.startswith('https://')
+    assert set(algorithm.stages_threads) == {'split_tiles', 'merge_search_tiles', 'choose_route_nodes'}
+    assert threading.main_thread() not in algorithm.stages_threads.values()
+    # the event loop kept running while the route was chosen
+    assert len([tick for tick in ticks if tick > started_at]) >= 4
+
+
+def test_batch_routes_share_one_fetch_and_derive_seeds(monkeypatch):
+    monkeypatch.setattr(BasicAlgorithm, 'spatial_index_cache', SpatialIndexCache(MemoryCache()))
+    maps_provider = GridMapsProvider()
+    algorithm = RecordingAlgorithm(maps_provider, tile_precision=5, route_seed=7)
+    search_configs = [SearchConfig(LATITUDE, LONGITUDE, distance=distance, nodes_count=3)
+                      for distance in (3, 5, 5, 5)]
+
+    batch_routes = asyncio.run(algorithm.search_and_route_batch(search_configs))
+
+    assert maps_provider.requests_count == 1
+    assert [batch_route.search_config for batch_route in batch_routes] == search_configs
+    assert algorithm.stages_threads['generate_batch_routes'] is not threading.main_thread()
+    # routes of the batch get the seed of the algorithm plus their index
+    nodes, ways = algorithm.search_nodes_ways(search_configs[-1])
+    assert [batch_route.nodes for batch_route in batch_routes[1:]] == \
+        [algorithm.choose_route_nodes(nodes, ways, search_configs[index], 7 + index) for index in (1, 2, 3)]
+    assert len({batch_route.route_url for batch_route in batch_routes[1:]}) == 3
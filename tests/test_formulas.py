@@ -0,0 +1,36 @@
+from math import pi
+from random import Random
+
+import pytest
+
+from dto import Coordinates
+from providers import calculate_distances, calculate_distance
+
+EARTH_RADIUS = 6371
+
+
+@pytest.mark.parametrize('origin, point, distance', [
+    ((0, 0), (0, 1), 2 * pi * EARTH_RADIUS / 360),
+    ((0, 0), (90, 0), pi * EARTH_RADIUS / 2),
+    ((0, 0), (0, 180), pi * EARTH_RADIUS),
+    ((10, 179.5), (10, -179.5), 2 * pi * EARTH_RADIUS / 360 * 0.98481),
+    # Kyiv and Lviv
+    ((50.4501, 30.5234), (49.8397, 24.0297), 467.9),
+    ((50.4, 30.5), (50.4, 30.5), 0),
+])
+def test_known_distances(origin, point, distance):
+    distances = calculate_distances(Coordinates(*origin), [point[0]], [point[1]])
+
+    assert distances[0] == pytest.approx(distance, rel=1e-3, abs=1e-9)
+
+
+def test_vectorized_distances_match_scalar_ones():
+    rng = Random(0)
+    origin = Coordinates(latitude=rng.uniform(0, 80), longitude=rng.uniform(0, 170))
+    points = [(rng.uniform(0, 80), rng.uniform(0, 170)) for _ in range(1000)]
+
+    distances = calculate_distances(origin, [latitude for latitude, _ in points],
+                                    [longitude for _, longitude in points])
+
+    assert distances.tolist() == pytest.approx(
+        [calculate_distance((origin.latitude, origin.longitude), point) for point in points], rel=1e-9, abs=1e-6)
@@ -0,0 +1,177 @@
+import asyncio
+import json
+from random import Random
+
+import pytest
+
+from dto import Coordinates, NodeStore
+from providers import LocalExtractProvider, build_local_extract, MapsProviderBase, MapsRequestData, \
+    MapsRequestType, calculate_distances
+
+BOUNDS = (50.0, 30.0, 51.0, 31.0)
+
+
+def make_elements(count: int = 3000, seed: int = 0) -> list:
+    rng = Random(seed)
+    elements = []
+    for node_id in range(1, count + 1):
+        tags = rng.choice([{"tourism": "museum"}, {"type": "city"}, {"type": "town", "tourism": "attraction"},
+                           {"type": "village"}, {}])
+        elements.append({"type": "node", "id": node_id, "lat": rng.uniform(50, 51), "lon": rng.uniform(30, 31),
+                         "tags": tags})
+    # ways of the dump are not stored in the extract
+    elements.append({"type": "way", "id": 1, "nodes": [1, 2]})
+    return elements
+
+
+class RecordingMapsProvider(MapsProviderBase):
+    """
+    Fallback provider answering every area with its index in the requests, which are recorded
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    def get_osm_nodes_ways(self, request_data: MapsRequestData, request_type: MapsRequestType):
+        self.requests.append(request_data)
+        return 'fallback', []
+
+    def get_osm_nodes_ways_areas(self, request_data: MapsRequestData, request_type: MapsRequestType) -> list:
+        self.requests.append(request_data)
+        areas = request_data.square_coordinates if request_type == MapsRequestType.SQUARE_COORDINATES else \
+            list(request_data.points_radius)
+        return [('fallback', index) for index in range(len(areas))]
+
+    async def get_osm_nodes_ways_async(self, request_data: MapsRequestData, request_type: MapsRequestType):
+        return self.get_osm_nodes_ways_areas(request_data, request_type)
+
+
+@pytest.fixture
+def elements() -> list:
+    return make_elements()
+
+
+@pytest.fixture
+def extract_path(tmp_path, elements) -> str:
+    source_path, extract_path = str(tmp_path / 'region.json'), str(tmp_path / 'region.bin')
+    with open(source_path, 'w') as source_file:
+        json.dump({"version": 0.6, "elements": elements}, source_file)
+    build_local_extract(source_path, extract_path, cell_size=0.1, bounds=BOUNDS)
+    return extract_path
+
+
+def expected_ids(elements: list, matches, only_cities_and_towns: bool = False) -> list:
+    def flagged(tags: dict) -> bool:
+        return tags.get('type') in ('city', 'town') if only_cities_and_towns else 'tourism' in tags
+
+    return sorted(element['id'] for element in elements
+                  if element['type'] == 'node' and flagged(element['tags']) and matches(element))
+
+
+def found_ids(nodes_ways) -> list:
+    nodes, ways = nodes_ways
+    assert ways == []
+    return sorted(nodes.ids)
+
+
+def test_extract_keeps_tourism_and_cities(tmp_path, elements):
+    source_path = str(tmp_path / 'region.json')
+    with open(source_path, 'w') as source_file:
+        json.dump({"elements": elements}, source_file)
+
+    count = build_local_extract(source_path, str(tmp_path / 'region.bin'))
+
+    provider = LocalExtractProvider(str(tmp_path / 'region.bin'))
+    kept = [element for element in elements if element['type'] == 'node' and
+            ('tourism' in element['tags'] or element['tags'].get('type') in ('city', 'town'))]
+    assert count == provider.nodes_count == len(kept)
+    # the extent of the kept nodes is covered without the bounds
+    assert provider.bounds == pytest.approx([min(element['lat'] for element in kept),
+                                             min(element['lon'] for element in kept),
+                                             max(element['lat'] for element in kept),
+                                             max(element['lon'] for element in kept)])
+
+
+@pytest.mark.parametrize('only_cities_and_towns', [False, True])
+def test_square_area(extract_path, elements, only_cities_and_towns):
+    provider = LocalExtractProvider(extract_path)
+    bottom_left, top_right = Coordinates(50.23, 30.41), Coordinates(50.58, 30.77)
+
+    nodes_ways = provider.find_nodes_ways((bottom_left, top_right), only_cities_and_towns)
+
+    assert found_ids(nodes_ways) == expected_ids(
+        elements, lambda element: 50.23 <= element['lat'] <= 50.58 and 30.41 <= element['lon'] <= 30.77,
+        only_cities_and_towns)
+    assert len(nodes_ways[0]) > 0
+
+
+@pytest.mark.parametrize('only_cities_and_towns', [False, True])
+def test_circle_area(extract_path, elements, only_cities_and_towns):
+    provider = LocalExtractProvider(extract_path)
+    center = Coordinates(50.5, 30.5)
+
+    nodes_ways = provider.find_nodes_ways((center, 20), only_cities_and_towns)
+
+    assert found_ids(nodes_ways) == expected_ids(
+        elements, lambda element: calculate_distances(center, [element['lat']], [element['lon']])[0] <= 20,
+        only_cities_and_towns)
+    assert len(nodes_ways[0]) > 0
+
+
+def test_covers_the_bounds_only(extract_path):
+    provider = LocalExtractProvider(extract_path)
+
+    assert provider.covers((Coordinates(50, 30), Coordinates(51, 31)))
+    assert not provider.covers((Coordinates(49.99, 30), Coordinates(51, 31)))
+    assert not provider.covers((Coordinates(50, 30), Coordinates(51, 31.01)))
+    assert provider.covers((Coordinates(50.5, 30.5), 20))
+    # the circle bounding square crosses the north bound
+    assert not provider.covers((Coordinates(50.9, 30.5), 20))
+    with pytest.raises(ValueError):
+        provider.find_nodes_ways((Coordinates(50.9, 30.5), 20))
+
+
+def test_areas_outside_of_the_extract_are_requested_from_the_fallback(extract_path, elements):
+    fallback = RecordingMapsProvider()
+    provider = LocalExtractProvider(extract_path, fallback=fallback)
+    squares = [[Coordinates(49.5, 30.2), Coordinates(49.6, 30.3)],
+               [Coordinates(50.2, 30.2), Coordinates(50.3, 30.3)],
+               [Coordinates(51.2, 30.2), Coordinates(51.3, 30.3)],
+               [Coordinates(50.6, 30.6), Coordinates(50.7, 30.7)]]
+    request_data = MapsRequestData(square_coordinates=squares)
+
+    responses = provider.get_osm_nodes_ways_areas(request_data, MapsRequestType.SQUARE_COORDINATES)
+    async_responses = asyncio.run(provider.get_osm_nodes_ways_async(request_data, MapsRequestType.SQUARE_COORDINATES))
+
+    for results in (responses, async_responses):
+        # results keep the order of the requested areas
+        assert results[0] == ('fallback', 0) and results[2] == ('fallback', 1)
+        assert isinstance(results[1][0], NodeStore) and isinstance(results[3][0], NodeStore)
+        assert found_ids(results[3]) == expected_ids(
+            elements, lambda element: 50.6 <= element['lat'] <= 50.7 and 30.6 <= element['lon'] <= 30.7)
+    assert [request.square_coordinates for request in fallback.requests] == [[squares[0], squares[2]]] * 2
+
+
+def test_circles_and_areas_without_fallback(extract_path):
+    fallback = RecordingMapsProvider()
+    provider = LocalExtractProvider(extract_path, fallback=fallback)
+    points_radius = {Coordinates(50.5, 30.5): 10, Coordinates(52, 30.5): 10}
+
+    request_data = MapsRequestData(points_radius=points_radius, only_cities_and_towns=True)
+
+    results = provider.get_osm_nodes_ways_areas(request_data, MapsRequestType.AROUND_POINT)
+
+    assert isinstance(results[0][0], NodeStore) and results[1] == ('fallback', 0)
+    assert fallback.requests[0].points_radius == {Coordinates(52, 30.5): 10}
+    assert fallback.requests[0].only_cities_and_towns
+    # without the fallback areas outside of the extract fail alone
+    results = LocalExtractProvider(extract_path).get_osm_nodes_ways_areas(request_data, MapsRequestType.AROUND_POINT)
+    assert isinstance(results[0][0], NodeStore) and isinstance(results[1], ValueError)
+
+
+def test_other_files_are_rejected(tmp_path):
+    path = tmp_path / 'other.bin'
+    path.write_bytes(b'\0' * 100)
+
+    with pytest.raises(ValueError):
+        LocalExtractProvider(str(path))
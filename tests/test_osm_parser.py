@@ -0,0 +1,90 @@
+import json
+import asyncio
+import tracemalloc
+
+import pytest
+
+from providers.osm_parser import OsmElementsParser, parse_osm_elements, parse_osm_elements_async
+
+RESPONSE = json.dumps({
+    "version": 0.6,
+    "osm3s": {"copyright": "The data included in this document is from www.openstreetmap.org."},
+    "elements": [
+        {"type": "node", "id": 1, "lat": 50.45, "lon": 30.52, "tags": {"tourism": "museum", "name": "Музей"}},
+        {"type": "node", "id": 2, "lat": 50.46, "lon": 30.53},
+        {"type": "node", "id": 3, "lat": 50.47, "lon": 30.54},
+        {"type": "way", "id": 10, "nodes": [1, 2, 4, 3]}
+    ]
+}, ensure_ascii=False).encode('utf-8')
+
+
+def split(body: bytes, size: int):
+    return [body[index:index + size] for index in range(0, len(body), size)]
+
+
+def assert_parsed(nodes, ways):
+    assert list(nodes.ids) == [1, 2, 3]
+    assert list(nodes.latitudes) == [50.45, 50.46, 50.47]
+    assert list(nodes.longitudes) == [30.52, 30.53, 30.54]
+    assert len(ways) == 1
+    # nodes missing from the response are skipped
+    assert ways[0].id == 10 and [node.id for node in ways[0].nodes] == [1, 2, 3]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 64, len(RESPONSE)])
+def test_chunked_response_is_parsed_like_the_whole_body(chunk_size):
+    # small chunks split the elements key, the elements and multibyte characters
+    assert_parsed(*parse_osm_elements(split(RESPONSE, chunk_size)))
+
+
+def test_async_chunks_are_parsed():
+    async def chunks():
+        for chunk in split(RESPONSE, 5):
+            yield chunk
+
+    assert_parsed(*asyncio.run(parse_osm_elements_async(chunks())))
+
+
+def test_empty_elements():
+    nodes, ways = parse_osm_elements([b'{"elements": [', b'  ]}'])
+    assert len(nodes) == 0 and ways == []
+
+
+@pytest.mark.parametrize('cut', [len(RESPONSE) // 2, len(RESPONSE) - 3])
+def test_truncated_response_raises(cut):
+    with pytest.raises(ValueError, match='truncated'):
+        parse_osm_elements(split(RESPONSE[:cut], 16))
+
+
+def test_error_body_raises_with_its_text():
+    with pytest.raises(ValueError, match='runtime error: Query timed out'):
+        parse_osm_elements([b'<html><body>runtime error: Query timed out</body></html>'])
+
+
+def test_elements_are_passed_to_the_callback_instead_of_the_store():
+    elements = []
+    parser = OsmElementsParser(on_element=elements.append)
+    for chunk in split(RESPONSE, 9):
+        parser.feed(chunk)
+    parser.close()
+
+    assert [element['id'] for element in elements] == [1, 2, 3, 10]
+    assert elements[0]['tags']['name'] == 'Музей'
+    assert len(parser.store) == 0 and parser.ways == []
+
+
+def test_parsed_store_does_not_keep_the_ids_dict():
+    elements = [{"type": "node", "id": node_id, "lat": 50.0, "lon": 30.0} for node_id in range(20000)]
+    elements.append({"type": "way", "id": 1, "nodes": [0, 19999, 12345]})
+    body = json.dumps({"elements": elements}).encode()
+
+    tracemalloc.start()
+    try:
+        nodes, ways = parse_osm_elements(split(body, 64 * 1024))
+        retained, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert [node.id for node in ways[0].nodes] == [0, 19999, 12345]
+    # 24 bytes of columns per node, the ids dict would add about 100 more
+    assert retained / len(nodes) < 50
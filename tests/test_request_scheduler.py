@@ -0,0 +1,117 @@
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from dto import Coordinates
+from providers import RequestScheduler, OverpassProvider, MapsRequestData, MapsRequestType
+from providers.request_scheduler import retry_after
+
+STATUS_WITHOUT_SLOTS = '''Connected as: 1234
+Current time: 2024-01-01T00:00:00Z
+Announced endpoint: none
+Rate limit: 2
+Slot available after: 2024-01-01T00:00:09Z, in 9 seconds.
+Slot available after: 2024-01-01T00:00:05Z, in 5 seconds.
+Currently running queries (pid, space limit, time limit, start time):
+'''
+
+
+def test_burst_starts_at_once_then_requests_are_spaced():
+    scheduler = RequestScheduler(requests_per_second=10, burst=3)
+
+    waits = [scheduler.reserve() for _ in range(6)]
+
+    assert waits == pytest.approx([0, 0, 0, 0.1, 0.2, 0.3], abs=0.01)
+
+
+def test_interval_starts_again_after_idle_time():
+    scheduler = RequestScheduler(requests_per_second=20, burst=1)
+    assert scheduler.reserve() == pytest.approx(0, abs=0.01)
+    assert scheduler.reserve() == pytest.approx(0.05, abs=0.01)
+
+    time.sleep(0.15)
+    assert scheduler.reserve() == pytest.approx(0, abs=0.01)
+
+
+def test_unlimited_rate_never_waits():
+    scheduler = RequestScheduler(requests_per_second=0)
+    assert [scheduler.reserve() for _ in range(5)] == pytest.approx([0] * 5, abs=0.01)
+
+
+def test_pause_delays_every_request():
+    scheduler = RequestScheduler(requests_per_second=100, burst=5)
+    scheduler.pause(1)
+    # a shorter pause does not shorten the current one
+    scheduler.pause(0.5)
+
+    assert [scheduler.reserve() for _ in range(2)] == pytest.approx([1, 1], abs=0.02)
+
+
+@pytest.mark.parametrize('status, paused_seconds', [
+    (STATUS_WITHOUT_SLOTS, 5),
+    (STATUS_WITHOUT_SLOTS.replace('Slot available after', '1 slots available now.\nSlot available after', 1), 0),
+    (STATUS_WITHOUT_SLOTS.replace('Rate limit: 2', 'Rate limit: 0'), 0),
+    (STATUS_WITHOUT_SLOTS.replace('in 5 seconds', 'in -3 seconds'), 0),
+    ('Error: runtime error', 0),
+])
+def test_status_text_pauses_until_the_next_slot(status, paused_seconds):
+    scheduler = RequestScheduler(requests_per_second=0)
+
+    scheduler.update_status(status)
+
+    assert scheduler.reserve() == pytest.approx(paused_seconds, abs=0.02)
+
+
+def test_retry_after_header_or_exponential_back_off():
+    assert retry_after({'Retry-After': '7'}, 0) == 7
+    assert retry_after({'Retry-After': '-1'}, 0) == 0
+    assert retry_after({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}, 2) == 4
+    assert retry_after({}, 3) == 8
+
+
+class OverpassHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        OverpassHandler.requests.append((self.path, time.monotonic()))
+        if self.path.endswith('/status'):
+            body = STATUS_WITHOUT_SLOTS.replace('in 5 seconds', 'in 1 seconds').encode()
+        else:
+            body = json.dumps({"elements": [{"type": "node", "id": 1, "lat": 50.01, "lon": 30.01}]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def overpass_url():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), OverpassHandler)
+    OverpassHandler.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{}/api/interpreter'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_sync_requests_wait_for_the_status_slot(overpass_url):
+    provider = OverpassProvider(overpass_url, scheduler=RequestScheduler(requests_per_second=0))
+    request_data = MapsRequestData(square_coordinates=[[Coordinates(50, 30), Coordinates(50.1, 30.1)]])
+    try:
+        responses = provider.get_osm_nodes_ways_areas(request_data, MapsRequestType.SQUARE_COORDINATES)
+    finally:
+        provider.close()
+
+    nodes, _ = responses[0]
+    assert list(nodes.ids) == [1]
+    (status_path, status_at), (query_path, query_at) = OverpassHandler.requests
+    assert (status_path, query_path) == ('/api/status', '/api/interpreter')
+    assert query_at - status_at >= 0.9
@@ -0,0 +1,140 @@
+from array import array
+from random import Random
+
+import pytest
+
+from dto import NodeStore, Node, Way, SearchConfig
+from providers import calculate_distances
+from route_engine import BasicRouteEngine, RouteBudget, pick_spaced_nodes, benchmark_route_engine, route_min_leg
+
+LATITUDE, LONGITUDE = 50.4, 30.5
+
+
+def make_nodes(count: int, spread: float = 0.3, seed: int = 0) -> NodeStore:
+    rng, nodes = Random(seed), NodeStore()
+    for node_id in range(1, count + 1):
+        nodes.add(node_id, LATITUDE + rng.uniform(-spread, spread), LONGITUDE + rng.uniform(-spread, spread))
+    return nodes
+
+
+def make_ways(nodes: NodeStore, count: int, length: int = 20, seed: int = 0) -> list:
+    rng = Random(seed)
+    return [Way(nodes, array('i', rng.sample(range(len(nodes)), length)), id=way_id)
+            for way_id in range(1, count + 1)]
+
+
+def distance_between(first: Node, second: Node) -> float:
+    return float(calculate_distances(first, [second.latitude], [second.longitude])[0])
+
+
+def stops_ids(route_stops) -> list:
+    return [node.id for node in route_stops.nodes]
+
+
+@pytest.mark.parametrize('ways_count', [0, 30])
+def test_same_seed_gives_same_stops(ways_count):
+    nodes = make_nodes(2000)
+    ways = make_ways(nodes, ways_count)
+    search_config = SearchConfig(LATITUDE, LONGITUDE, distance=20, nodes_count=4)
+    engine = BasicRouteEngine()
+
+    routes = [stops_ids(engine.choose_stops(nodes, ways, search_config, seed)) for seed in (1, 1, 2, 3, 4)]
+
+    assert routes[0] == routes[1]
+    assert len(set(map(tuple, routes))) > 1
+    assert all(len(route) == 4 for route in routes)
+
+
+def test_spaced_nodes_without_ways():
+    nodes = make_nodes(2000)
+    search_config = SearchConfig(LATITUDE, LONGITUDE, distance=20, nodes_count=4)
+
+    route_stops = BasicRouteEngine().choose_stops(nodes, [], search_config, seed=5)
+
+    assert route_stops.strategy == 'spaced_nodes'
+    assert route_stops.iterations == 0
+    assert not route_stops.budget_exhausted
+    initial_node, stops = route_stops.nodes[0], route_stops.nodes[1:]
+    assert (initial_node.latitude, initial_node.longitude) == (LATITUDE, LONGITUDE)
+    assert all(distance_between(initial_node, stop) <= 20 for stop in stops)
+    assert route_min_leg(route_stops.nodes) >= 20 / 4
+
+
+def test_stops_found_on_ways():
+    nodes = make_nodes(2000)
+    route_stops = BasicRouteEngine().choose_stops(nodes, make_ways(nodes, 30),
+                                                  SearchConfig(LATITUDE, LONGITUDE, distance=20, nodes_count=3), seed=1)
+
+    assert route_stops.strategy == 'ways'
+    assert 1 <= route_stops.iterations <= 30
+    assert not route_stops.budget_exhausted
+
+
+def test_iterations_budget_cutoff():
+    nodes = make_nodes(2000)
+    # nodes of the ways are too close to each other, walking them never finds stops
+    ways = [Way(nodes, array('i', [index, index]), id=index) for index in range(10)]
+    search_config = SearchConfig(LATITUDE, LONGITUDE, distance=20, nodes_count=3)
+    engine = BasicRouteEngine()
+
+    limited = engine.choose_stops(nodes, ways, search_config, seed=1, budget=RouteBudget(max_iterations=4))
+    unlimited = engine.choose_stops(nodes, ways, search_config, seed=1)
+
+    assert (limited.iterations, limited.budget_exhausted, limited.strategy) == (4, True, 'spaced_nodes')
+    assert (unlimited.iterations, unlimited.budget_exhausted, unlimited.strategy) == (10, False, 'spaced_nodes')
+    assert len(limited.nodes) == len(unlimited.nodes) == 3
+
+
+def test_seconds_budget_cutoff():
+    nodes = make_nodes(2000)
+    route_stops = BasicRouteEngine().choose_stops(nodes, make_ways(nodes, 30),
+                                                  SearchConfig(LATITUDE, LONGITUDE, distance=20, nodes_count=3),
+                                                  seed=1, budget=RouteBudget(max_seconds=0))
+
+    assert route_stops.budget_exhausted
+    assert route_stops.iterations == 0
+    assert route_stops.strategy == 'spaced_nodes'
+    assert len(route_stops.nodes) == 3
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_pick_spaced_nodes_keeps_distances(seed):
+    nodes = make_nodes(3000, seed=seed)
+    initial_node = Node(0, latitude=LATITUDE, longitude=LONGITUDE)
+
+    stops = pick_spaced_nodes(nodes, initial_node, 5, 4, 25, Random(seed))
+
+    assert len(stops) == 5
+    assert len({stop.id for stop in stops}) == 5
+    assert all(distance_between(initial_node, stop) <= 25 for stop in stops)
+    assert all(distance_between(previous_stop, stop) >= 4
+               for previous_stop, stop in zip([initial_node] + stops, stops))
+    assert [stop.id for stop in pick_spaced_nodes(nodes, initial_node, 5, 4, 25, Random(seed))] == \
+        [stop.id for stop in stops]
+
+
+def test_pick_spaced_nodes_falls_back_to_nearest():
+    # every node is closer to the search point than the spacing
+    nodes = make_nodes(50, spread=0.001)
+    initial_node = Node(0, latitude=LATITUDE, longitude=LONGITUDE)
+
+    stops = pick_spaced_nodes(nodes, initial_node, 3, 10, 20, Random(0))
+
+    assert len(stops) == 3
+    assert len({stop.id for stop in stops}) == 3
+    assert pick_spaced_nodes(NodeStore(), initial_node, 3, 10, 20, Random(0)) == []
+
+
+def test_benchmark_is_reproducible():
+    nodes = make_nodes(2000)
+    ways = make_ways(nodes, 30)
+    search_configs = [SearchConfig(LATITUDE, LONGITUDE, distance=distance, nodes_count=nodes_count)
+                      for distance in (10, 20) for nodes_count in (2, 3, 5)]
+
+    first = benchmark_route_engine(BasicRouteEngine(), nodes, ways, search_configs, seed=7)
+    second = benchmark_route_engine(BasicRouteEngine(), nodes, ways, search_configs, seed=7)
+
+    assert first.routes_count == 6
+    assert first.complete_routes_count == 6
+    assert first.mean_min_leg == second.mean_min_leg
+    assert benchmark_route_engine(BasicRouteEngine(), nodes, ways, []).routes_count == 0
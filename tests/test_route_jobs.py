@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+from route_jobs import RouteJobQueue, RouteJobStatus
+
+
+@pytest.fixture
+def released():
+    released = threading.Event()
+    yield released
+    released.set()
+
+
+def blocked_job(released: threading.Event, result):
+    def job():
+        released.wait(5)
+        return result
+
+    return job
+
+
+def test_user_has_one_job_at_a_time(released):
+    route_jobs = RouteJobQueue(workers_count=2, max_queued_jobs=2)
+    first = route_jobs.submit('u', blocked_job(released, 'first'))
+
+    duplicate = route_jobs.submit('u', blocked_job(released, 'second'))
+
+    assert (first.status, first.jobs_ahead) == (RouteJobStatus.QUEUED, 0)
+    # the job of the user is returned, so its result can be waited for
+    assert (duplicate.status, duplicate.jobs_ahead, duplicate.future) == (RouteJobStatus.DUPLICATE, 1, first.future)
+    released.set()
+    assert first.future.result(timeout=5) == 'first'
+    route_jobs.close()
+
+
+def test_full_queue_refuses_jobs(released):
+    route_jobs = RouteJobQueue(workers_count=1, max_queued_jobs=1)
+    submissions = [route_jobs.submit(user_id, blocked_job(released, user_id)) for user_id in ('a', 'b', 'c')]
+
+    assert [(submission.status, submission.jobs_ahead) for submission in submissions] == \
+        [(RouteJobStatus.QUEUED, 0), (RouteJobStatus.QUEUED, 1), (RouteJobStatus.QUEUE_FULL, 2)]
+    assert submissions[2].future is None
+    assert route_jobs.depth == 2
+
+    released.set()
+    assert [submission.future.result(timeout=5) for submission in submissions[:2]] == ['a', 'b']
+    route_jobs.close()
+    # finished jobs leave the queue
+    assert route_jobs.depth == 0
+
+
+def test_finished_job_calls_back_and_frees_the_user(released):
+    route_jobs = RouteJobQueue(workers_count=1)
+    done = []
+    finished = threading.Event()
+
+    def on_done(future):
+        done.append((future.result(), route_jobs.depth))
+        finished.set()
+
+    route_jobs.submit('u', blocked_job(released, 'route'), on_done)
+    released.set()
+
+    assert finished.wait(5)
+    # the job is removed before its callback, so the callback may submit the next job of the user
+    assert done == [('route', 0)]
+    assert route_jobs.submit('u', lambda: 'next').future.result(timeout=5) == 'next'
+    route_jobs.close()
+
+
+def test_close_cancels_queued_jobs(released):
+    route_jobs = RouteJobQueue(workers_count=1, max_queued_jobs=5)
+    done = []
+    started = threading.Event()
+
+    def running_job():
+        started.set()
+        return blocked_job(released, 'running')()
+
+    running = route_jobs.submit('running', running_job, done.append)
+    queued = route_jobs.submit('queued', blocked_job(released, 'queued'), done.append)
+
+    assert started.wait(5)
+    route_jobs.close(wait=False)
+    released.set()
+
+    assert running.future.result(timeout=5) == 'running'
+    assert queued.future.cancelled()
+    route_jobs.close()
+    # callbacks of cancelled jobs are not called
+    assert done == [running.future]
+    assert route_jobs.depth == 0
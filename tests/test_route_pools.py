@@ -0,0 +1,162 @@
+import asyncio
+from random import Random
+
+import pytest
+
+from adapters.db_sqlite_adapter import SqliteDbAdapter, SqliteAsyncDbAdapter
+from base_algo import BasicAlgorithm
+from dto import Coordinates, Node, NodeStore, SearchConfig, RoutePool
+from providers import CacheProvider, AsyncCacheProvider, SpatialIndexCache, MemoryCache, calculate_distances, \
+    geohash_bounds
+from providers.route_pool import HotRoutePools, route_pool_key, route_pool_center_radius, ROUTE_POOL_PRECISION
+from tests.test_async_search import GridMapsProvider
+
+LATITUDE, LONGITUDE = 50.45, 30.52
+KEY = route_pool_key(SearchConfig(LATITUDE, LONGITUDE, distance=20, nodes_count=3))
+
+
+def make_nodes(count: int = 3000, spread: float = 0.3, seed: int = 0) -> NodeStore:
+    rng, nodes = Random(seed), NodeStore()
+    for node_id in range(1, count + 1):
+        nodes.add(node_id, LATITUDE + rng.uniform(-spread, spread), LONGITUDE + rng.uniform(-spread, spread))
+    return nodes.drop_index()
+
+
+@pytest.fixture(autouse=True)
+def hot_route_pools(monkeypatch) -> HotRoutePools:
+    hot_route_pools = HotRoutePools()
+    monkeypatch.setattr(BasicAlgorithm, 'hot_route_pools', hot_route_pools)
+    monkeypatch.setattr(BasicAlgorithm, 'spatial_index_cache', SpatialIndexCache(MemoryCache()))
+    return hot_route_pools
+
+
+@pytest.fixture
+def cache_provider(tmp_path):
+    db_adapter = SqliteDbAdapter(str(tmp_path / 'pools.sqlite'), 'user_search')
+    cache_provider = CacheProvider(db_adapter)
+    cache_provider.ensure_indexes()
+    yield cache_provider
+    db_adapter.close()
+
+
+@pytest.mark.parametrize('distance, nodes_count, expected', [
+    (20, 3, 20), (24.9, 3, 20), (25, 3, 25), (5, 0, 5), (4.9, 3, None), (0, 3, None)])
+def test_searches_share_the_pool_of_their_bucket(distance, nodes_count, expected):
+    key = route_pool_key(SearchConfig(LATITUDE, LONGITUDE, distance=distance, nodes_count=nodes_count))
+
+    if expected is None:
+        assert key is None
+    else:
+        tile, key_distance, key_nodes_count = key
+        assert len(tile) == ROUTE_POOL_PRECISION
+        assert (key_distance, key_nodes_count) == (expected, nodes_count or 3)
+        # points of the tile share the key
+        bottom_left, top_right = geohash_bounds(tile)
+        assert route_pool_key(SearchConfig(bottom_left.latitude + 1e-6, top_right.longitude - 1e-6,
+                                           distance=distance, nodes_count=nodes_count)) == key
+
+
+def test_tile_radius_reaches_its_corners():
+    center, radius = route_pool_center_radius(KEY[0])
+    bottom_left, top_right = geohash_bounds(KEY[0])
+
+    corners = calculate_distances(center, [bottom_left.latitude, top_right.latitude],
+                                  [bottom_left.longitude, top_right.longitude])
+    assert corners.max() == pytest.approx(radius)
+    assert 1 < radius < 5
+
+
+def test_hot_keys_are_ranked_and_cool_down(hot_route_pools):
+    for key, searches in (('a', 5), ('b', 3), ('c', 1), ('d', 8)):
+        for _ in range(searches):
+            hot_route_pools.record(key)
+
+    assert hot_route_pools.hot_keys(2) == ['d', 'a']
+    # counters are halved: d 4, a 2, b 1
+    assert hot_route_pools.hot_keys(5) == ['d', 'a']
+    assert hot_route_pools.hot_keys(5) == ['d']
+    assert hot_route_pools.hot_keys(5, min_searches=1) == ['d']
+    assert hot_route_pools.hot_keys(5, min_searches=1) == []
+
+
+def test_only_missing_pools_are_counted(hot_route_pools):
+    stops = [[Node(1, LATITUDE, LONGITUDE)]]
+
+    assert BasicAlgorithm.usable_route_pool(KEY, None) is None
+    # pools of areas with ways have no stop sets, they are not built again
+    assert BasicAlgorithm.usable_route_pool(KEY, RoutePool(*KEY)) is None
+    assert BasicAlgorithm.usable_route_pool(KEY, RoutePool(*KEY, stops=stops)).stops == stops
+    assert hot_route_pools.hot_keys(5, min_searches=1) == [KEY]
+
+
+def test_pool_stops_are_valid_from_any_point_of_the_tile():
+    tile, distance, nodes_count = KEY
+    route_pool = BasicAlgorithm.build_route_pool(make_nodes(), [], KEY, Random(1), pool_size=16)
+
+    assert 0 < len(route_pool.stops) <= 16
+    bottom_left, top_right = geohash_bounds(tile)
+    corners = [Coordinates(latitude, longitude) for latitude in (bottom_left.latitude, top_right.latitude)
+               for longitude in (bottom_left.longitude, top_right.longitude)]
+    min_node_distance = (distance + 5) / nodes_count
+    for stops in route_pool.stops:
+        assert len(stops) == nodes_count - 1
+        for corner in corners:
+            distances = calculate_distances(corner, [stop.latitude for stop in stops],
+                                            [stop.longitude for stop in stops])
+            assert distances.max() <= distance
+            assert distances[0] >= min_node_distance
+    assert BasicAlgorithm.build_route_pool(make_nodes(), [], KEY, Random(1), pool_size=16).stops == route_pool.stops
+
+
+def test_areas_with_ways_and_short_buckets_have_empty_pools():
+    nodes = make_nodes()
+    short_key = route_pool_key(SearchConfig(LATITUDE, LONGITUDE, distance=5, nodes_count=3))
+
+    assert BasicAlgorithm.build_route_pool(nodes, [object()], KEY).stops == []
+    assert BasicAlgorithm.build_route_pool(NodeStore(), [], KEY).stops == []
+    assert BasicAlgorithm.build_route_pool(nodes, [], short_key).stops == []
+
+
+def test_precomputed_pool_answers_the_searches(cache_provider):
+    maps_provider = GridMapsProvider()
+    algorithm = BasicAlgorithm(maps_provider, cache_provider=cache_provider, use_route_pools=True, route_seed=1)
+    search_config = SearchConfig(LATITUDE, LONGITUDE, id='u', distance=20, nodes_count=3)
+    assert algorithm.find_route_pool(search_config) is None
+    assert algorithm.find_route_pool(search_config) is None
+
+    assert algorithm.precompute_route_pools() == 1
+    # the pool is built once
+    assert algorithm.precompute_route_pools() == 0
+
+    route_pool = algorithm.find_route_pool(search_config)
+    assert route_pool is not None and route_pool.stops
+    requests_count = maps_provider.requests_count
+    assert requests_count > 0
+    cache_provider.save_user_search(search_config)
+    route_url = algorithm.search_and_generate_route(search_config)
+
+    # the route is chosen from the pool without searching the nodes again
+    assert maps_provider.requests_count == requests_count
+    assert route_url == algorithm.create_route_url(algorithm.choose_pooled_route_nodes(route_pool, search_config))
+    assert cache_provider.get_user_search('u', projection={"results": 1})["results"]["route"] == route_url
+
+
+def test_precompute_async(tmp_path, hot_route_pools):
+    async def run():
+        db_adapter = SqliteAsyncDbAdapter(str(tmp_path / 'pools.sqlite'), 'user_search')
+        try:
+            algorithm = BasicAlgorithm(GridMapsProvider(), async_cache_provider=AsyncCacheProvider(db_adapter),
+                                       use_route_pools=True, route_seed=1)
+            built_count = await algorithm.precompute_route_pools_async()
+            return built_count, await algorithm.find_route_pool_async(route_pool_search_config)
+        finally:
+            db_adapter.close()
+
+    route_pool_search_config = SearchConfig(LATITUDE, LONGITUDE, distance=20, nodes_count=3)
+    hot_route_pools.record(KEY)
+    hot_route_pools.record(KEY)
+    built_count, route_pool = asyncio.run(run())
+
+    assert built_count == 1
+    assert (route_pool.tile, route_pool.distance, route_pool.nodes_count) == KEY
+    assert len(route_pool.stops) > 0
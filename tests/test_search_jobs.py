@@ -0,0 +1,193 @@
+import asyncio
+import json
+import time
+from datetime import datetime
+
+import pytest
+
+from adapters.db_sqlite_adapter import SqliteAsyncDbAdapter
+from api.search_jobs import SearchJobs, format_event
+from dto import SearchConfig, Node
+from providers import AsyncCacheProvider
+
+STAGE_SECONDS = 0.03
+
+
+class StagedAlgorithm:
+    """
+    Goes through the stages of BasicAlgorithm.search_and_route in STAGE_SECONDS each, fails with error when set,
+    and waits for released before the last stage when it is given
+    """
+
+    def __init__(self, async_cache_provider: AsyncCacheProvider, error: str = None,
+                 released: asyncio.Event = None):
+        self.async_cache_provider = async_cache_provider
+        self.error = error
+        self.released = released
+
+    async def search_and_route(self, search_config: SearchConfig, on_stage) -> str:
+        for stage in ('fetch', 'route'):
+            on_stage(stage)
+            await asyncio.sleep(STAGE_SECONDS)
+        if self.error:
+            raise ValueError(self.error)
+        if self.released:
+            await self.released.wait()
+        on_stage('persist')
+        await self.async_cache_provider.save_user_search_results(search_config.id, [Node(1, 50, 30)], 'url')
+        return 'url'
+
+
+@pytest.fixture
+def path(tmp_path) -> str:
+    return str(tmp_path / 'jobs.sqlite')
+
+
+def run_with_cache_provider(path: str, scenario):
+    async def run():
+        db_adapter = SqliteAsyncDbAdapter(path, 'user_search')
+        try:
+            cache_provider = AsyncCacheProvider(db_adapter)
+            await cache_provider.save_user_search(SearchConfig(50, 30, id='s'))
+            return await scenario(cache_provider)
+        finally:
+            db_adapter.close()
+
+    return asyncio.run(run())
+
+
+def test_stage_timings_are_read_with_the_search(path):
+    async def scenario(cache_provider):
+        search_jobs = SearchJobs()
+        job = search_jobs.create('s')
+        await search_jobs.run(job, StagedAlgorithm(cache_provider), SearchConfig(50, 30, id='s'))
+        return job, await search_jobs.read('s', cache_provider)
+
+    job, user_search = run_with_cache_provider(path, scenario)
+
+    assert job.stage == 'finished' and job.error is None
+    assert list(job.timings) == ['queued', 'fetch', 'route', 'persist']
+    assert job.timings['fetch'] == pytest.approx(STAGE_SECONDS, abs=0.02)
+    assert (user_search['status'], user_search['stage'], user_search['timings']) == \
+        ('finished', 'finished', job.timings)
+
+
+def test_failed_job_stores_the_error(path):
+    async def scenario(cache_provider):
+        search_jobs = SearchJobs()
+        job = search_jobs.create('s')
+        await search_jobs.run(job, StagedAlgorithm(cache_provider, error='no nodes'), SearchConfig(50, 30, id='s'))
+        return job, await search_jobs.read('s', cache_provider)
+
+    job, user_search = run_with_cache_provider(path, scenario)
+
+    assert (job.stage, job.error) == ('failed', 'no nodes')
+    assert (user_search['status'], user_search['error'], user_search['stage']) == ('failed', 'no nodes', 'failed')
+
+
+def test_done_jobs_are_kept_for_keep_seconds(path):
+    async def scenario(cache_provider):
+        search_jobs = SearchJobs(keep_seconds=0.05)
+        await search_jobs.run(search_jobs.create('s'), StagedAlgorithm(cache_provider), SearchConfig(50, 30, id='s'))
+        kept = search_jobs.get('s') is not None
+        await asyncio.sleep(0.1)
+        return kept, search_jobs.get('s'), await search_jobs.read('s', cache_provider)
+
+    kept, job, user_search = run_with_cache_provider(path, scenario)
+
+    assert kept and job is None
+    # the search is still read from the database, without the stages
+    assert user_search['status'] == 'finished' and 'stage' not in user_search
+
+
+def test_long_poll_returns_at_the_timeout_or_when_done(path):
+    async def scenario(cache_provider):
+        search_jobs, released = SearchJobs(), asyncio.Event()
+        job = search_jobs.create('s')
+        task = asyncio.ensure_future(search_jobs.run(job, StagedAlgorithm(cache_provider, released=released),
+                                                     SearchConfig(50, 30, id='s')))
+        started_at = time.monotonic()
+        timed_out = await search_jobs.wait('s', cache_provider, timeout=0.2)
+        timed_out_seconds = time.monotonic() - started_at
+        asyncio.get_running_loop().call_later(0.05, released.set)
+        done = await search_jobs.wait('s', cache_provider, timeout=5)
+        done_seconds = time.monotonic() - started_at - timed_out_seconds
+        await task
+        return timed_out, timed_out_seconds, done, done_seconds
+
+    timed_out, timed_out_seconds, done, done_seconds = run_with_cache_provider(path, scenario)
+
+    assert (timed_out['status'], timed_out['stage']) == ('in_progress', 'route')
+    assert timed_out_seconds == pytest.approx(0.2, abs=0.05)
+    assert (done['status'], done['stage'], done['results']['route']) == ('finished', 'finished', 'url')
+    assert done_seconds < 1
+
+
+def test_searches_of_other_processes_are_polled(path):
+    async def scenario(cache_provider):
+        search_jobs = SearchJobs()
+        timed_out = await search_jobs.wait('s', cache_provider, timeout=0.05, poll_seconds=0.01)
+
+        async def finish():
+            await asyncio.sleep(0.05)
+            await cache_provider.save_user_search_results('s', [Node(1, 50, 30)], 'url')
+
+        task = asyncio.ensure_future(finish())
+        done = await search_jobs.wait('s', cache_provider, timeout=5, poll_seconds=0.01)
+        await task
+        return timed_out, done, await search_jobs.wait('missing', cache_provider, timeout=5)
+
+    timed_out, done, missing = run_with_cache_provider(path, scenario)
+
+    assert timed_out['status'] == 'in_progress'
+    assert done['status'] == 'finished' and 'stage' not in done
+    assert missing is None
+
+
+def parse_event(event: str) -> tuple:
+    name_line, data_line = event.rstrip('\n').split('\n')
+    return name_line[len('event: '):], json.loads(data_line[len('data: '):])
+
+
+def test_events_stream_every_stage_then_the_result(path):
+    async def scenario(cache_provider):
+        search_jobs = SearchJobs()
+        job = search_jobs.create('s')
+        task = asyncio.ensure_future(search_jobs.run(job, StagedAlgorithm(cache_provider),
+                                                     SearchConfig(50, 30, id='s')))
+        events = [event async for event in search_jobs.events('s', cache_provider, timeout=5)]
+        await task
+        return events
+
+    events = [parse_event(event) for event in run_with_cache_provider(path, scenario)]
+
+    assert [(name, data.get('stage')) for name, data in events] == \
+        [('stage', 'queued'), ('stage', 'fetch'), ('stage', 'route'), ('stage', 'persist'), ('result', 'finished')]
+    assert list(events[2][1]['timings']) == ['queued', 'fetch']
+    assert events[-1][1]['results']['route'] == 'url'
+
+
+def test_idle_events_stream_is_kept_alive(path):
+    async def scenario(cache_provider):
+        search_jobs, released = SearchJobs(), asyncio.Event()
+        job = search_jobs.create('s')
+        task = asyncio.ensure_future(search_jobs.run(job, StagedAlgorithm(cache_provider, released=released),
+                                                     SearchConfig(50, 30, id='s')))
+        events = [event async for event in search_jobs.events('s', cache_provider, timeout=0.3,
+                                                              keep_alive_seconds=0.1)]
+        released.set()
+        await task
+        return events
+
+    events = run_with_cache_provider(path, scenario)
+
+    assert ': keep-alive\n\n' in events
+    # the stream is closed at the timeout with the search in progress
+    name, data = parse_event(events[-1])
+    assert (name, data['status'], data['stage']) == ('result', 'in_progress', 'route')
+
+
+def test_format_event():
+    assert format_event('result', {"at": datetime(2024, 1, 2), "stage": "fetch"}) == \
+        'event: result\ndata: {"at": "2024-01-02 00:00:00", "stage": "fetch"}\n\n'
+    assert format_event('result', None) == 'event: result\ndata: null\n\n'
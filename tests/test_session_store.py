@@ -0,0 +1,128 @@
+import threading
+
+import pytest
+
+from adapters.db_sqlite_adapter import SqliteDbAdapter
+from dto import SearchConfig
+from providers import CacheProvider, SessionStore
+
+
+class BlockedCacheProvider(CacheProvider):
+    """
+    Writes user searches only after they are released, like a slow database
+    """
+
+    def __init__(self, db_adapter):
+        super().__init__(db_adapter)
+        self.released = threading.Event()
+
+    def save_user_search(self, search_config: SearchConfig):
+        self.released.wait(5)
+        super().save_user_search(search_config)
+
+
+class FailingCacheProvider(CacheProvider):
+    """
+    Fails the first writes of user searches, like a database which is not reachable for a while
+    """
+
+    def __init__(self, db_adapter, failures_count: int):
+        super().__init__(db_adapter)
+        self.failures_count = failures_count
+        self.failed = threading.Event()
+
+    def save_user_search(self, search_config: SearchConfig):
+        if self.failures_count:
+            self.failures_count -= 1
+            self.failed.set()
+            raise ConnectionError('Database is not reachable')
+        super().save_user_search(search_config)
+
+
+@pytest.fixture
+def cache_provider(tmp_path):
+    db_adapter = SqliteDbAdapter(str(tmp_path / 'sessions.sqlite'), 'user_search')
+    cache_provider = BlockedCacheProvider(db_adapter)
+    cache_provider.ensure_indexes()
+    yield cache_provider
+    cache_provider.released.set()
+    db_adapter.close()
+
+
+def saved_search_config(cache_provider: CacheProvider, user_id: str) -> dict:
+    return cache_provider.get_user_search(user_id, projection={"search_config": 1})["search_config"]
+
+
+def test_expired_session_is_returned_before_it_is_written(cache_provider):
+    sessions = SessionStore(cache_provider, ttl_seconds=0)
+    search_config = SearchConfig(50.4, 30.5, id='u', distance=20)
+    sessions.put(search_config)
+
+    assert sessions.get('u') == search_config
+    assert cache_provider.get_user_search('u') is None
+
+    cache_provider.released.set()
+    sessions.close()
+    assert saved_search_config(cache_provider, 'u')["distance"] == 20
+
+
+def test_session_evicted_over_max_sessions_is_returned(cache_provider):
+    sessions = SessionStore(cache_provider, max_sessions=1)
+    first, second = SearchConfig(50.4, 30.5, id='first'), SearchConfig(50.5, 30.6, id='second')
+    sessions.put(first)
+    sessions.put(second)
+
+    assert len(sessions) == 1
+    assert sessions.get('first') == first
+    assert sessions.get('second') == second
+
+    cache_provider.released.set()
+    sessions.close()
+    assert saved_search_config(cache_provider, 'first')["latitude"] == 50.4
+    assert saved_search_config(cache_provider, 'second')["latitude"] == 50.5
+
+
+def test_written_session_is_read_from_database(cache_provider):
+    cache_provider.released.set()
+    sessions = SessionStore(cache_provider, max_sessions=1)
+    sessions.finish(SearchConfig(50.4, 30.5, id='first', nodes_count=3)).result()
+    sessions.put(SearchConfig(50.5, 30.6, id='second'))
+
+    assert sessions.get('first') == SearchConfig(50.4, 30.5, id='first', nodes_count=3)
+    assert sessions.get('missing') is None
+    sessions.close()
+
+
+def test_session_of_failed_write_is_kept(tmp_path):
+    db_adapter = SqliteDbAdapter(str(tmp_path / 'sessions.sqlite'), 'user_search')
+    cache_provider = FailingCacheProvider(db_adapter, failures_count=2)
+    sessions = SessionStore(cache_provider, max_sessions=1)
+    first, second = SearchConfig(50.4, 30.5, id='first', distance=20), SearchConfig(50.5, 30.6, id='second')
+    sessions.put(first)
+    sessions.put(second)
+    assert cache_provider.failed.wait(5)
+
+    # the write of the evicted search failed, it is returned and written again on its next eviction
+    assert sessions.get('first') == first
+    # second is evicted by first and its write fails too
+    assert sessions.get('second') == second
+    try:
+        sessions.close()
+        assert cache_provider.failures_count == 0
+        assert saved_search_config(cache_provider, 'first')["distance"] == 20
+        assert saved_search_config(cache_provider, 'second')["latitude"] == 50.5
+    finally:
+        db_adapter.close()
+
+
+def test_close_writes_failed_sessions_again(tmp_path):
+    db_adapter = SqliteDbAdapter(str(tmp_path / 'sessions.sqlite'), 'user_search')
+    cache_provider = FailingCacheProvider(db_adapter, failures_count=1)
+    sessions = SessionStore(cache_provider)
+    sessions.put(SearchConfig(50.4, 30.5, id='u', distance=20))
+    try:
+        sessions.close()
+        assert cache_provider.failed.is_set()
+        assert saved_search_config(cache_provider, 'u')["distance"] == 20
+    finally:
+        db_adapter.close()
@@ -0,0 +1,78 @@
+from random import Random
+
+import numpy as np
+import pytest
+
+from dto import NodeStore, Coordinates
+from providers import SpatialIndex, SpatialIndexCache, MemoryCache, calculate_distances
+from providers.spatial_index import dataset_size
+
+
+def make_nodes(count: int, latitudes: tuple, longitudes: tuple, seed: int = 0) -> NodeStore:
+    rng, nodes = Random(seed), NodeStore()
+    for node_id in range(count):
+        nodes.add(node_id, rng.uniform(*latitudes), rng.uniform(*longitudes))
+    return nodes
+
+
+def brute_force_ring(nodes: NodeStore, coordinates: Coordinates, min_distance: float, max_distance: float):
+    distances = calculate_distances(coordinates, np.asarray(nodes.latitudes), np.asarray(nodes.longitudes))
+    return set(np.nonzero((distances >= min_distance) & (distances <= max_distance))[0].tolist())
+
+
+@pytest.mark.parametrize('latitude, longitude, latitudes, longitudes', [
+    (50.4, 30.5, (49.5, 51.5), (29, 32)),
+    # around the antimeridian and close to the pole
+    (10.0, 179.9, (9, 11), (-180, 180)),
+    (89.5, 0.0, (88, 90), (-180, 180)),
+])
+def test_ring_and_within_match_brute_force(latitude, longitude, latitudes, longitudes):
+    nodes = make_nodes(3000, latitudes, longitudes)
+    spatial_index = SpatialIndex(nodes, cell_size=0.25)
+    coordinates = Coordinates(latitude=latitude, longitude=longitude)
+
+    for min_distance, max_distance in [(0, 5), (0, 40), (20, 60), (50, 120)]:
+        assert set(spatial_index.ring(coordinates, min_distance, max_distance).tolist()) == \
+            brute_force_ring(nodes, coordinates, min_distance, max_distance)
+    assert set(spatial_index.within(coordinates, 40).tolist()) == brute_force_ring(nodes, coordinates, 0, 40)
+
+
+def test_nearest_are_ordered_by_distance():
+    nodes = make_nodes(2000, (49.5, 51.5), (29, 32))
+    coordinates = Coordinates(latitude=50.4, longitude=30.5)
+    distances = calculate_distances(coordinates, np.asarray(nodes.latitudes), np.asarray(nodes.longitudes))
+
+    nearest = nodes.spatial_index.nearest(coordinates, 10)
+
+    assert nearest.tolist() == np.argsort(distances, kind='stable')[:10].tolist()
+    assert len(nodes.spatial_index.nearest(Coordinates(latitude=-40, longitude=-70), 5000)) == len(nodes)
+
+
+def test_empty_index():
+    spatial_index = SpatialIndex(NodeStore())
+    coordinates = Coordinates(latitude=50, longitude=30)
+    assert len(spatial_index.within(coordinates, 100)) == 0
+    assert len(spatial_index.nearest(coordinates, 3)) == 0
+
+
+def test_index_is_rebuilt_when_the_store_grows():
+    nodes = make_nodes(10, (50, 50.1), (30, 30.1))
+    spatial_index = nodes.spatial_index
+    assert nodes.spatial_index is spatial_index
+
+    nodes.add(100, 60, 60)
+    assert len(nodes.spatial_index) == 11
+    assert nodes.spatial_index.nearest(Coordinates(latitude=60, longitude=60), 1).tolist() == [10]
+
+
+def test_cache_is_bounded_by_bytes():
+    datasets = [(make_nodes(1000, (50, 51), (30, 31), seed), []) for seed in range(4)]
+    size = dataset_size(*datasets[0])
+    spatial_index_cache = SpatialIndexCache(MemoryCache(max_bytes=size * 2 + size // 2))
+
+    for key, dataset in enumerate(datasets):
+        spatial_index_cache.put(key, dataset)
+
+    assert spatial_index_cache.get(0) is None and spatial_index_cache.get(1) is None
+    assert spatial_index_cache.get(2) is datasets[2] and spatial_index_cache.get(3) is datasets[3]
+    assert spatial_index_cache.memory_cache.stats.size_bytes == size * 2
@@ -0,0 +1,189 @@
+import asyncio
+from array import array
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from adapters.db_base_adapter import DbWriteOperation, DbOperationType
+from adapters.db_sqlite_adapter import SqliteDbAdapter, SqliteAsyncDbAdapter, LOOKUP_BATCH_SIZE
+from dto import NodeStore, Way, SearchConfig, Node
+from providers import CacheProvider, AsyncCacheProvider, MemoryCache
+
+
+@pytest.fixture
+def path(tmp_path) -> str:
+    return str(tmp_path / 'cache.sqlite')
+
+
+@pytest.fixture
+def adapter(path):
+    adapter = SqliteDbAdapter(path, 'documents')
+    yield adapter
+    adapter.close()
+
+
+def document_id_of(adapter: SqliteDbAdapter):
+    return adapter.select({"user_id": "u"})["_id"]
+
+
+def test_save_select_and_projection(adapter):
+    document_id = adapter.save({"user_id": "u", "search": {"distance": 10, "nodes_count": 3}})
+
+    assert str(document_id_of(adapter)) == document_id
+    assert adapter.select({"search.distance": 10}, projection={"_id": 0, "search": 1}) == \
+        {"search": {"distance": 10, "nodes_count": 3}}
+    assert adapter.select({"user_id": "u"}, projection={"search": 0}) == \
+        {"_id": document_id_of(adapter), "user_id": "u"}
+    assert adapter.select({"user_id": "other"}) is None
+    assert adapter.select({"user_id": "other"}, multiple=True) == []
+
+
+def test_update_upsert_replace_and_remove(adapter):
+    adapter.upsert({"user_id": "u"}, {"status": "in_progress", "search.distance": 10})
+    adapter.update({"user_id": "u"}, {"status": "finished"})
+    assert adapter.select({"user_id": "u"}, projection={"_id": 0}) == \
+        {"user_id": "u", "status": "finished", "search": {"distance": 10}}
+
+    document_id = adapter.select({"user_id": "u"})["_id"]
+    adapter.replace({"user_id": "u"}, {"user_id": "u", "status": "replaced"})
+    assert adapter.select({"user_id": "u"}) == {"_id": document_id, "user_id": "u", "status": "replaced"}
+
+    # update without upsert does not insert
+    adapter.update({"user_id": "missing"}, {"status": "finished"})
+    assert adapter.select({"user_id": "missing"}) is None
+
+    adapter.remove({"user_id": "u"})
+    assert adapter.select({}, multiple=True) == []
+
+
+def test_unique_index_conflicts(adapter):
+    adapter.ensure_index(["tile"], unique=True)
+    adapter.save({"_id": "a", "tile": "t1"})
+
+    assert adapter.upsert({"_id": "b"}, {"tile": "t1"}) is False
+    assert adapter.upsert({"_id": "b"}, {"tile": "t2"}) is True
+    with pytest.raises(ConnectionError):
+        adapter.save({"_id": "c", "tile": "t1"})
+
+
+def test_bulk_write_reports_failed_operations_only(adapter):
+    adapter.ensure_index(["tile"], unique=True)
+    adapter.save({"_id": "taken", "tile": "t1"})
+
+    succeeded = adapter.bulk_write([
+        DbWriteOperation(DbOperationType.UPSERT, {"_id": "a"}, {"tile": "t0"}),
+        DbWriteOperation(DbOperationType.UPSERT, {"_id": "b"}, {"tile": "t1"}),
+        DbWriteOperation(DbOperationType.REPLACE, {"_id": "c"}, {"_id": "c", "tile": "t2"}),
+        DbWriteOperation(DbOperationType.REMOVE, {"_id": "taken"}),
+    ])
+
+    assert succeeded == [True, False, True, True]
+    assert sorted(document["_id"] for document in adapter.select({}, multiple=True)) == ["a", "c"]
+    assert adapter.bulk_write([]) == []
+
+
+def test_indexed_lookups_match_scans(adapter):
+    count = LOOKUP_BATCH_SIZE + 10
+    adapter.bulk_write([DbWriteOperation(DbOperationType.REPLACE, {"_id": str(i)}, {"_id": str(i), "tile": i})
+                        for i in range(count)])
+    wanted = list(range(0, count, 3))
+
+    scanned = adapter.select({"tile": {"$in": wanted}}, multiple=True)
+    # documents written before the index are indexed by it
+    adapter.ensure_index(["tile"])
+    looked_up = adapter.select({"tile": {"$in": wanted}}, multiple=True)
+    by_id = adapter.select({"_id": {"$in": [str(i) for i in wanted]}}, multiple=True)
+
+    assert sorted(document["tile"] for document in looked_up) == wanted
+    assert sorted(document["tile"] for document in scanned) == wanted
+    assert sorted(document["tile"] for document in by_id) == wanted
+
+
+def test_expired_documents_are_not_returned(adapter):
+    adapter.ensure_index(["cached_at"], expire_after_seconds=60)
+    now = datetime.now(timezone.utc)
+    adapter.save({"_id": "old", "cached_at": now - timedelta(seconds=120)})
+    adapter.save({"_id": "new", "cached_at": now})
+    # documents without a date do not expire
+    adapter.save({"_id": "undated"})
+
+    assert sorted(document["_id"] for document in adapter.select({}, multiple=True)) == ["new", "undated"]
+    # an expired document does not conflict with a new one of the same _id
+    adapter.save({"_id": "old", "cached_at": now})
+    assert adapter.select({"_id": "old"})["_id"] == "old"
+
+    # TTL change applies to existing documents
+    adapter.ensure_index(["cached_at"], expire_after_seconds=-1)
+    assert [document["_id"] for document in adapter.select({}, multiple=True)] == ["undated"]
+
+
+def test_documents_and_indexes_persist(path, adapter):
+    adapter.ensure_index(["tile"], unique=True)
+    adapter.save({"_id": "a", "tile": "t1", "created": datetime(2020, 1, 1)})
+
+    reopened = SqliteDbAdapter(path, 'documents')
+    try:
+        assert reopened.select({"tile": "t1"}) == {"_id": "a", "tile": "t1", "created": datetime(2020, 1, 1)}
+        assert reopened.upsert({"_id": "b"}, {"tile": "t1"}) is False
+        # collections of the same file are separate
+        assert SqliteDbAdapter(path, 'other').select({}, multiple=True) == []
+    finally:
+        reopened.close()
+
+
+def test_cache_provider_round_trip(adapter):
+    cache_provider = CacheProvider(adapter)
+    cache_provider.ensure_indexes()
+    nodes = NodeStore()
+    for node_id in range(3):
+        nodes.add(node_id, 50 + node_id / 10, 30)
+    cache_provider.save_tiles({"u8c": (nodes, [Way(nodes, array('i', [0, 2]), id=7)])})
+
+    tiles = cache_provider.get_tiles(["u8c", "missing"])
+    assert list(tiles) == ["u8c"]
+    tile_nodes, tile_ways = tiles["u8c"]
+    assert list(tile_nodes.ids) == [0, 1, 2]
+    assert [(way.id, [node.id for node in way.nodes]) for way in tile_ways] == [(7, [0, 2])]
+
+    assert cache_provider.acquire_tiles_leases(["a", "b"], "first", 60) == ["a", "b"]
+    assert cache_provider.acquire_tiles_leases(["a", "b", "c"], "second", 60) == ["c"]
+    cache_provider.release_tiles_leases(["a"], "first")
+    assert cache_provider.acquire_tiles_leases(["a", "b"], "second", 60) == ["a"]
+
+    cache_provider.save_user_search(SearchConfig(50, 30, id="u", distance=10, nodes_count=3))
+    cache_provider.save_user_search_results("u", [Node(1, 50, 30)], "url")
+    user_search = cache_provider.get_user_search("u", projection={"_id": 0, "status": 1, "results": 1})
+    assert user_search == {"status": "finished",
+                           "results": {"nodes": [{"id": 1, "latitude": 50, "longitude": 30}], "route": "url"}}
+
+
+def test_user_searches_are_read_from_memory(adapter):
+    memory_cache = MemoryCache()
+    cache_provider = CacheProvider(adapter, memory_cache=memory_cache, user_search_ttl_seconds=60)
+    cache_provider.save_user_search(SearchConfig(50, 30, id="u", distance=10, nodes_count=3))
+    assert cache_provider.get_user_search("u", projection={"_id": 0, "status": 1}) == {"status": "in_progress"}
+
+    # results written by this process update the cached search
+    cache_provider.save_user_search_results("u", [Node(1, 50, 30)], "url")
+    adapter.remove({"user_id": "u"})
+    assert cache_provider.get_user_search("u", projection={"_id": 0, "status": 1}) == {"status": "finished"}
+    assert memory_cache.stats.hits == 2
+    # without the TTL searches are read from the database
+    assert CacheProvider(adapter, memory_cache=memory_cache).get_user_search("u") is None
+
+
+def test_async_adapter(path):
+    async def run():
+        adapter = SqliteAsyncDbAdapter(path, 'documents')
+        try:
+            cache_provider = AsyncCacheProvider(adapter)
+            await cache_provider.ensure_indexes()
+            await cache_provider.save_user_search(SearchConfig(50, 30, id="u"))
+            await adapter.upsert({"_id": "a"}, {"tile": "t1"})
+            return await cache_provider.get_user_search("u"), await adapter.select({"_id": "a"})
+        finally:
+            adapter.close()
+
+    user_search, document = asyncio.run(run())
+    assert user_search["status"] == "in_progress"
+    assert document == {"_id": "a", "tile": "t1"}
@@ -0,0 +1,115 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Bot
+
+from api.telegram_webhook import TelegramWebhook
+
+
+class RecordingDispatcher:
+    """
+    Records the chat and id of the handled updates, handling takes handle_seconds
+    """
+
+    def __init__(self, handle_seconds: float = 0):
+        self.bot = Bot('123456:TEST')
+        self.handle_seconds = handle_seconds
+        self.handled = []
+        self.lock = threading.Lock()
+
+    def process_update(self, update):
+        time.sleep(self.handle_seconds)
+        with self.lock:
+            self.handled.append((update.effective_chat.id if update.effective_chat else None, update.update_id))
+
+
+class CountingExecutor(ThreadPoolExecutor):
+    def __init__(self):
+        super().__init__(max_workers=4)
+        self.submits_count = 0
+
+    def submit(self, *args, **kwargs):
+        self.submits_count += 1
+        return super().submit(*args, **kwargs)
+
+
+def message_update(update_id: int, chat_id: int) -> dict:
+    return {"update_id": update_id, "message": {"message_id": update_id, "date": 0, "text": "/start",
+                                                "chat": {"id": chat_id, "type": "private"}}}
+
+
+def run_webhook(webhook: TelegramWebhook, updates: list, executor: ThreadPoolExecutor = None) -> list:
+    async def run():
+        if executor:
+            asyncio.get_running_loop().set_default_executor(executor)
+        webhook.start()
+        accepted = [webhook.put(update) for update in updates]
+        await webhook.stop()
+        return accepted
+
+    return asyncio.run(run())
+
+
+def test_updates_of_a_chat_are_handled_in_order():
+    dispatcher = RecordingDispatcher(handle_seconds=0.002)
+    webhook = TelegramWebhook(dispatcher, workers_count=3, batch_size=2)
+    updates = [message_update(update_id, chat_id=update_id % 5) for update_id in range(1, 61)]
+
+    assert all(run_webhook(webhook, updates))
+
+    assert sorted(dispatcher.handled) == sorted((update_id % 5, update_id) for update_id in range(1, 61))
+    for chat_id in range(5):
+        chat_updates = [update_id for handled_chat_id, update_id in dispatcher.handled if handled_chat_id == chat_id]
+        assert chat_updates == sorted(chat_updates)
+
+
+def test_queued_updates_are_handled_in_batches():
+    dispatcher = RecordingDispatcher()
+    executor = CountingExecutor()
+    webhook = TelegramWebhook(dispatcher, workers_count=1, batch_size=4)
+
+    run_webhook(webhook, [message_update(update_id, chat_id=1) for update_id in range(1, 11)], executor)
+
+    assert [update_id for _, update_id in dispatcher.handled] == list(range(1, 11))
+    # the updates are queued before the worker runs, so they take ceil(10 / 4) calls of the thread pool
+    assert executor.submits_count == 3
+    executor.shutdown()
+
+
+def test_full_queue_refuses_updates():
+    dispatcher = RecordingDispatcher()
+    webhook = TelegramWebhook(dispatcher, workers_count=1, max_queued_updates=2)
+
+    accepted = run_webhook(webhook, [message_update(update_id, chat_id=1) for update_id in range(1, 4)] + [{}])
+
+    # Telegram sends the refused update again, updates without content are accepted and skipped
+    assert accepted == [True, True, False, True]
+    assert [update_id for _, update_id in dispatcher.handled] == [1, 2]
+
+
+def test_stop_drains_the_queues():
+    dispatcher = RecordingDispatcher(handle_seconds=0.01)
+    webhook = TelegramWebhook(dispatcher, workers_count=2, batch_size=2)
+
+    run_webhook(webhook, [message_update(update_id, chat_id=update_id) for update_id in range(1, 21)])
+
+    assert sorted(update_id for _, update_id in dispatcher.handled) == list(range(1, 21))
+    assert webhook.depth == 0
+
+
+def test_stop_gives_up_after_the_timeout():
+    dispatcher = RecordingDispatcher(handle_seconds=0.05)
+    webhook = TelegramWebhook(dispatcher, workers_count=1, batch_size=1)
+
+    async def run():
+        webhook.start()
+        for update_id in range(1, 21):
+            webhook.put(message_update(update_id, chat_id=1))
+        started_at = time.monotonic()
+        await webhook.stop(timeout_seconds=0.1)
+        return time.monotonic() - started_at
+
+    assert asyncio.run(run()) < 0.5
+    assert len(dispatcher.handled) < 20
@@ -0,0 +1,172 @@
+import gc
+import tracemalloc
+from array import array
+from random import Random
+
+from base_algo import BasicAlgorithm
+from dto import NodeStore, Way, Coordinates
+from providers import calculate_tiles, calculate_tiles_square, calculate_tiles_rectangles, geohash_encode, \
+    geohash_bounds, group_by_tiles, CacheProvider, MemoryCache
+from providers.cache_provider import pack_tile, unpack_tile, tile_size
+
+
+def make_tile():
+    nodes = NodeStore(array('q', [1, 2 ** 40, 3]), array('d', [50.1, 50.2, -33.9]),
+                      array('d', [30.1, 30.2, 151.2]))
+    ways = [Way(nodes, array('i', [0, 1]), id=7), Way(nodes, array('i'), id=0), Way(nodes, array('i', [2]), id=2 ** 35)]
+    return nodes, ways
+
+
+def test_pack_unpack_round_trip():
+    nodes, ways = make_tile()
+    packed = pack_tile(nodes, ways)
+
+    assert all(isinstance(column, bytes) for column in packed.values())
+    unpacked_nodes, unpacked_ways = unpack_tile(packed)
+    assert list(unpacked_nodes.ids) == list(nodes.ids)
+    assert list(unpacked_nodes.latitudes) == list(nodes.latitudes)
+    assert list(unpacked_nodes.longitudes) == list(nodes.longitudes)
+    assert [(way.id, list(way.nodes_indexes)) for way in unpacked_ways] == \
+        [(way.id, list(way.nodes_indexes)) for way in ways]
+    assert all(way.store is unpacked_nodes for way in unpacked_ways)
+
+
+def test_pack_unpack_empty_tile():
+    nodes, ways = unpack_tile(pack_tile(NodeStore(), []))
+    assert len(nodes) == 0 and ways == []
+    # tiles written before ways were stored have no ways columns
+    nodes, ways = unpack_tile({name: column for name, column in pack_tile(*make_tile()).items()
+                               if not name.startswith('ways')})
+    assert len(nodes) == 3 and ways == []
+
+
+def test_tile_size_grows_with_elements():
+    nodes, ways = make_tile()
+    assert tile_size(nodes, ways) > tile_size(nodes, []) > tile_size(NodeStore(), [])
+
+
+def test_tiles_cover_the_square():
+    square = [Coordinates(latitude=50.0, longitude=30.0), Coordinates(latitude=50.2, longitude=30.3)]
+    tiles = calculate_tiles(square, 5)
+
+    assert len(tiles) == len(set(tiles))
+    covered = calculate_tiles_square(tiles)
+    assert covered[0].latitude <= 50.0 and covered[0].longitude <= 30.0
+    assert covered[1].latitude >= 50.2 and covered[1].longitude >= 30.3
+    for latitude in (50.0, 50.05, 50.199):
+        for longitude in (30.0, 30.15, 30.299):
+            assert geohash_encode(Coordinates(latitude=latitude, longitude=longitude), 5) in tiles
+
+
+def test_nodes_are_grouped_by_their_geohash():
+    nodes, _ = make_tile()
+    groups = group_by_tiles(nodes.latitudes, nodes.longitudes, 5)
+
+    assert sorted(index for indexes in groups.values() for index in indexes) == [0, 1, 2]
+    for tile, indexes in groups.items():
+        bottom_left, top_right = geohash_bounds(tile)
+        for index in indexes:
+            assert geohash_encode(nodes[index], 5) == tile
+            assert bottom_left.latitude <= nodes.latitudes[index] <= top_right.latitude
+
+
+def test_responses_are_split_into_tiles_with_their_ways():
+    nodes = NodeStore()
+    for node_id, latitude, longitude in [(1, 50.01, 30.01), (2, 50.01, 30.09), (3, 50.09, 30.09)]:
+        nodes.add(node_id, latitude, longitude)
+    ways = [Way(nodes, array('i', [0, 1, 2]), id=5)]
+    algorithm = BasicAlgorithm(None, tile_precision=5)
+    tiles_chunks = [sorted({geohash_encode(node, 5) for node in nodes})]
+
+    tiles = algorithm.split_tiles(tiles_chunks, [(nodes, ways)])
+
+    assert set(tiles) == set(tiles_chunks[0])
+    # nodes of other tiles are only stored with the ways using them
+    assert sorted(node.id for tile, (tile_nodes, _) in tiles.items() for node in tile_nodes
+                  if geohash_encode(node, 5) == tile) == [1, 2, 3]
+    first_tile_nodes, first_tile_ways = tiles[geohash_encode(nodes[0], 5)]
+    # the way is stored in the tile of its first node, with all its nodes
+    assert [[node.id for node in way.nodes] for way in first_tile_ways] == [[1, 2, 3]]
+    merged_nodes, merged_ways = BasicAlgorithm.merge_nodes_ways(tiles.values())
+    assert sorted(merged_nodes.ids) == [1, 2, 3] and len(merged_ways) == 1
+
+
+def test_rectangles_cover_only_their_tiles():
+    square = [Coordinates(latitude=50.0, longitude=30.0), Coordinates(latitude=50.3, longitude=30.4)]
+    all_tiles = calculate_tiles(square, 5)
+    # cached tiles leave holes in the missing ones
+    missing_tiles = [tile for index, tile in enumerate(all_tiles) if index % 7 not in (2, 3)]
+
+    rectangles = calculate_tiles_rectangles(missing_tiles)
+
+    assert sorted(tile for rectangle in rectangles for tile in rectangle) == sorted(missing_tiles)
+    for rectangle in rectangles:
+        bottom_left, top_right = calculate_tiles_square(rectangle)
+        for tile in all_tiles:
+            tile_bottom_left, tile_top_right = geohash_bounds(tile)
+            center = Coordinates(latitude=(tile_bottom_left.latitude + tile_top_right.latitude) / 2,
+                                 longitude=(tile_bottom_left.longitude + tile_top_right.longitude) / 2)
+            inside = bottom_left.latitude < center.latitude < top_right.latitude and \
+                bottom_left.longitude < center.longitude < top_right.longitude
+            assert inside == (tile in rectangle)
+    assert len(calculate_tiles_rectangles(all_tiles)) == 1
+
+
+def retained_bytes_per_node(build, count: int) -> float:
+    tracemalloc.start()
+    try:
+        kept = build()
+        retained, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert kept is not None
+    return retained / count
+
+
+def test_split_and_merged_nodes_do_not_keep_the_ids_dict():
+    nodes = NodeStore()
+    for node_id in range(20000):
+        nodes.add(node_id, 50 + (node_id % 200) / 1000, 30 + (node_id // 200) / 1000)
+    nodes.drop_index()
+    algorithm = BasicAlgorithm(None, tile_precision=5)
+    tiles_chunks = [sorted(group_by_tiles(nodes.latitudes, nodes.longitudes, 5))]
+
+    tiles = algorithm.split_tiles(tiles_chunks, [(nodes, [])])
+    # 24 bytes of columns per node, the ids dict would add about 100 more
+    assert retained_bytes_per_node(lambda: algorithm.split_tiles(tiles_chunks, [(nodes, [])]), len(nodes)) < 50
+    assert retained_bytes_per_node(lambda: BasicAlgorithm.merge_nodes_ways(tiles.values()), len(nodes)) < 50
+    # the dict is built again for lookups
+    merged_nodes, _ = BasicAlgorithm.merge_nodes_ways(tiles.values())
+    assert merged_nodes.index_of(12345) is not None
+    assert merged_nodes[merged_nodes.index_of(12345)].id == 12345
+    assert merged_nodes.add(12345, 0, 0) == merged_nodes.index_of(12345)
+
+
+def test_cache_eviction_keeps_split_tiles_under_max_bytes():
+    rng, nodes = Random(0), NodeStore()
+    for node_id in range(20000):
+        nodes.add(node_id, 50 + (node_id % 200) / 1000, 30 + (node_id // 200) / 1000)
+    ways = [Way(nodes, array('i', rng.sample(range(20000), 8)), id=way_id) for way_id in range(1, 2001)]
+    algorithm = BasicAlgorithm(None, tile_precision=5)
+    tiles_chunks = [sorted(group_by_tiles(nodes.latitudes, nodes.longitudes, 5))]
+    tiles_size = sum(tile_size(*nodes_ways) for nodes_ways in algorithm.split_tiles(tiles_chunks, [(nodes, ways)])
+                     .values())
+    memory_cache = MemoryCache(max_bytes=tiles_size // 2)
+    cache_provider = CacheProvider(None, memory_cache=memory_cache)
+
+    tracemalloc.start()
+    try:
+        for _ in range(4):
+            tiles = algorithm.split_tiles(tiles_chunks, [(nodes, ways)])
+            # lookups in the tiles build their ids dicts again
+            for tile_nodes, _ in tiles.values():
+                tile_nodes.index_of(0)
+            cache_provider.cache_tiles(tiles)
+        del tiles
+        gc.collect()
+        retained, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert memory_cache.stats.evictions > 0
+    assert retained <= memory_cache.max_bytes
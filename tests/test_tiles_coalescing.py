@@ -0,0 +1,150 @@
+import threading
+import time
+
+import pytest
+
+from adapters.db_sqlite_adapter import SqliteDbAdapter
+from base_algo import BasicAlgorithm
+from dto import Coordinates, NodeStore
+from providers import SingleFlight, CacheProvider, MapsProviderBase, MapsRequestData, MapsRequestType, \
+    calculate_tiles, geohash_bounds
+
+TILE_PRECISION = 5
+SQUARE = [Coordinates(latitude=50.0, longitude=30.0), Coordinates(latitude=50.1, longitude=30.1)]
+
+
+class SquaresMapsProvider(MapsProviderBase):
+    """
+    Answers every square with one node in its center and records the requested squares
+    """
+
+    def __init__(self, delay_seconds: float = 0):
+        self.delay_seconds = delay_seconds
+        self.squares = []
+        self.lock = threading.Lock()
+
+    def get_osm_nodes_ways(self, request_data: MapsRequestData, request_type: MapsRequestType):
+        raise NotImplementedError()
+
+    async def get_osm_nodes_ways_async(self, request_data: MapsRequestData, request_type: MapsRequestType):
+        raise NotImplementedError()
+
+    def get_osm_nodes_ways_areas(self, request_data: MapsRequestData, request_type: MapsRequestType) -> list:
+        time.sleep(self.delay_seconds)
+        responses = []
+        for bottom_left, top_right in request_data.square_coordinates:
+            with self.lock:
+                self.squares.append((bottom_left, top_right))
+            nodes = NodeStore()
+            nodes.add(len(self.squares), (bottom_left.latitude + top_right.latitude) / 2,
+                      (bottom_left.longitude + top_right.longitude) / 2)
+            responses.append((nodes, []))
+        return responses
+
+    def requested_tiles(self, tiles: list) -> set:
+        return {tile for tile in tiles for bottom_left, top_right in self.squares
+                if bottom_left.latitude <= tile_center(tile).latitude <= top_right.latitude and
+                bottom_left.longitude <= tile_center(tile).longitude <= top_right.longitude}
+
+
+def tile_center(tile: str) -> Coordinates:
+    bottom_left, top_right = geohash_bounds(tile)
+    return Coordinates(latitude=(bottom_left.latitude + top_right.latitude) / 2,
+                       longitude=(bottom_left.longitude + top_right.longitude) / 2)
+
+
+@pytest.fixture
+def cache_provider(tmp_path):
+    db_adapter = SqliteDbAdapter(str(tmp_path / 'cache.sqlite'), 'user_search')
+    cache_provider = CacheProvider(db_adapter)
+    cache_provider.ensure_indexes()
+    yield cache_provider
+    db_adapter.close()
+
+
+def test_single_flight_claims_keys_once():
+    single_flight = SingleFlight()
+
+    claimed, in_flight = single_flight.claim(['a', 'b'])
+    claimed_again, in_flight_again = single_flight.claim(['b', 'c'])
+
+    assert (list(claimed), list(in_flight)) == (['a', 'b'], [])
+    assert (list(claimed_again), list(in_flight_again)) == (['c'], ['b'])
+    single_flight.resolve('b', 'result')
+    single_flight.resolve('a', None)
+    assert in_flight_again['b'].result(timeout=1) == 'result'
+    # resolved keys are claimed by the next caller
+    assert list(single_flight.claim(['a', 'b'])[0]) == ['a', 'b']
+    # resolving a key which is not claimed does nothing
+    single_flight.resolve('missing', 'result')
+
+
+def test_concurrent_searches_request_tiles_once():
+    maps_provider = SquaresMapsProvider(delay_seconds=0.2)
+    tiles = calculate_tiles(SQUARE, TILE_PRECISION)
+    results = []
+
+    def search():
+        algorithm = BasicAlgorithm(maps_provider, tile_precision=TILE_PRECISION)
+        results.append(algorithm.request_missing_tiles([tiles], tiles))
+
+    threads = [threading.Thread(target=search) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [set(result) for result in results] == [set(tiles)] * 4
+    assert len(maps_provider.squares) == len(BasicAlgorithm.split_tiles_rectangles([tiles]))
+
+
+def test_tiles_leased_by_another_process_are_waited_for(cache_provider):
+    maps_provider = SquaresMapsProvider()
+    tiles = calculate_tiles(SQUARE, TILE_PRECISION)
+    leased_elsewhere = tiles[:3]
+    assert cache_provider.acquire_tiles_leases(leased_elsewhere, 'other', 5) == leased_elsewhere
+
+    def other_process():
+        time.sleep(0.2)
+        cache_provider.save_tiles({tile: (NodeStore(), []) for tile in leased_elsewhere})
+        cache_provider.release_tiles_leases(leased_elsewhere, 'other')
+
+    thread = threading.Thread(target=other_process)
+    thread.start()
+    algorithm = BasicAlgorithm(maps_provider, cache_provider=cache_provider, tile_precision=TILE_PRECISION,
+                               tiles_lease_seconds=5)
+    tiles_nodes_ways = algorithm.request_missing_tiles([tiles], tiles)
+    thread.join()
+
+    assert set(tiles_nodes_ways) == set(tiles)
+    assert maps_provider.requested_tiles(tiles) == set(tiles) - set(leased_elsewhere)
+    # leases of the search are released
+    assert cache_provider.acquire_tiles_leases(tiles, 'third', 5) == tiles
+
+
+def test_expired_lease_is_requested_by_the_waiting_search(cache_provider):
+    maps_provider = SquaresMapsProvider()
+    tiles = calculate_tiles(SQUARE, TILE_PRECISION)
+    # the owner crashed and never writes the tile
+    cache_provider.acquire_tiles_leases(tiles[:1], 'crashed', 60)
+    algorithm = BasicAlgorithm(maps_provider, cache_provider=cache_provider, tile_precision=TILE_PRECISION,
+                               tiles_lease_seconds=0.6)
+
+    tiles_nodes_ways = algorithm.request_missing_tiles([tiles], tiles)
+
+    assert set(tiles_nodes_ways) == set(tiles)
+    assert maps_provider.requested_tiles(tiles) == set(tiles)
+
+
+def test_leases_conflict_until_they_expire(cache_provider):
+    assert cache_provider.acquire_tiles_leases(['a', 'b'], 'first', 60) == ['a', 'b']
+    assert cache_provider.acquire_tiles_leases(['a', 'b', 'c'], 'second', 60) == ['c']
+    # only the owner releases its leases
+    cache_provider.release_tiles_leases(['a', 'c'], 'first')
+    assert cache_provider.acquire_tiles_leases(['a', 'c'], 'third', 60) == ['a']
+
+    assert cache_provider.acquire_tiles_leases(['d'], 'first', -1) == ['d']
+    # an expired lease is taken over, and removed by the TTL index of the lease date
+    assert cache_provider.db_adapter.select({"_id": {"lease": "d"}}) is None
+    assert cache_provider.acquire_tiles_leases(['d'], 'second', 60) == ['d']
+    assert cache_provider.db_adapter.select({"_id": {"lease": "d"}})["owner"] == 'second'